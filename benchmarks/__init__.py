@@ -0,0 +1,3 @@
+'''
+Benchmarks of the iEEG and fMRI hot paths on synthetic data, see benchmarks/run.py
+'''
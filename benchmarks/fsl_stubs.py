@@ -0,0 +1,88 @@
+'''
+Stand-ins for the FSL commands of the pipeline, writing the outputs the later tasks read without doing the analysis:
+bet copies, fast scales the brain to a partial volume map, FEAT writes filtered_func_data, mean_func, motion
+parameters and an identity registration whose warp is a zero cubic spline coefficient file, and nii2mgh writes
+nothing. Every call is appended to a JSON lines log with its start and end time.
+write_stubs writes one executable per command for the tools argument of fsl_pipeline
+
+python -m benchmarks.fsl_stubs log.jsonl command [arguments]
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import nibabel
+import numpy as np
+
+from benchmarks.synthetic import write_fnirt_coefficients
+
+COMMANDS = ('bet', 'fast', 'feat', 'nii2mgh')
+
+
+def write_stubs(directory, log):
+    '''Executable scripts named after COMMANDS in directory, logging to log. Returns the tools dict'''
+    if not os.path.isdir(directory): os.makedirs(directory)
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    tools = {}
+    for command in COMMANDS:
+        tools[command] = os.path.join(directory, command)
+        with open(tools[command], 'w') as f:
+            f.write('#!/bin/sh\nPYTHONPATH="' + root + '${PYTHONPATH:+:$PYTHONPATH}" exec "' + sys.executable +
+                    '" -m benchmarks.fsl_stubs "' + log + '" ' + command + ' "$@"\n')
+        os.chmod(tools[command], 0o755)
+    return tools
+
+
+def bet(t1w, t1w_brain, *args):
+    shutil.copy(t1w, t1w_brain)
+
+
+def fast(*args):
+    base = re.sub(r'\.nii(\.gz)?$', '', args[args.index('-o') + 1])
+    img = nibabel.load(args[-1])
+    data = np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3])
+    nibabel.save(nibabel.Nifti1Image(data / data.max(), img.affine), base + '_pve_1.nii.gz')
+
+
+def feat(fsf_file):
+    with open(fsf_file) as f:
+        fsf = dict(re.findall(r'^set (\S+) (.*)$', f.read(), re.M))
+    if fsf['fmri(level)'] != '1':
+        os.makedirs(fsf['fmri(outputdir)'].strip('"').rstrip(os.sep) + '.gfeat')
+        return
+    func = fsf['feat_files(1)'].strip('"')
+    feat_dir = func + '.feat'
+    for d in ['mc', 'reg']:
+        os.makedirs(os.path.join(feat_dir, d))
+    img = nibabel.load(func + '.nii.gz')
+    shutil.copy(func + '.nii.gz', os.path.join(feat_dir, 'filtered_func_data.nii.gz'))
+    mean = nibabel.Nifti1Image(np.asarray(img.dataobj, dtype=np.float32).mean(-1), img.affine)
+    for name in ['mean_func.nii.gz', os.path.join('reg', 'example_func.nii.gz'),
+                 os.path.join('reg', 'standard.nii.gz')]:
+        nibabel.save(mean, os.path.join(feat_dir, name))
+    rng = np.random.default_rng(0)
+    np.savetxt(os.path.join(feat_dir, 'mc', 'prefiltered_func_data_mcf.par'),
+               np.cumsum(rng.normal(0, [1e-3] * 3 + [.1] * 3, (img.shape[-1], 6)), 0))
+    for name in ['example_func2highres.mat', 'highres2example_func.mat']:
+        np.savetxt(os.path.join(feat_dir, 'reg', name), np.eye(4))
+    spacing = (5, 5, 5)
+    write_fnirt_coefficients(os.path.join(feat_dir, 'reg', 'highres2standard_warp.nii.gz'),
+                             np.zeros([int(np.ceil((n + 1) / k)) + 2 for n, k in zip(img.shape[:3], spacing)] + [3]),
+                             spacing, img.shape[:3])
+
+
+def nii2mgh(*args):
+    pass
+
+
+##
+if __name__ == '__main__':
+    log, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    start = time.time()
+    globals()[command](*args)
+    line = json.dumps({'command': command, 'args': args, 'start': start, 'end': time.time()}) + '\n'
+    with open(log, 'a') as f:
+        f.write(line)
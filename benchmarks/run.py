@@ -0,0 +1,478 @@
+'''
+Time, peak memory and accuracy against the reference implementations of the hot paths on synthetic data.
+Results are written as JSON, --compare prints the speedup over an earlier result file
+
+python -m benchmarks.run
+    -o results.json
+    [--size small|full]
+    [--only extract_bands calculate_r_squared ...]
+    [--compare baseline.json]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from ieeg_fmri_validation.instrument import current_rss, peak_rss, reset_peak_rss
+from benchmarks import synthetic
+
+SIZES = {'small': {'n_channels': 16, 'sfreq': 1024., 'maxlag': 25, 'shape': [32, 32, 20], 'n_vols': 200,
+                   'n_inputs': 100, 'n_variants': 200, 'n_perm': 1000, 'n_subjects': 3, 'repeat': 3},
+         'full': {'n_channels': 128, 'sfreq': 2048., 'maxlag': 25, 'shape': [64, 64, 40], 'n_vols': 641,
+                  'n_inputs': 1000, 'n_variants': 2000, 'n_perm': 10000, 'n_subjects': 8, 'repeat': 5}}
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(func, repeat=1):
+    '''Returns the result of func(), the best wall time of repeat calls, and peak RSS above the RSS before'''
+    seconds = []
+    rss_before = current_rss()
+    reset_peak_rss()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return result, {'seconds': min(seconds), 'seconds_all': seconds, 'peak_rss': peak_rss(),
+                    'peak_rss_delta': max(peak_rss() - rss_before, 0)}
+
+
+def accuracy(name, value, tol):
+    return {'metric': name, 'value': float(value), 'tol': tol, 'passed': bool(value <= tol)}
+
+
+def _ieeg_dataset(config, workdir):
+    root = os.path.join(workdir, 'bids')
+    if not os.path.isdir(root):
+        synthetic.make_ieeg_dataset(root, n_channels=config['n_channels'], sfreq=config['sfreq'])
+    return root
+
+
+def _film(root, **kwargs):
+    from ieeg_fmri_validation.iemu.classes import FilmDataset
+    film = FilmDataset(root, '01', acquisition='clinical', **kwargs)
+    film.preprocess()
+    film.extract_events()
+    return film
+
+
+@benchmark
+def extract_bands(config, workdir):
+    '''preprocess + extract_bands of a film run, against the MNE filter + apply_hilbert path'''
+    root = _ieeg_dataset(config, workdir)
+
+    def run(method):
+        film = _film(root)
+        film.extract_bands(method=method)
+        return np.stack(list(film.band_block_means.values()))
+
+    result, stats = measure(lambda: run('fft'))
+    reference, reference_stats = measure(lambda: run('mne'))
+    stats['reference_seconds'] = reference_stats['seconds']
+    stats['accuracy'] = accuracy('max abs diff of z-scored block means', np.max(np.abs(result - reference)), 5e-2)
+    return stats
+
+
+@benchmark
+def crop_to_task(config, workdir):
+    '''Film run cropped to the task window before preprocessing, against the uncropped run, both with the FFT
+    band envelopes (the MNE ones are not local, see _crop_to_task_window): envelopes relative to their RMS per
+    band, gamma OLS t and best lags. Delta is held to 1e-2, its filter edges reach furthest'''
+    root = _ieeg_dataset(config, workdir)
+
+    def run(crop):
+        film = _film(root, crop_to_task=crop, band_method='fft')
+        film.extract_bands()
+        return film.bands.data, film.run_task_gamma_ols()
+
+    (result, ols), stats = measure(lambda: run(True))
+    (reference, reference_ols), reference_stats = measure(lambda: run(False))
+    stats['reference_seconds'] = reference_stats['seconds']
+    diff = np.max(np.abs(result - reference), (1, 2)) / np.sqrt(np.mean(reference ** 2, (1, 2)))
+    stats['rel_diff_per_band'] = diff.tolist()
+    stats['max_abs_diff_t'] = float(np.max(np.abs(ols['tvalue'] - reference_ols['tvalue'])))
+    stats['lags_differ'] = int(np.sum(ols['lags'] != reference_ols['lags']))
+    stats['accuracy'] = accuracy('max rel diff of theta to gamma envelopes (inf if delta differs by more than 1e-2, '
+                                 't by more than 1e-4 or any lag)',
+                                 np.max(diff[1:]) if diff[0] <= 1e-2 and stats['max_abs_diff_t'] <= 1e-4 and
+                                 not stats['lags_differ'] else np.inf, 1e-4)
+    return stats
+
+
+@benchmark
+def load_signal(config, workdir):
+    '''Signal of the good ECoG channels of a film run with the memory-mapped reader, against mne's reader'''
+    from ieeg_fmri_validation.iemu.classes import FilmDataset
+    root = _ieeg_dataset(config, workdir)
+
+    def run(reader):
+        film = FilmDataset(root, '01', acquisition='clinical', reader=reader)
+        film._discard_bad_electrodes()
+        film._load_signal()
+        return film.raw.get_data()
+
+    result, stats = measure(lambda: run('native'), config['repeat'])
+    reference, reference_stats = measure(lambda: run('mne'), config['repeat'])
+    stats['reference_seconds'] = reference_stats['seconds']
+    stats['accuracy'] = accuracy('max abs diff of signal in V', np.max(np.abs(result - reference)), 0)
+    return stats
+
+
+def _replay_unaligned(root, skip=123, block_seconds=.37):
+    '''Film run pushed to OnlineFilm from sample skip on in blocks of an odd number of samples, so that neither
+    the markers nor the blocks fall on chunk boundaries'''
+    from ieeg_fmri_validation.iemu.classes import FilmDataset
+    from ieeg_fmri_validation.iemu.online import OnlineFilm
+    film = FilmDataset(root, '01', acquisition='clinical', preload=False)
+    film._discard_bad_electrodes()
+    film._read_events()
+    sfreq = film.raw.info['sfreq']
+    start, stop = film.events[[0, -1], 0] - film.raw.first_samp - skip
+    online = OnlineFilm(film.raw.ch_names, sfreq, start, stop, subject=film.subject,
+                        expected_duration=film.expected_duration)
+    block = int(block_seconds * sfreq) | 1
+    for s in range(skip, film.raw.n_times, block):
+        online.push(film._read_signal(s, min(s + block, film.raw.n_times)))
+    online.finish()
+    return online
+
+
+@benchmark
+def online_replay(config, workdir):
+    '''Film run replayed in 0.5 s blocks through the online mapping, and from an unaligned start in odd-sized
+    blocks, final gamma t against the streamed offline run_task_gamma_ols'''
+    from ieeg_fmri_validation.iemu.classes import FilmDataset
+    from ieeg_fmri_validation.iemu.online import replay
+    root = _ieeg_dataset(config, workdir)
+    online, stats = measure(lambda: replay(FilmDataset(root, '01', acquisition='clinical', preload=False)))
+    unaligned = _replay_unaligned(root)
+    film = _film(root, streaming=True)
+    film.extract_bands()
+    reference = film.run_task_gamma_ols()
+    stats['max_latency'] = max(update.latency for update in online.updates + unaligned.updates)
+    stats['max_block_seconds'] = max(update.seconds for update in online.updates)
+    diff = 0
+    for result in (online.gamma_ols(), unaligned.gamma_ols()):
+        same = list(result['name']) == list(reference['name']) and np.array_equal(result['lags'], reference['lags'])
+        diff = max(diff, np.max(np.abs(result['tvalue'] - reference['tvalue'])) if same else np.inf)
+    stats['accuracy'] = accuracy('max abs diff of t, aligned and unaligned (inf if channels or lags differ)', diff,
+                                 1e-3)
+    return stats
+
+
+def _ols_data(config):
+    rng = np.random.default_rng(0)
+    design = np.hstack([np.zeros(30 * 25), np.ones(30 * 25)] * 7)[:-30 * 25]
+    Y = rng.standard_normal((len(design), config['n_channels'])) + \
+        np.roll(design, 5)[:, None] * rng.uniform(0, 1, config['n_channels'])
+    return design, Y
+
+
+@benchmark
+def run_OLS_block_design(config, workdir):
+    '''Batched closed-form lagged OLS against one statsmodels fit per channel and lag'''
+    from ieeg_fmri_validation.iemu.routines import run_OLS_block_design
+    design, Y = _ols_data(config)
+    result, stats = measure(lambda: run_OLS_block_design(design, Y, config['maxlag'], 5e-2), config['repeat'])
+    reference, reference_stats = measure(lambda: run_OLS_block_design(design, Y, config['maxlag'], 5e-2,
+                                                                      engine='statsmodels'))
+    stats['reference_seconds'] = reference_stats['seconds']
+    same = np.array_equal(result[1], reference[1]) and np.array_equal(result[2], reference[2])
+    stats['accuracy'] = accuracy('max abs diff of t (inf if lags or significance differ)',
+                                 np.max(np.abs(result[0] - reference[0])) if same else np.inf, 1e-8)
+    return stats
+
+
+@benchmark
+def permutation_test_ols(config, workdir):
+    '''n_perm block permutations with max-statistic correction, observed t against run_OLS_block_design'''
+    from ieeg_fmri_validation.iemu.routines import run_OLS_block_design
+    from ieeg_fmri_validation.iemu.permutation import permutation_test_ols
+    design, Y = _ols_data(config)
+    result, stats = measure(lambda: permutation_test_ols(design, Y, config['maxlag'], config['n_perm']))
+    reference = run_OLS_block_design(design, Y, config['maxlag'], 5e-2)
+    same = np.array_equal(result[1], reference[1])
+    stats['accuracy'] = accuracy('max abs diff of observed t (inf if lags differ)',
+                                 np.max(np.abs(result[0] - reference[0])) if same else np.inf, 1e-8)
+    return stats
+
+
+@benchmark
+def calculate_r_squared(config, workdir):
+    '''Vectorized signed r2 of block means of all bands and channels against scipy.stats.pearsonr'''
+    from scipy import stats as sp_stats
+    from ieeg_fmri_validation.iemu.routines import calculate_r_squared
+    rng = np.random.default_rng(0)
+    design = np.array([0, 1] * 7)[:-1]
+    block_means = rng.standard_normal((5, len(design), config['n_channels'])) + design[:, None]
+    result, stats = measure(lambda: calculate_r_squared(block_means, design[:, None]), config['repeat'] * 100)
+    reference = np.array([[sp_stats.pearsonr(block_means[b, :, c], design) for c in range(block_means.shape[-1])]
+                          for b in range(block_means.shape[0])])
+    r2 = np.sign(reference[..., 0]) * reference[..., 0] ** 2
+    stats['accuracy'] = accuracy('max abs diff of r2 and p', max(np.max(np.abs(result[0] - r2)),
+                                                                 np.max(np.abs(result[1] - reference[..., 1]))), 1e-10)
+    return stats
+
+
+@benchmark
+def run_rest_speech_r_squared(config, workdir):
+    '''Speech-rest r2 on precomputed envelopes, against calculate_r_squared per channel'''
+    from ieeg_fmri_validation.iemu.routines import run_rest_speech_r_squared, calculate_r_squared
+    rng = np.random.default_rng(0)
+    ch_names = ['G' + str(i + 1) for i in range(config['n_channels'])]
+    bands = ['delta', 'theta', 'alpha', 'beta', 'gamma']
+
+    def dataset(duration, **kwargs):
+        envelopes = OrderedDict((band, rng.standard_normal((duration * 25, len(ch_names)))) for band in bands)
+        return SimpleNamespace(bands=envelopes, expected_duration=duration, subject='01',
+                               raw=SimpleNamespace(ch_names=ch_names),
+                               band_block_means=OrderedDict((band, np.zeros((duration // 30, len(ch_names))))
+                                                            for band in bands), **kwargs)
+    film, rest = dataset(390), dataset(180, type_rest='rest task')
+    result, stats = measure(lambda: run_rest_speech_r_squared(film, rest), config['repeat'])
+
+    film_gamma = film.bands['gamma'].reshape((-1, 750, len(ch_names)))[1::2].reshape((-1, len(ch_names)))
+    both = np.vstack([rest.bands['gamma'], film_gamma])
+    both = (both - both.mean(0)) / both.std(0)
+    block_means = both.reshape((-1, 750, len(ch_names))).mean(1)
+    r2, p = calculate_r_squared(block_means, np.array([0] * 6 + [1] * 6)[:, None])
+    got = result[result['band'] == 'gamma']
+    stats['accuracy'] = accuracy('max abs diff of gamma r2', np.max(np.abs(got['r2'].values - r2)), 1e-10)
+    return stats
+
+
+@benchmark
+def tsnr(config, workdir):
+    '''Streaming tSNR from a gzipped 4D run, against math_tsnr on the fully loaded data'''
+    import nibabel
+    from ieeg_fmri_validation.fmri.tsnr import stream_tsnr, math_tsnr
+    path = os.path.join(workdir, 'bold.nii.gz')
+    if not os.path.isfile(path):
+        synthetic.make_nifti_run(path, tuple(config['shape']), config['n_vols'])
+
+    def reference():
+        x = nibabel.load(path).get_fdata()
+        x = x.reshape(-1, x.shape[-1])
+        select = np.all(x != 0, 1)
+        return math_tsnr(x[select]), select
+
+    result, stats = measure(lambda: stream_tsnr(nibabel.load(path, keep_file_open=True)))
+    (expected, select), reference_stats = measure(reference)
+    stats['reference_seconds'] = reference_stats['seconds']
+    stats['reference_peak_rss_delta'] = reference_stats['peak_rss_delta']
+    stats['accuracy'] = accuracy('max rel diff of tSNR (inf if voxel selection differs)',
+                                 np.max(np.abs(result[0] - expected) / expected)
+                                 if np.array_equal(result[1], select) else np.inf, 1e-10)
+    return stats
+
+
+@benchmark
+def apply_warp(config, workdir):
+    '''In-process applywarp with a premat and a displacement field, trilinear and nearest neighbour, against
+    applywarp when FSL is installed, else against map_coordinates at the known sample coordinates. Voxels that
+    sample within one voxel of the input edge are left out, FSL pads the edge differently'''
+    import nibabel
+    from scipy.ndimage import map_coordinates
+    from ieeg_fmri_validation.fmri import warp
+    paths, coordinates = synthetic.make_warp(os.path.join(workdir, 'warp'), tuple(config['shape']))
+    runs = (('in', 1, 'trilinear'), ('labels', 0, 'nn'))
+
+    def native():
+        warp._cached_grid.cache_clear()
+        return [warp.apply_warp(paths['ref'], paths[name], premat=paths['premat'], warp=paths['warp'],
+                                order=order).get_fdata() for name, order, _ in runs]
+
+    def reference(name, order, interp):
+        if shutil.which('applywarp') is None:
+            data = nibabel.load(paths[name]).get_fdata()
+            return map_coordinates(data, coordinates, order=order, mode='nearest').reshape(tuple(config['shape']))
+        out_file = os.path.join(workdir, 'warp', name + '_applywarp.nii.gz')
+        subprocess.check_call(['applywarp', '--ref=' + paths['ref'], '--in=' + paths[name],
+                               '--premat=' + paths['premat'], '--warp=' + paths['warp'], '--interp=' + interp,
+                               '--out=' + out_file])
+        return nibabel.load(out_file).get_fdata()
+
+    result, stats = measure(native)
+    stats['reference'] = 'applywarp' if shutil.which('applywarp') else 'map_coordinates'
+    shape = np.array(nibabel.load(paths['in']).shape)[:, None]
+    interior = np.all((coordinates >= 1) & (coordinates <= shape - 2), 0).reshape(tuple(config['shape']))
+    values = nibabel.load(paths['in']).get_fdata()
+    trilinear, nearest = [reference(*run)[interior] for run in runs]
+    diff = np.max(np.abs(result[0][interior] - trilinear)) / np.ptp(values)
+    stats['nn_mismatch'] = float(np.mean(result[1][interior] != nearest))
+    stats['accuracy'] = accuracy('max abs diff of trilinear values relative to input range (inf if more than 1e-3 of '
+                                 'nearest neighbour labels differ)', diff if stats['nn_mismatch'] <= 1e-3 else np.inf,
+                                 1e-4)
+    return stats
+
+
+@benchmark
+def fsl_pipeline(config, workdir):
+    '''fsl_pipeline with the grey mask on n_subjects synthetic subjects, with the FSL commands replaced by
+    fsl_stubs. Checks that every task ran, that second level started after all first levels ended and that a
+    rerun finds every task current'''
+    from ieeg_fmri_validation.fmri.pipeline import fsl_pipeline
+    from benchmarks import fsl_stubs
+    root = os.path.join(workdir, 'pipeline')
+    shutil.rmtree(root, ignore_errors=True)
+    synthetic.make_fmri_dataset(os.path.join(root, 'bids'), config['n_subjects'])
+    log = os.path.join(root, 'stubs.jsonl')
+    tools = fsl_stubs.write_stubs(os.path.join(root, 'stubs'), log)
+
+    def run():
+        return fsl_pipeline(os.path.join(root, 'bids'), os.path.join(root, 'output') + os.sep, tools,
+                            use_grey_mask=True).run(jobs=4)
+
+    status, stats = measure(run)
+    rerun = run()
+    with open(log) as f:
+        calls = [json.loads(line) for line in f]
+    feats = [c for c in calls if c['command'] == 'feat']
+    second = [c for c in feats if 'second_level' in c['args'][0]]
+    first_end = max(c['end'] for c in feats if 'first_level' in c['args'][0])
+    stats['status'] = dict((state, list(status.values()).count(state)) for state in set(status.values()))
+    stats['errors'] = {'not ran': sum(s != 'ran' for s in status.values()),
+                       'second level before first levels': sum(c['start'] < first_end for c in second),
+                       'not current on rerun': sum(s != 'current' for s in rerun.values())}
+    stats['accuracy'] = accuracy('number of ordering or rerun errors', sum(stats['errors'].values()), 0)
+    return stats
+
+
+@benchmark
+def fnirt_coefficients(config, workdir):
+    '''Displacement field of an FNIRT cubic spline coefficient file with a starting affine, evaluated in process,
+    against convertwarp --relout when FSL is installed, else against scipy B-spline design matrices'''
+    import nibabel
+    from scipy.interpolate import BSpline
+    from ieeg_fmri_validation.fmri import warp
+    paths, _ = synthetic.make_warp(os.path.join(workdir, 'warp'), tuple(config['shape']))
+    shape, zooms, affine = warp.geometry(paths['ref'])
+    spacing = (4, 4, 3)
+    n_coefficients = [int(np.ceil((n + 1) / k)) + 2 for n, k in zip(shape, spacing)]
+    aff = warp.read_fsl_mat(paths['premat'])
+    path = synthetic.write_fnirt_coefficients(os.path.join(workdir, 'warp', 'coefficients.nii.gz'),
+                                              np.random.default_rng(0).normal(0, 2, n_coefficients + [3]),
+                                              spacing, shape, aff)
+
+    def reference():
+        if shutil.which('convertwarp') is not None:
+            out_file = os.path.join(workdir, 'warp', 'coefficients_convertwarp.nii.gz')
+            subprocess.check_call(['convertwarp', '--ref=' + paths['ref'], '--warp1=' + path, '--relout',
+                                   '--out=' + out_file])
+            return nibabel.load(out_file).get_fdata()
+        design = []
+        for n, c, k in zip(shape, n_coefficients, spacing):
+            # a knot beyond either end, so that every voxel lies inside the base interval
+            knots = ((n - 1) - (c - 1) * k) / 2. + k * np.arange(-3, c + 3)
+            design.append(BSpline.design_matrix(np.arange(n, dtype=np.float64), knots, 3).toarray()[:, 1:-1])
+        data = nibabel.load(path).get_fdata()
+        field = np.stack([np.einsum('ia,jb,kc,abc->ijk', *design, data[..., i]) for i in range(3)], -1)
+        mm = np.indices(shape, dtype=np.float64).reshape(3, -1) * np.array(zooms)[:, None]
+        mm[0] = (shape[0] - 1) * zooms[0] - mm[0] if np.linalg.det(affine[:3, :3]) > 0 else mm[0]
+        moved = np.linalg.inv(aff)[:3].dot(np.vstack([mm, np.ones(mm.shape[1])]))
+        return field + (moved - mm).T.reshape(tuple(shape) + (3,))
+
+    result, stats = measure(lambda: warp.coefficients_to_field(path, paths['ref']).get_fdata(), config['repeat'])
+    stats['reference'] = 'convertwarp' if shutil.which('convertwarp') else 'scipy'
+    stats['accuracy'] = accuracy('max abs diff of displacements in mm', np.max(np.abs(result - reference())), 1e-3)
+    return stats
+
+
+@benchmark
+def FSL_template(config, workdir):
+    '''Second-level design with n_inputs inputs and n_variants per-subject first-level designs'''
+    from ieeg_fmri_validation.fmri.classes import FSL_template
+    inputs = [os.path.join(workdir, 'sub-' + str(i) + '_bold') for i in range(config['n_inputs'])]
+
+    def run():
+        fsf = FSL_template('second_level')
+        fsf.set_output_directory(workdir)
+        fsf.set_4D_data(inputs)
+        fsf.set_EV_values()
+        fsf.set_group_membership()
+        rendered = [fsf.render()]
+        base = FSL_template('first_level')
+        for i in range(config['n_variants']):
+            variant = base.copy()
+            variant.set_4D_data([inputs[i % len(inputs)]])
+            variant.set_structural_images([inputs[i % len(inputs)] + '_T1w_brain'])
+            rendered.append(variant.render())
+        return rendered
+
+    result, stats = measure(run, config['repeat'])
+    with open(FSL_template('first_level').template) as f:
+        template = f.read()
+    stats['accuracy'] = accuracy('template round trip differs', float(FSL_template('first_level').render() != template)
+                                 + float(result[0].count('set feat_files(') != config['n_inputs']), 0)
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(size='small', only=None, workdir=None, **overrides):
+    config = dict(SIZES[size], **overrides)
+    remove = workdir is None
+    workdir = tempfile.mkdtemp(prefix='ieeg_fmri_benchmarks') if workdir is None else workdir
+    output = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'size': size, 'config': config,
+              'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'cpus': os.cpu_count(), 'results': OrderedDict()}
+    try:
+        for name, func in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            output['results'][name] = func(config, workdir)
+            print(name + ': ' + str(round(output['results'][name]['seconds'], 4)) + ' s, accuracy ' +
+                  ('passed' if output['results'][name]['accuracy']['passed'] else 'FAILED'))
+    finally:
+        if remove:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return output
+
+
+def compare(old, new):
+    '''Print time ratios old / new per benchmark'''
+    for name, result in new['results'].items():
+        if name in old['results']:
+            print(name + ': ' + str(round(old['results'][name]['seconds'] / result['seconds'], 2)) + 'x (' +
+                  str(round(old['results'][name]['seconds'], 4)) + ' -> ' + str(round(result['seconds'], 4)) + ' s)')
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', '-o', type=str, default=None)
+    parser.add_argument('--size', type=str, default='small', choices=list(SIZES))
+    parser.add_argument('--only', type=str, nargs='+', default=None, choices=list(BENCHMARKS))
+    parser.add_argument('--workdir', type=str, default=None, help='keep synthetic data here between runs')
+    parser.add_argument('--compare', type=str, default=None)
+    args = parser.parse_args()
+
+    output = run_benchmarks(args.size, args.only, args.workdir)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+    failed = [name for name, result in output['results'].items() if not result['accuracy']['passed']]
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,170 @@
+'''
+Synthetic BIDS iEEG subjects (BrainVision, channels/electrodes TSV, events as markers) and 4D NIfTI runs
+shaped like the dataset: film task of 13 alternating 30 s music/speech blocks, rest task of 180 s
+'''
+
+import os
+import json
+import nibabel
+import numpy as np
+
+
+def write_brainvision(base, data, sfreq, ch_names, markers, fmt='INT_16', orientation='MULTIPLEXED',
+                      resolution=0.1):
+    '''data in V (channels x time), markers as (sample, description)'''
+    name = os.path.basename(base)
+    with open(base + '.vhdr', 'w') as f:
+        f.write('Brain Vision Data Exchange Header File Version 1.0\n\n[Common Infos]\nCodepage=UTF-8\n'
+                'DataFile=' + name + '.eeg\nMarkerFile=' + name + '.vmrk\nDataFormat=BINARY\n'
+                'DataOrientation=' + orientation + '\nNumberOfChannels=' + str(len(ch_names)) + '\n'
+                'SamplingInterval=' + str(1e6 / sfreq) + '\n\n[Binary Infos]\nBinaryFormat=' + fmt +
+                '\n\n[Channel Infos]\n')
+        for i, ch in enumerate(ch_names):
+            f.write('Ch' + str(i + 1) + '=' + ch + ',,' + str(resolution if fmt == 'INT_16' else 1) + ',µV\n')
+    with open(base + '.vmrk', 'w') as f:
+        f.write('Brain Vision Data Exchange Marker File, Version 1.0\n\n[Common Infos]\nCodepage=UTF-8\n'
+                'DataFile=' + name + '.eeg\n\n[Marker Infos]\nMk1=New Segment,,1,1,0\n')
+        for i, (sample, description) in enumerate(markers):
+            f.write('Mk' + str(i + 2) + '=Stimulus,' + description + ',' + str(sample + 1) + ',1,0\n')
+    x = data / 1e-6
+    x = np.round(x / resolution).astype('<i2') if fmt == 'INT_16' else x.astype('<f4')
+    (x.T if orientation == 'MULTIPLEXED' else x).tofile(base + '.eeg')
+
+
+def make_ieeg_subject(root, subject='01', n_channels=16, sfreq=2048., pad=20., rest=True, seed=0, fmt='INT_16',
+                      acquisition='clinical'):
+    '''One subject with film (and rest) runs: white noise, 50 Hz line noise on all channels and an 80 Hz
+    component during speech blocks with a random gain per channel. The fourth channel is marked bad'''
+    rng = np.random.default_rng(seed)
+    ieeg = os.path.join(root, 'sub-' + subject, 'ses-iemu', 'ieeg')
+    anat = os.path.join(root, 'sub-' + subject, 'ses-mri3t', 'anat')
+    for d in [ieeg, anat]:
+        if not os.path.isdir(d): os.makedirs(d)
+    nibabel.save(nibabel.Nifti1Image(np.zeros((4, 4, 4), np.float32), np.eye(4)),
+                 os.path.join(anat, 'sub-' + subject + '_ses-mri3t_run-1_T1w.nii.gz'))
+    names = ['G' + str(i + 1) for i in range(n_channels)] + ['ECG', 'EOG']
+    types = ['ECOG'] * n_channels + ['ECG', 'EOG']
+    status = ['good'] * len(names)
+    status[3] = 'bad'
+    for task, duration in [('film', 390)] + ([('rest', 180)] if rest else []):
+        n = int((2 * pad + duration) * sfreq)
+        t = np.arange(n) / sfreq
+        data = rng.standard_normal((len(names), n)) * 20e-6
+        if task == 'film':
+            design = np.zeros(n)
+            for b in range(13):
+                start = int((pad + b * 30) * sfreq)
+                design[start:start + int(30 * sfreq)] = b % 2
+            gain = rng.uniform(0, 1, n_channels)[:, None] * rng.standard_normal((n_channels, 1))
+            data[:n_channels] += gain * design * np.sin(2 * np.pi * 80 * t) * 30e-6
+            markers = [(int((pad + b * 30) * sfreq), 'music' if b % 2 == 0 else 'speech') for b in range(13)]
+        else:
+            markers = [(int(pad * sfreq), 'start task')]
+        markers.append((int((pad + duration) * sfreq), 'end task'))
+        data[:n_channels] += np.sin(2 * np.pi * 50 * t) * 50e-6
+        base = os.path.join(ieeg, 'sub-' + subject + '_ses-iemu_task-' + task + '_acq-' + acquisition + '_run-1_ieeg')
+        write_brainvision(base, data, sfreq, names, markers, fmt=fmt)
+        with open(base.replace('_ieeg', '_channels') + '.tsv', 'w') as f:
+            f.write('name\ttype\tunits\tsampling_frequency\tstatus\n')
+            for name, kind, s in zip(names, types, status):
+                f.write(name + '\t' + kind + '\tuV\t' + str(sfreq) + '\t' + s + '\n')
+        if task == 'rest':
+            with open(base + '.json', 'w') as f:
+                json.dump({'TaskDescription': 'rest task'}, f)
+    with open(os.path.join(ieeg, 'sub-' + subject + '_ses-iemu_acq-' + acquisition + '_electrodes.tsv'), 'w') as f:
+        f.write('name\tx\ty\tz\tsize\n')
+        for name in names[:n_channels]:
+            f.write(name + '\t0\t0\t0\t1\n')
+    participants = os.path.join(root, 'participants.tsv')
+    new = not os.path.exists(participants)
+    with open(participants, 'a') as f:
+        if new: f.write('participant_id\thigh_density_grid\n')
+        f.write('sub-' + subject + '\tno\n')
+    with open(os.path.join(root, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'synthetic', 'BIDSVersion': '1.6.0'}, f)
+
+
+def make_ieeg_dataset(root, n_subjects=1, **kwargs):
+    for i in range(n_subjects):
+        make_ieeg_subject(root, '%02d' % (i + 1), seed=i, **kwargs)
+
+
+def make_nifti_run(path, shape=(64, 64, 40), n_vols=641, seed=0, dtype=np.int16):
+    '''4D run with a brain-like ellipsoid of mean 1000 and voxelwise noise level, zeros outside'''
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape, dtype=np.float32)
+    center = (np.array(shape, dtype=np.float32) - 1)[:, None, None, None] / 2
+    inside = (((grid - center) / (0.4 * np.array(shape, dtype=np.float32))[:, None, None, None]) ** 2).sum(0) < 1
+    mean = np.where(inside, 1000., 0.).astype(np.float32)
+    sd = np.where(inside, rng.uniform(5, 50, shape), 0.).astype(np.float32)
+    data = np.empty(shape + (n_vols,), dtype=dtype)
+    for t in range(n_vols):
+        data[..., t] = mean + sd * rng.standard_normal(shape, dtype=np.float32)
+    affine = np.diag([3., 3., 3., 1.])
+    nibabel.save(nibabel.Nifti1Image(data, affine), path)
+    return path
+
+
+def make_fmri_dataset(root, n_subjects=2, shape=(16, 16, 10), n_vols=20):
+    '''BIDS fMRI subjects: a film run (make_nifti_run) and a T1w volume on the same 3 mm grid'''
+    for i in range(n_subjects):
+        subject = '%02d' % (i + 1)
+        func = os.path.join(root, 'sub-' + subject, 'ses-mri3t', 'func')
+        anat = os.path.join(root, 'sub-' + subject, 'ses-mri3t', 'anat')
+        for d in [func, anat]:
+            if not os.path.isdir(d): os.makedirs(d)
+        make_nifti_run(os.path.join(func, 'sub-' + subject + '_ses-mri3t_task-film_run-1_bold.nii.gz'), shape,
+                       n_vols, seed=i)
+        make_nifti_run(os.path.join(anat, 'sub-' + subject + '_ses-mri3t_run-1_T1w.nii.gz'), shape, 1, seed=i)
+
+
+def write_fnirt_coefficients(path, coefficients, spacing, ref_shape, aff=np.eye(4)):
+    '''Cubic spline coefficient file as fnirt --cout writes it: knot spacing in reference voxels as voxel size,
+    the reference shape as qform offset and the starting affine (input -> reference scaled mm) as sform'''
+    img = nibabel.Nifti1Image(np.asarray(coefficients, dtype=np.float32), None)
+    qform = np.diag([float(spacing[0]), spacing[1], spacing[2], 1.])
+    qform[:3, 3] = ref_shape
+    img.set_qform(qform, 1)
+    img.set_sform(aff, 1)
+    img.header['intent_code'] = 2007  # FSL_CUBIC_SPLINE_COEFFICIENTS
+    nibabel.save(img, path)
+    return path
+
+
+def make_warp(directory, shape=(64, 64, 40), seed=0):
+    '''Reference grid (radiological, 2 mm), input volume and label volume (neurological, 2.5 mm), a FLIRT matrix
+    from input to reference scaled mm and a relative FNIRT displacement field in mm on the reference grid. Returns
+    the paths and the input voxel coordinates every reference voxel samples, worked out in FSL scaled mm'''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = dict((name, os.path.join(directory, name + '.nii.gz')) for name in ('ref', 'in', 'labels', 'warp'))
+    paths['premat'] = os.path.join(directory, 'premat.mat')
+
+    ref_zooms, in_zooms = np.array([2., 2., 2.]), np.array([2.5, 2.5, 2.5])
+    in_shape = tuple(int(n) for n in np.ceil(np.array(shape) * ref_zooms / in_zooms) + 2)
+    ref_affine = np.diag(np.append(ref_zooms * [-1, 1, 1], 1.))
+    ref_affine[0, 3] = (shape[0] - 1) * ref_zooms[0]
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape, dtype=np.float32), ref_affine), paths['ref'])
+    in_affine = np.diag(np.append(in_zooms, 1.))
+    smooth = np.cumsum(np.cumsum(np.cumsum(rng.standard_normal(in_shape), 0), 1), 2)
+    nibabel.save(nibabel.Nifti1Image(smooth.astype(np.float32), in_affine), paths['in'])
+    nibabel.save(nibabel.Nifti1Image(rng.integers(1, 50, in_shape).astype(np.int16), in_affine), paths['labels'])
+
+    angle = np.deg2rad(5)
+    premat = np.array([[np.cos(angle), -np.sin(angle), 0, 3.], [np.sin(angle), np.cos(angle), 0, -2.],
+                       [0, 0, 1.02, 4.], [0, 0, 0, 1]])
+    np.savetxt(paths['premat'], premat, fmt='%.10f')
+
+    grid = np.indices(shape, dtype=np.float64)
+    field = np.stack([3 * np.sin(2 * np.pi * grid[(i + 1) % 3] / shape[(i + 1) % 3]) for i in range(3)], -1)
+    img = nibabel.Nifti1Image(field.astype(np.float32), ref_affine)
+    img.header['intent_code'] = 2006  # FSL_FNIRT_DISPLACEMENT_FIELD
+    nibabel.save(img, paths['warp'])
+
+    # reference voxel -> scaled mm (radiological: voxel times size) -> displaced -> input scaled mm -> input voxel
+    # (neurological: x counted from the last voxel)
+    mm = grid.reshape(3, -1) * ref_zooms[:, None] + np.asarray(img.dataobj, dtype=np.float64).reshape(-1, 3).T
+    mm = np.linalg.inv(premat)[:3].dot(np.vstack([mm, np.ones(mm.shape[1])]))
+    coordinates = mm / in_zooms[:, None]
+    coordinates[0] = in_shape[0] - 1 - coordinates[0]
+    return paths, coordinates
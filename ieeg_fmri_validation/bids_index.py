@@ -0,0 +1,170 @@
+'''
+One-pass index of a BIDS tree in SQLite, a drop-in resolver for mne_bids.get_entity_vals and BIDSPath.match
+
+python -m ieeg_fmri_validation.bids_index
+    -i bids_dir
+    [--db index.sqlite]
+'''
+
+import os
+import re
+import sqlite3
+import threading
+import hashlib
+import argparse
+import mne_bids
+
+ENTITIES = [('subject', 'sub'), ('session', 'ses'), ('task', 'task'), ('acquisition', 'acq'), ('run', 'run'),
+            ('processing', 'proc'), ('space', 'space'), ('recording', 'rec'), ('split', 'split'),
+            ('description', 'desc')]
+COLUMNS = [e for e, _ in ENTITIES] + ['suffix', 'extension', 'datatype']
+DATATYPES = ['anat', 'func', 'ieeg', 'eeg', 'meg', 'beh', 'fmap', 'dwi', 'perf', 'pet', 'nirs']
+IGNORE_DIRS = ['derivatives', 'sourcedata', 'code']
+
+
+def parse_fname(fname):
+    '''Entities, suffix and extension of a BIDS file name'''
+    abbr = dict((a, e) for e, a in ENTITIES)
+    base, dot, extension = fname.partition('.')
+    parts = base.split('_')
+    parsed = dict.fromkeys(COLUMNS)
+    for part in parts:
+        key, dash, value = part.partition('-')
+        if dash and key in abbr:
+            parsed[abbr[key]] = value
+    if '-' not in parts[-1]:
+        parsed['suffix'] = parts[-1]
+    parsed['extension'] = dot + extension if dot else None
+    return parsed
+
+
+def get_entity_vals(path, entity_key, index=None):
+    '''mne_bids.get_entity_vals through index when given'''
+    if index is not None:
+        return index.get_entity_vals(path, entity_key)
+    return mne_bids.get_entity_vals(path, entity_key)
+
+
+class BIDSIndex(object):
+    '''All files of a BIDS tree with their entities, kept in SQLite. Directories are re-listed on refresh only if
+    their mtime changed, unchanged directories cost one stat'''
+    def __init__(self, root, db_path=None, refresh=True):
+        self.root = os.path.realpath(root)
+        if db_path is None:
+            cache = os.path.join(os.path.expanduser('~'), '.cache', 'ieeg_fmri_validation')
+            if not os.path.isdir(cache): os.makedirs(cache)
+            db_path = os.path.join(cache, 'bids_index_' + hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16] +
+                                   '.sqlite')
+        self.db_path = db_path
+        self._local = threading.local()
+        self._create()
+        if refresh:
+            self.refresh()
+
+    @property
+    def connection(self):
+        '''One connection per thread, sqlite3 connections cannot be shared between threads'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.db_path, timeout=60)
+        return connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _create(self):
+        with self.connection as c:
+            c.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER)')
+            c.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, ' +
+                      ', '.join(column + ' TEXT' for column in COLUMNS) + ')')
+            c.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            c.execute('CREATE INDEX IF NOT EXISTS files_subject ON files (subject)')
+            c.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+
+    def refresh(self):
+        '''Bring the index up to date with the file system, returns the number of re-listed directories'''
+        mtimes = dict(self.connection.execute('SELECT path, mtime FROM dirs'))
+        seen, changed = set(), 0
+        stack = [self.root]
+        with self.connection as c:
+            while stack:
+                path = stack.pop()
+                seen.add(path)
+                mtime = os.stat(path).st_mtime_ns
+                if mtimes.get(path) == mtime:
+                    stack.extend(p for p, in c.execute('SELECT path FROM dirs WHERE parent = ?', (path,)))
+                    continue
+                changed += 1
+                subdirs = self._list(c, path)
+                c.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, os.path.dirname(path), mtime))
+                for subdir in subdirs:
+                    c.execute('INSERT OR IGNORE INTO dirs VALUES (?, ?, ?)', (subdir, path, None))
+                stack.extend(subdirs)
+            for path in set(mtimes) - seen:
+                c.execute('DELETE FROM dirs WHERE path = ?', (path,))
+                c.execute('DELETE FROM files WHERE dir = ?', (path,))
+        return changed
+
+    def _list(self, c, path):
+        c.execute('DELETE FROM files WHERE dir = ?', (path,))
+        c.execute('DELETE FROM dirs WHERE parent = ?', (path,))
+        datatype = os.path.basename(path) if os.path.basename(path) in DATATYPES else None
+        subdirs, rows = [], []
+        for entry in os.scandir(path):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                if not (path == self.root and entry.name in IGNORE_DIRS):
+                    subdirs.append(entry.path)
+            else:
+                parsed = parse_fname(entry.name)
+                parsed['datatype'] = datatype
+                rows.append([entry.path, path] + [parsed[column] for column in COLUMNS])
+        c.executemany('INSERT OR REPLACE INTO files VALUES (' + ', '.join(['?'] * (len(COLUMNS) + 2)) + ')', rows)
+        return subdirs
+
+    def find(self, root=None, **entities):
+        '''Rows (dicts with path and all entities) of files under root matching entities, sorted by path.
+        Extensions may be given with or without the leading dot'''
+        where, values = ['(path LIKE ? ESCAPE \'\\\')'], [self._prefix(root)]
+        for key, value in entities.items():
+            if value is None:
+                continue
+            if key == 'extension' and not value.startswith('.'):
+                value = '.' + value
+            where.append(key + ' = ?')
+            values.append(str(value))
+        rows = self.connection.execute('SELECT path, ' + ', '.join(COLUMNS) + ' FROM files WHERE ' +
+                                       ' AND '.join(where) + ' ORDER BY path', values)
+        return [dict(zip(['path'] + COLUMNS, row)) for row in rows]
+
+    def match(self, root=None, **entities):
+        return [row['path'] for row in self.find(root, **entities)]
+
+    def get_entity_vals(self, path, entity_key):
+        '''Sorted unique values of entity_key in files under path, as mne_bids.get_entity_vals'''
+        assert entity_key in COLUMNS, 'Unknown entity ' + entity_key
+        rows = self.connection.execute('SELECT DISTINCT ' + entity_key + ' FROM files WHERE path LIKE ? ESCAPE \'\\\' '
+                                       'AND ' + entity_key + ' IS NOT NULL', (self._prefix(path),))
+        return sorted(value for value, in rows)
+
+    def _prefix(self, path):
+        path = self.root if path is None else os.path.realpath(path)
+        return re.sub(r'([\\%_])', r'\\\1', path.rstrip(os.sep) + os.sep) + '%'
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bids_dir', '-i', type=str)
+    parser.add_argument('--db', type=str, default=None)
+    args = parser.parse_args()
+
+    index = BIDSIndex(args.bids_dir, args.db, refresh=False)
+    print('Re-listed ' + str(index.refresh()) + ' directories')
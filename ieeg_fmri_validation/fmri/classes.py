@@ -1,13 +1,128 @@
-
-import re
-import warnings
 import os
+import copy as _copy
+import warnings
+
+from functools import lru_cache
+
+
+class FSFDocument(object):
+    '''Parsed .fsf: a sequence of entries, each the lines preceding a set line (blank lines and comment headers)
+    plus the set key and value, indexed by key. Values are kept as written, quotes included. Unmodified lines are
+    rendered exactly as read'''
+    def __init__(self, text=''):
+        self.entries = []
+        self.index = {}
+        self.tail = []
+        if text:
+            self.parse(text)
+
+    def parse(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        self.entries, self.index = [], {}
+        before = []
+        for line in text.split('\n'):
+            parts = line.strip().split(None, 2)
+            if len(parts) >= 2 and parts[0] == 'set':
+                self._append(_Entry(before, parts[1], parts[2] if len(parts) == 3 else '', line))
+                before = []
+            else:
+                before.append(line)
+        self.tail = before
+
+    def _append(self, entry):
+        self.entries.append(entry)
+        self.index[entry.key] = entry
+
+    def render(self):
+        lines = []
+        for entry in self.entries:
+            lines.extend(entry.before)
+            lines.append(entry.line())
+        return '\n'.join(lines + self.tail)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        return self.index[key].value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def header(self, key):
+        '''Last comment line before the set line of key'''
+        comments = [line for line in self.index[key].before if line.startswith('#')]
+        return comments[-1] if comments else None
+
+    def set(self, key, value, header=None):
+        '''Update key in place, or append it at the end under header'''
+        if key in self.index:
+            self.index[key].set(value)
+        else:
+            self._append(_Entry(['', header] if header else [''], key, value))
 
-from collections import OrderedDict
+    def set_series(self, key, header, values):
+        '''Entries key.format(i) with comment header.format(i) for i = 1..len(values), as FEAT numbers inputs:
+        existing ones are updated in place, missing ones inserted in one pass after the last existing one and
+        any beyond len(values) removed'''
+        n_existing = 0
+        while key.format(n_existing + 1) in self.index:
+            n_existing += 1
+        for i, value in enumerate(values[:n_existing]):
+            self.index[key.format(i + 1)].set(value)
+        if len(values) < n_existing:
+            removed = set(id(self.index.pop(key.format(i + 1))) for i in range(len(values), n_existing))
+            self.entries = [entry for entry in self.entries if id(entry) not in removed]
+        elif len(values) > n_existing:
+            new = [_Entry(['', header.format(i + 1)], key.format(i + 1), values[i])
+                   for i in range(n_existing, len(values))]
+            position = self.entries.index(self.index[key.format(n_existing)]) + 1 if n_existing else \
+                len(self.entries)
+            self.entries[position:position] = new
+            self.index.update((entry.key, entry) for entry in new)
 
+    def copy(self):
+        document = _copy.copy(self)
+        document.entries = [entry.copy() for entry in self.entries]
+        document.index = dict((entry.key, entry) for entry in document.entries)
+        document.tail = list(self.tail)
+        return document
 
-class FSL_template(OrderedDict):
+
+class _Entry(object):
+    __slots__ = ['before', 'key', 'value', 'raw']
+
+    def __init__(self, before, key, value, raw=None):
+        self.before = before
+        self.key = key
+        self.value = value
+        self.raw = raw
+
+    def set(self, value):
+        if value != self.value:
+            self.value = value
+            self.raw = None
+
+    def line(self):
+        return self.raw if self.raw is not None else 'set ' + self.key + ' ' + self.value
+
+    def copy(self):
+        return _Entry(list(self.before), self.key, self.value, self.raw)
+
+
+@lru_cache(maxsize=None)
+def _read_template(template, mtime):
+    with open(template, 'rb') as infile:
+        return FSFDocument(infile.read())
+
+
+class FSL_template(FSFDocument):
+    '''FEAT design from the template of analysis ('first_level' or 'second_level'). The template is parsed once
+    per process, every FSL_template and copy() starts from that parse, so many designs (per subject, per
+    contrast) can be generated without re-reading it'''
     def __init__(self, analysis):
+        super(FSL_template, self).__init__()
         self.analysis = analysis
         self.template = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                                     'fsl', 'template_' + self.analysis +'.fsf')
@@ -16,97 +131,45 @@ class FSL_template(OrderedDict):
 
     def read(self, template):
         self.template = template
-        with open(self.template, 'rb') as infile:
-            data = infile.read()
-        self.parse(data)
+        parsed = _read_template(template, os.path.getmtime(template))
+        self.entries = [entry.copy() for entry in parsed.entries]
+        self.index = dict((entry.key, entry) for entry in self.entries)
+        self.tail = list(parsed.tail)
 
-    def parse(self, data):
-        coding = 'utf-8'
-        buff = [s.strip() for s in data.decode(coding).split('\n')]
-        self.data = buff
+    @property
+    def data(self):
+        return self.render().split('\n')
 
     def set_EV_values(self):
         assert self.analysis == 'second_level', 'EV values are only used in second_level analysis'
-        grab_n_inputs = lambda s: re.match('# Higher-level EV value for EV 1 and input \d+$', s)
-        temp = [grab_n_inputs(s) for s in self.data if grab_n_inputs(s) != None]
-        last_index = -1
-        for i in range(self.n_inputs):
-            if i < len(temp):
-                self.data[self.data.index(temp[i].string) + 1] = 'set fmri(evg' + str(i + 1) + '.1) 1.0'
-                last_index = self.data.index(temp[i].string) + 1
-            else:
-                self.data.insert(last_index + 2, '# Higher-level EV value for EV 1 and input ' + str(i + 1))
-                self.data.insert(last_index + 3, 'set fmri(evg' + str(i + 1) + '.1) 1.0')
-                self.data.insert(last_index + 4, '')
-                last_index = last_index + 3
+        self.set_series('fmri(evg{}.1)', '# Higher-level EV value for EV 1 and input {}', ['1.0'] * self.n_inputs)
 
     def set_group_membership(self):
         assert self.analysis == 'second_level', 'Group membership is only used in second_level analysis'
-        grab_n_inputs = lambda s: re.match('# Group membership for input \d+$', s)
-        temp = [grab_n_inputs(s) for s in self.data if grab_n_inputs(s) != None]
-        last_index = -1
-        for i in range(self.n_inputs):
-            if i < len(temp):
-                self.data[self.data.index(temp[i].string) + 1] = 'set fmri(groupmem.' + str(i + 1) + ') 1'
-                last_index = self.data.index(temp[i].string) + 1
-            else:
-                self.data.insert(last_index + 2, '# Group membership for input ' + str(i + 1))
-                self.data.insert(last_index + 3, 'set fmri(groupmem.' + str(i + 1) + ') 1')
-                self.data.insert(last_index + 4, '')
-                last_index = last_index + 3
+        self.set_series('fmri(groupmem.{})', '# Group membership for input {}', ['1'] * self.n_inputs)
 
     def set_output_directory(self, output_directory):
         # output directory
-        self.data[self.data.index('# Output directory')+1] = 'set fmri(outputdir) ' + '"' + output_directory + '"'
+        self.set('fmri(outputdir)', '"' + output_directory + '"')
 
     def set_4D_data(self, inputs_4D):
-        grab_n_inputs = lambda s: re.match('# 4D AVW data or FEAT directory \(\d+\)$', s)
-        temp = [grab_n_inputs(s) for s in self.data if grab_n_inputs(s) != None]
         self.n_inputs = len(inputs_4D)
-        last_index = -1
-        for i in range(len(inputs_4D)):
-            if i < len(temp):
-                if self.analysis == 'first_level':
-                    self.data[self.data.index(temp[i].string) + 1] = 'set feat_files(' + str(i+1) + \
-                                                                     ') ' + '"' + inputs_4D[i] + '"'
-                elif self.analysis == 'second_level':
-                    self.data[self.data.index(temp[i].string) + 1] = 'set feat_files(' + str(i + 1) + \
-                                                                     ') ' + '"' + inputs_4D[i] + '.feat"'
-                else:
-                    warnings.warn('Should be first_level or second_level analysis')
-                last_index = self.data.index(temp[i].string) + 1
-            else:
-                self.data.insert(last_index + 2, '# 4D AVW data or FEAT directory (' + str(i+1) + ')')
-                if self.analysis == 'first_level':
-                    self.data.insert(last_index + 3, 'set feat_files(' + str(i+1) + ') ' + '"' + inputs_4D[i] + '"')
-                elif self.analysis == 'second_level':
-                    self.data.insert(last_index + 3, 'set feat_files(' + str(i + 1) + ') ' + '"' +
-                                                                                                inputs_4D[i] + '.feat"')
-                else:
-                    warnings.warn('Should be first_level or second_level analysis')
-                self.data.insert(last_index + 4, '')
-                last_index = last_index + 3
-        self.data[self.data.index('# Number of first-level analyses') + 1] = 'set fmri(multiple) ' + str(len(inputs_4D))
-
+        if self.analysis == 'first_level':
+            values = ['"' + s + '"' for s in inputs_4D]
+        elif self.analysis == 'second_level':
+            values = ['"' + s + '.feat"' for s in inputs_4D]
+        else:
+            warnings.warn('Should be first_level or second_level analysis')
+            return
+        self.set_series('feat_files({})', '# 4D AVW data or FEAT directory ({})', values)
+        self.set('fmri(multiple)', str(len(inputs_4D)))
 
     def set_structural_images(self, structural_images):
         assert self.analysis == 'first_level', 'Structural images are only used in first_level analysis'
-        grab_n_inputs = lambda s: re.match('# Subject\'s structural image for analysis \d+$', s)
-        temp = [grab_n_inputs(s) for s in self.data if grab_n_inputs(s) != None]
-        last_index = -1
-        for i in range(len(structural_images)):
-            if i < len(temp):
-                self.data[self.data.index(temp[i].string) + 1] = 'set highres_files(' + str(i+1) + ') ' + \
-                                                                                    '"' + structural_images[i] + '"'
-                last_index = self.data.index(temp[i].string) + 1
-            else:
-                self.data.insert(last_index + 2, '# Subject\'s structural image for analysis ' + str(i+1))
-                self.data.insert(last_index + 3, 'set highres_files(' + str(i+1) + ') ' +
-                                                                                    '"' + structural_images[i] + '"')
-                self.data.insert(last_index + 4, '')
-                last_index = last_index + 3
+        self.set_series('highres_files({})', '# Subject\'s structural image for analysis {}',
+                        ['"' + s + '"' for s in structural_images])
 
     def write(self, filename):
         self.filename = filename
         with open(self.filename, 'w') as outfile:
-            outfile.write('\n'.join(self.data))
\ No newline at end of file
+            outfile.write(self.render())
@@ -0,0 +1,74 @@
+import os
+import numpy as np
+
+from scipy import stats
+
+
+class GroupStack(object):
+    '''Subject maps in a disk-backed subjects x voxels .npy memmap, filled as they are produced and reduced in voxel
+    blocks, so memory does not grow with the number of subjects'''
+    def __init__(self, path, n_subjects, n_voxels, dtype=np.float64):
+        self.path = path
+        self.data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_subjects, n_voxels))
+        self.n = 0
+
+    @classmethod
+    def open(cls, path):
+        '''Reopen a filled stack'''
+        stack = cls.__new__(cls)
+        stack.path = path
+        stack.data = np.load(path, mmap_mode='r')
+        stack.n = stack.data.shape[0]
+        return stack
+
+    def append(self, y):
+        self.data[self.n] = np.ravel(y)
+        self.n += 1
+
+    def flush(self):
+        if hasattr(self.data, 'flush'):
+            self.data.flush()
+
+    def reduce(self, func, block=65536):
+        '''func(subjects x block voxels) -> block voxels, applied block by block'''
+        n_voxels = self.data.shape[1]
+        out = np.empty(n_voxels)
+        for start in range(0, n_voxels, block):
+            out[start:start + block] = func(np.asarray(self.data[:self.n, start:start + block]))
+        return out
+
+    def median(self, block=65536):
+        return self.reduce(lambda x: np.median(x, 0), block)
+
+    def mean(self, block=65536):
+        return self.reduce(lambda x: np.mean(x, 0), block)
+
+    def percentile(self, q, block=65536):
+        return self.reduce(lambda x: np.percentile(x, q, 0), block)
+
+    def tmap(self, popmean=0, block=65536):
+        '''One-sample t against popmean, 0 where subjects do not vary'''
+        def t(x):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.nan_to_num(stats.ttest_1samp(x, popmean, 0).statistic, nan=0, posinf=0, neginf=0)
+        return self.reduce(t, block)
+
+    def summary(self, percentiles=(25, 75), block=65536):
+        '''median, mean, percentiles and one-sample t map in a single pass over the stack'''
+        n_voxels = self.data.shape[1]
+        out = dict((key, np.empty(n_voxels)) for key in ['median', 'mean', 't'] +
+                   ['p' + str(q) for q in percentiles])
+        for start in range(0, n_voxels, block):
+            x = np.asarray(self.data[:self.n, start:start + block])
+            out['median'][start:start + block] = np.median(x, 0)
+            out['mean'][start:start + block] = np.mean(x, 0)
+            for q, p in zip(percentiles, np.percentile(x, percentiles, 0).reshape(len(percentiles), -1)):
+                out['p' + str(q)][start:start + block] = p
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out['t'][start:start + block] = np.nan_to_num(stats.ttest_1samp(x, 0, 0).statistic,
+                                                              nan=0, posinf=0, neginf=0)
+        return out
+
+    def remove(self):
+        del self.data
+        os.remove(self.path)
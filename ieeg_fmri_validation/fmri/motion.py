@@ -8,8 +8,79 @@ import argparse
 import os
 import numpy as np
 import re
+import nibabel
+
+from concurrent.futures import ProcessPoolExecutor
 
 from ieeg_fmri_validation.utils import sort_nicely
+from ieeg_fmri_validation import instrument
+
+
+def read_motion_parameters(subject_directory):
+    '''MCFLIRT parameters of the FEAT run, volumes x (rx, ry, rz in radians, tx, ty, tz in mm)'''
+    return np.loadtxt(os.path.join(subject_directory, 'mc', 'prefiltered_func_data_mcf.par'), ndmin=2)
+
+
+def framewise_displacement(par, radius=50):
+    '''Power et al. FD as fsl_motion_outliers --fd: sum of absolute backward differences of translations and of
+    rotations as arc length on a sphere of radius mm, 0 for the first volume'''
+    diff = np.abs(np.diff(par, axis=0))
+    return np.concatenate([[0.], radius * diff[:, :3].sum(1) + diff[:, 3:].sum(1)])
+
+
+def dvars(img, mask=None, scale=1000):
+    '''RMS over mask voxels of the intensity change between consecutive volumes, with intensities normalized to
+    a grand mean of scale within the mask (fslmaths -ing), 0 for the first volume. Volumes are read from dataobj one
+    at a time, keeping only the previous one. Without mask, voxels above 10% of the robust maximum (98th
+    percentile) of the first volume are used'''
+    n_vols = img.shape[-1]
+    previous = np.asarray(img.dataobj[..., 0], dtype=np.float64)
+    if mask is None:
+        mask = previous > 0.1 * np.percentile(previous, 98)
+    mask = np.asarray(mask, dtype=bool).reshape(previous.shape)
+    previous = previous[mask]
+    total = previous.sum()
+    metric = np.zeros(n_vols)
+    for t in range(1, n_vols):
+        current = np.asarray(img.dataobj[..., t], dtype=np.float64)[mask]
+        metric[t] = np.sqrt(np.mean((current - previous) ** 2))
+        total += current.sum()
+        previous = current
+    return metric * scale / (total / (n_vols * previous.size))
+
+
+def boxplot_threshold(metric):
+    '''75th percentile + 1.5 IQR, the default cutoff of fsl_motion_outliers'''
+    p25, p75 = np.percentile(metric, [25, 75])
+    return p75 + 1.5 * (p75 - p25)
+
+
+def outlier_matrix(metric, thresh=None):
+    '''Confound matrix volumes x outliers with a single 1 per column at every volume where metric exceeds thresh,
+    as fsl_motion_outliers -o'''
+    thresh = boxplot_threshold(metric) if thresh is None else thresh
+    outliers = np.flatnonzero(metric > thresh)
+    matrix = np.zeros((len(metric), len(outliers)), dtype=int)
+    matrix[outliers, np.arange(len(outliers))] = 1
+    return matrix
+
+
+def motion_qc(subject_directory, subject_4D, type_outliers='fd', mask=None):
+    '''In-process fsl_motion_outliers: FD from the FEAT motion parameters, DVARS (type_outliers='dvar') from
+    subject_4D without motion correction, inside mask or the FEAT brain mask when it exists. Returns the FD metric
+    and the outlier matrix of type_outliers'''
+    subject = os.path.basename(subject_directory.rstrip(os.sep)).split('sub-')[1].split('_')[0]
+    with instrument.span('motion_qc', subject=subject, type_outliers=type_outliers):
+        return _motion_qc(subject_directory, subject_4D, type_outliers, mask)
+
+
+def _motion_qc(subject_directory, subject_4D, type_outliers='fd', mask=None):
+    fd = framewise_displacement(read_motion_parameters(subject_directory))
+    if type_outliers == 'fd':
+        return fd, outlier_matrix(fd)
+    if mask is None and os.path.isfile(os.path.join(subject_directory, 'mask.nii.gz')):
+        mask = nibabel.load(os.path.join(subject_directory, 'mask.nii.gz')).get_fdata() > 0
+    return fd, outlier_matrix(dvars(nibabel.load(subject_4D), mask))
 
 
 def calculate_fd(subject_directory, subject_4D):
@@ -28,7 +99,9 @@ def calculate_dvar(subject_directory, subject_4D):
                      '-s', os.path.join(subject_directory, 'DVAR'), '--dvars', '--nomoco'])
     print(rc)
 
-def find_outliers(output_directory, type_outliers='fd'):
+@instrument.instrumented()
+def find_outliers(output_directory, type_outliers='fd', engine='native', jobs=-1):
+    '''FD (and DVARS) outliers of every subject in output_directory, computed on jobs processes (-1: all cores)'''
     subjects = []
     for f in glob.glob(output_directory + 'sub-*.feat/'):
         subjects.append(f.split('sub-')[1].split('_')[0])
@@ -36,24 +109,36 @@ def find_outliers(output_directory, type_outliers='fd'):
     sort_nicely(subjects)
     print('Found ' + str(len(subjects)) + ' subjects')
 
-    fds, outliers = [], []
-    for i, subject in enumerate(subjects):
-        print(i, subject)
+    runs = []
+    for subject in subjects:
         assert len(glob.glob(output_directory + '/sub-' + subject + '*_bold.nii.gz')) == 1, 'More than one func 4D file'
         subject_4D = glob.glob(output_directory + '/sub-' + subject + '*_bold.nii.gz')[0]
         assert len(glob.glob(output_directory + '/sub-' + subject + '*.feat')) == 1, 'More than one subject directory'
         subject_directory = glob.glob(output_directory + '/sub-' + subject + '*.feat')[0]
-        subprocess.check_call(['cd', subject_directory], shell=True)
-        if not os.path.isfile(os.path.join(subject_directory, 'FD')) or \
-                not os.path.isfile(os.path.join(subject_directory, 'mc', type_outliers+'_outliers')):
-            calculate_fd(subject_directory, subject_4D)
-        if type_outliers == 'dvar' and (not os.path.isfile(os.path.join(subject_directory, 'DVAR')) or
-                not os.path.isfile(os.path.join(subject_directory, 'mc', type_outliers+'_outliers'))):
-            calculate_dvar(subject_directory, subject_4D)
-        fd_file = os.path.join(subject_directory, 'FD')
-        print(fd_file)
-        fds.append(np.loadtxt(fd_file))
-        temp = np.loadtxt(os.path.join(subject_directory, 'mc', type_outliers+'_outliers'))
+        runs.append((subject_directory, subject_4D))
+
+    if engine == 'native':
+        with ProcessPoolExecutor(max_workers=os.cpu_count() if jobs == -1 else jobs) as executor:
+            results = list(executor.map(motion_qc, *zip(*runs), [type_outliers] * len(runs)))
+    else:
+        results = [None] * len(runs)
+
+    fds, outliers = [], []
+    for i, (subject, (subject_directory, subject_4D), result) in enumerate(zip(subjects, runs, results)):
+        print(i, subject)
+        if result is None:
+            subprocess.check_call(['cd', subject_directory], shell=True)
+            if not os.path.isfile(os.path.join(subject_directory, 'FD')) or \
+                    not os.path.isfile(os.path.join(subject_directory, 'mc', type_outliers+'_outliers')):
+                calculate_fd(subject_directory, subject_4D)
+            if type_outliers == 'dvar' and (not os.path.isfile(os.path.join(subject_directory, 'DVAR')) or
+                    not os.path.isfile(os.path.join(subject_directory, 'mc', type_outliers+'_outliers'))):
+                calculate_dvar(subject_directory, subject_4D)
+            fd_file = os.path.join(subject_directory, 'FD')
+            print(fd_file)
+            result = np.loadtxt(fd_file), np.loadtxt(os.path.join(subject_directory, 'mc', type_outliers+'_outliers'))
+        fds.append(result[0])
+        temp = result[1].reshape(len(result[0]), -1)
         print('FD outliers: ' + str(np.sum(np.sum(temp, 1) > 0)) + '/' + str(temp.shape[0]))
         print('It is ' + str(np.sum(np.sum(temp, 1) > 0) / temp.shape[0]*100) + '%')
         outliers.append(np.sum(np.sum(temp, 1) > 0))
@@ -64,6 +149,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--output_directory', '-o', type=str)
     parser.add_argument('--type_outliers', '-t', type=str, default='fd', choices=['dvar', 'fd'])
+    parser.add_argument('--engine', type=str, default='native', choices=['native', 'fsl'])
+    parser.add_argument('--jobs', '-j', type=int, default=-1, help='processes, -1 for all cores')
     args = parser.parse_args()
 
-    find_outliers(args.output_directory, args.type_outliers)
+    find_outliers(args.output_directory, args.type_outliers, args.engine, args.jobs)
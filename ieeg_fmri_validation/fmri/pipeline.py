@@ -0,0 +1,301 @@
+'''
+Dependency-aware parallel runner for the FSL pipeline: per-subject bet, fast, first-level FEAT, grey matter mask,
+motion outliers and tSNR on a process pool, second-level FEAT and the group tSNR once all subjects are done.
+Tasks whose inputs, outputs and command are unchanged since they last ran are skipped, as in make.
+Every external command (bet, fast, feat, applywarp, fslmaths, nii2mgh) can be replaced by a stub,
+e.g. --tool feat=/path/to/fake_feat
+
+python -m ieeg_fmri_validation.fmri.pipeline
+    -i bids_dir
+    -o output_dir/
+    --jobs 8
+    [--use_grey_mask] [--force] [--dry_run] [--tool name=command]
+'''
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import traceback
+import subprocess
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ieeg_fmri_validation.utils import sort_nicely
+from ieeg_fmri_validation.fmri.classes import FSL_template
+from ieeg_fmri_validation.fmri.motion import motion_qc
+from ieeg_fmri_validation.fmri.tsnr import subject_tsnr, median_tsnr_mni
+from ieeg_fmri_validation.fmri.routines import make_grey_matter_mask, TOOLS as ROUTINE_TOOLS
+from ieeg_fmri_validation.fmri.staging import stage, METHODS
+
+TOOLS = dict(ROUTINE_TOOLS, bet='bet', fast='fast', feat='feat')
+
+
+class Task(object):
+    '''func(*args) producing outputs from inputs, run after the tasks named in deps'''
+    def __init__(self, name, func, args=(), inputs=(), outputs=(), deps=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+
+    def signature(self):
+        return hashlib.sha1(json.dumps([self.func.__module__ + '.' + self.func.__name__, self.args],
+                                       default=str).encode('utf-8')).hexdigest()
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _run_task(func, args):
+    try:
+        func(*args)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+class Pipeline(object):
+    '''DAG of Tasks. On success, the signature of a task and the size and mtime of its inputs and outputs are
+    recorded in state_dir. A task is up to date while all of them are unchanged, so it reruns when an upstream
+    task rewrote one of its inputs or its outputs were modified'''
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.tasks = {}
+
+    def add(self, task):
+        assert task.name not in self.tasks, 'Duplicate task ' + task.name
+        self.tasks[task.name] = task
+        return task
+
+    def _state_file(self, task):
+        return os.path.join(self.state_dir, task.name.replace(os.sep, '_') + '.json')
+
+    def up_to_date(self, task):
+        if not task.outputs or not all(os.path.exists(f) for f in task.outputs + task.inputs):
+            return False
+        if not os.path.isfile(self._state_file(task)):
+            return False
+        with open(self._state_file(task)) as f:
+            state = json.load(f)
+        return state == self._state(task)
+
+    def _state(self, task):
+        return {'signature': task.signature(), 'inputs': [_stamp(f) for f in task.inputs],
+                'outputs': [_stamp(f) for f in task.outputs]}
+
+    def _done(self, task):
+        if not os.path.isdir(self.state_dir): os.makedirs(self.state_dir)
+        with open(self._state_file(task), 'w') as f:
+            json.dump(self._state(task), f)
+
+    def order(self):
+        '''Task names in a topological order'''
+        for task in self.tasks.values():
+            for dep in task.deps:
+                assert dep in self.tasks, task.name + ' depends on unknown task ' + dep
+        order, state = [], {}
+
+        def visit(name):
+            if state.get(name) == 'done':
+                return
+            assert state.get(name) != 'visiting', 'Cycle through ' + name
+            state[name] = 'visiting'
+            for dep in self.tasks[name].deps:
+                visit(dep)
+            state[name] = 'done'
+            order.append(name)
+        for name in self.tasks:
+            visit(name)
+        return order
+
+    def run(self, jobs=1, force=False, dry_run=False):
+        '''Run all tasks that are not up to date, up to jobs at a time. A failed task skips everything downstream
+        of it. Returns a dict name -> 'ran', 'current', 'failed' or 'skipped' ('would run' with dry_run)'''
+        order = self.order()
+        status = {}
+        waiting = list(order)
+        pending = {}
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while waiting or pending:
+                for name in list(waiting):
+                    task = self.tasks[name]
+                    if any(status.get(dep) in ('failed', 'skipped') for dep in task.deps):
+                        status[name] = 'skipped'
+                    elif all(status.get(dep) in ('ran', 'current', 'would run') for dep in task.deps):
+                        if dry_run and 'would run' in [status[dep] for dep in task.deps]:
+                            status[name] = 'would run'
+                        elif not force and self.up_to_date(task):
+                            status[name] = 'current'
+                        elif dry_run:
+                            status[name] = 'would run'
+                        else:
+                            print('Running ' + name)
+                            pending[executor.submit(_run_task, task.func, task.args)] = name
+                            status[name] = 'running'
+                    else:
+                        continue
+                    waiting.remove(name)
+                if not pending:
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    error = future.result()
+                    missing = [f for f in self.tasks[name].outputs if not os.path.exists(f)]
+                    if error is None and missing:
+                        error = 'Outputs not written: ' + ', '.join(missing) + '\n'
+                    if error is None:
+                        self._done(self.tasks[name])
+                        status[name] = 'ran'
+                    else:
+                        status[name] = 'failed'
+                        print('Failed ' + name + ':\n' + error)
+        for state in ['ran', 'current', 'would run', 'failed', 'skipped']:
+            names = [name for name in order if status[name] == state]
+            if names:
+                print(state + ': ' + str(len(names)) + ' tasks')
+        return status
+
+
+## FSL pipeline tasks
+def stage_inputs(pairs, methods=METHODS):
+    stage(pairs, methods, verbose=False)
+
+
+def run_bet(tools, t1w, t1w_brain):
+    subprocess.check_call([tools['bet'], t1w, t1w_brain, '-R', '-f', '.2', '-g', '0'])
+
+
+def run_fast(tools, t1w_brain):
+    subprocess.check_call([tools['fast'], '-t', '1', '-n', '3', '-o', t1w_brain, t1w_brain])
+
+
+def run_first_level(tools, fsf_file, func_input, struct_input, feat_dir):
+    if os.path.isdir(feat_dir):  # feat would write to feat_dir+ instead
+        shutil.rmtree(feat_dir)
+    fsf = FSL_template(analysis='first_level')
+    fsf.set_4D_data([func_input])
+    fsf.set_structural_images([struct_input])
+    fsf.write(fsf_file)
+    subprocess.check_call([tools['feat'], fsf_file])
+
+
+def run_second_level(tools, fsf_file, output_dir, func_inputs, gfeat_dir):
+    if os.path.isdir(gfeat_dir):
+        shutil.rmtree(gfeat_dir)
+    fsf = FSL_template(analysis='second_level')
+    fsf.set_output_directory(output_dir)
+    fsf.set_4D_data(func_inputs)
+    fsf.set_EV_values()
+    fsf.set_group_membership()
+    fsf.write(fsf_file)
+    subprocess.check_call([tools['feat'], fsf_file])
+
+
+def run_motion(feat_dir, func_4D):
+    fd, outliers = motion_qc(feat_dir, func_4D, 'fd')
+    np.savetxt(os.path.join(feat_dir, 'FD'), fd)
+    np.savetxt(os.path.join(feat_dir, 'mc', 'fd_outliers'), outliers, '%1d')
+
+
+def run_grey_mask(tools, feat_dir, pve1):
+    make_grey_matter_mask(feat_dir, pve1, tools=tools)
+
+
+def run_subject_tsnr(tools, output_dir, subject, use_grey_mask, grey_mask):
+    subject_tsnr(output_dir, subject, use_grey_mask=use_grey_mask, grey_mask=grey_mask, tools=tools)
+
+
+def run_tsnr_median(tools, output_dir, tsnrs, use_grey_mask):
+    median_tsnr_mni(output_dir, tsnrs, use_grey_mask, tools)
+
+
+def fsl_pipeline(bids_dir, output_dir, tools=None, use_grey_mask=False, methods=METHODS):
+    '''Pipeline of make_fsf_script and the fmri quality metrics, one chain of tasks per subject'''
+    tools = dict(TOOLS, **(tools or {}))
+    if not os.path.isdir(output_dir): os.makedirs(output_dir)
+    pipeline = Pipeline(os.path.join(output_dir, '.pipeline'))
+    grey_mask_tag = '_grey_mask' if use_grey_mask else ''
+
+    func_files = glob.glob(os.path.join(bids_dir, '**/ses-mri3t/func/*.nii.gz'))
+    sort_nicely(func_files)
+    first_levels, tsnrs, func_inputs = [], [], []
+    for file in func_files:
+        file_anat = glob.glob(os.path.join(file.split('func')[0], 'anat', '*.nii.gz'))[0]
+        func = os.path.join(output_dir, os.path.split(file)[-1])
+        t1w = os.path.join(output_dir, os.path.split(file_anat)[-1])
+        t1w_brain = t1w.replace('T1w', 'T1w_brain')
+        func_input = func[:-len('.nii.gz')]
+        feat_dir = func_input + '.feat'
+        subject = os.path.basename(func).split('sub-')[1].split('_')[0]
+        func_inputs.append(func_input)
+
+        pipeline.add(Task('stage/' + subject, stage_inputs, [((file, func), (file_anat, t1w)), tuple(methods)],
+                          inputs=[file, file_anat], outputs=[func, t1w]))
+        pipeline.add(Task('bet/' + subject, run_bet, [tools, t1w, t1w_brain], inputs=[t1w], outputs=[t1w_brain],
+                          deps=['stage/' + subject]))
+        pipeline.add(Task('first_level/' + subject, run_first_level,
+                          [tools, os.path.join(output_dir, 'fsl_first_level_sub-' + subject + '.fsf'), func_input,
+                           t1w_brain[:-len('.nii.gz')], feat_dir],
+                          inputs=[func, t1w_brain],
+                          outputs=[os.path.join(feat_dir, 'filtered_func_data.nii.gz'),
+                                   os.path.join(feat_dir, 'mc', 'prefiltered_func_data_mcf.par')],
+                          deps=['bet/' + subject]))
+        pipeline.add(Task('motion/' + subject, run_motion, [feat_dir, func],
+                          inputs=[os.path.join(feat_dir, 'mc', 'prefiltered_func_data_mcf.par')],
+                          outputs=[os.path.join(feat_dir, 'FD'), os.path.join(feat_dir, 'mc', 'fd_outliers')],
+                          deps=['first_level/' + subject]))
+        tsnr_deps = ['first_level/' + subject]
+        tsnr_inputs = [os.path.join(feat_dir, 'filtered_func_data.nii.gz')]
+        grey_mask = None
+        if use_grey_mask:
+            pve1 = t1w_brain.replace('.nii.gz', '_pve_1.nii.gz')
+            pipeline.add(Task('fast/' + subject, run_fast, [tools, t1w_brain], inputs=[t1w_brain], outputs=[pve1],
+                              deps=['bet/' + subject]))
+            grey_mask = os.path.join(feat_dir, 'reg', 'grey_mask_func_space.nii.gz')
+            pipeline.add(Task('grey_mask/' + subject, run_grey_mask, [tools, feat_dir, pve1],
+                              inputs=[pve1, os.path.join(feat_dir, 'filtered_func_data.nii.gz')],
+                              outputs=[grey_mask], deps=['fast/' + subject, 'first_level/' + subject]))
+            tsnr_deps.append('grey_mask/' + subject)
+            tsnr_inputs.append(grey_mask)  # made once by grey_mask, read by tsnr
+        tsnr_mni = os.path.join(feat_dir, 'tsnr_mni' + grey_mask_tag + '.nii.gz')
+        pipeline.add(Task('tsnr/' + subject, run_subject_tsnr, [tools, output_dir, subject, use_grey_mask, grey_mask],
+                          inputs=tsnr_inputs, outputs=[tsnr_mni], deps=tsnr_deps))
+        first_levels.append('first_level/' + subject)
+        tsnrs.append(tsnr_mni)
+
+    pipeline.add(Task('second_level', run_second_level,
+                      [tools, os.path.join(output_dir, 'fsl_second_level.fsf'), output_dir, func_inputs,
+                       output_dir.rstrip(os.sep) + '.gfeat'],
+                      inputs=[os.path.join(f + '.feat', 'filtered_func_data.nii.gz') for f in func_inputs],
+                      outputs=[output_dir.rstrip(os.sep) + '.gfeat'], deps=first_levels))
+    pipeline.add(Task('tsnr_median', run_tsnr_median, [tools, output_dir, tsnrs, use_grey_mask], inputs=tsnrs,
+                      outputs=[os.path.join(output_dir, 'tsnr_median_mni' + grey_mask_tag + '.nii')],
+                      deps=['tsnr/' + os.path.basename(f).split('sub-')[1].split('_')[0] for f in func_inputs]))
+    return pipeline
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bids_dir', '-i', type=str)
+    parser.add_argument('--output_dir', '-o', type=str)
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--use_grey_mask', action='store_true')
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--dry_run', action='store_true')
+    parser.add_argument('--stage', type=str, nargs='+', default=list(METHODS), choices=METHODS)
+    parser.add_argument('--tool', action='append', default=[], help='name=command, e.g. feat=/opt/stubs/feat')
+    args = parser.parse_args()
+
+    pipeline = fsl_pipeline(args.bids_dir, args.output_dir, dict(t.split('=', 1) for t in args.tool),
+                            args.use_grey_mask, args.stage)
+    pipeline.run(args.jobs, args.force, args.dry_run)
@@ -20,24 +20,28 @@ import os
 
 from ieeg_fmri_validation.utils import sort_nicely
 from ieeg_fmri_validation.fmri.classes import FSL_template
+from ieeg_fmri_validation.fmri.pipeline import fsl_pipeline
+from ieeg_fmri_validation.fmri.staging import stage, METHODS
 
 
-def make_fsf_script(bids_dir, output_dir, run=False):
+def make_fsf_script(bids_dir, output_dir, run=False, jobs=1, methods=METHODS):
 
     if not os.path.isdir(output_dir): os.makedirs(output_dir)
 
     # load functional and anatomical images
     func_inputs = []
     struct_inputs = []
+    pairs = []
     for file in glob.glob(os.path.join(bids_dir, '**/ses-mri3t/func/*.nii.gz')):
         destination = os.path.join(output_dir, os.path.split(file)[-1])
-        shutil.copyfile(file, destination)
+        pairs.append((file, destination))
         func_inputs.append(destination)
 
         file_anat = glob.glob(os.path.join(file.split('func')[0], 'anat', '*.nii.gz'))[0]
         destination_anat = os.path.join(output_dir, os.path.split(file_anat)[-1])
-        shutil.copyfile(file_anat, destination_anat)
+        pairs.append((file_anat, destination_anat))
         struct_inputs.append(destination_anat)
+    stage(pairs, methods)
 
     sort_nicely(func_inputs)
     print('Functional files: ' + str(len(func_inputs)))
@@ -58,7 +62,7 @@ def make_fsf_script(bids_dir, output_dir, run=False):
     filename_2nd = os.path.join(output_dir, 'fsl_second_level.fsf')
 
     # copy bet bash
-    shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bet_fsl_per_dir.sh'),
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bash', 'bet_fsl_per_dir.sh'),
                     os.path.join(output_dir, 'bet_fsl_per_dir.sh'))
 
     # update fsf templates
@@ -78,7 +82,10 @@ def make_fsf_script(bids_dir, output_dir, run=False):
     fsf.write(filename_2nd)
     print('FSL script writen to ' + filename_2nd)
 
-    if run:
+    if run and jobs > 1:
+        # per-subject first levels on a process pool, see fmri/pipeline.py
+        fsl_pipeline(bids_dir, output_dir, methods=methods).run(jobs)
+    elif run:
         rc = subprocess.check_call(['bash', os.path.join(output_dir, 'bet_fsl_per_dir.sh'), '-p', output_dir])
         print(rc)
         rc = subprocess.check_call('feat ' + filename_1st, shell=True)
@@ -93,7 +100,10 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', '-o', type=str)
     parser.add_argument('--run', dest='run', action='store_true')
     parser.add_argument('--no-run', dest='run', action='store_false')
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--stage', type=str, nargs='+', default=list(METHODS), choices=METHODS,
+                        help='staging methods to try in order, --stage copy to always copy')
     parser.set_defaults(run=False)
     args = parser.parse_args()
 
-    make_fsf_script(args.bids_directory, args.output_directory, args.run)
+    make_fsf_script(args.bids_dir, args.output_dir, args.run, args.jobs, args.stage)
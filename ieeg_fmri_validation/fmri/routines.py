@@ -2,39 +2,62 @@
 import os
 from subprocess import check_call
 
+from ieeg_fmri_validation.fmri.warp import apply_warp
 
+# external commands, replaceable by stubs through the tools argument; nii2mgh is a script run with bash
+TOOLS = {'applywarp': 'applywarp', 'fslmaths': 'fslmaths',
+         'nii2mgh': os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bash', 'zstat.nii2mgh.sh')}
 
-def nii2mgh(file):
-    rc = check_call(['bash', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bash', 'zstat.nii2mgh.sh'),
-                                                                                                            '-z', file])
+
+def _tools(tools):
+    return dict(TOOLS, **(tools or {}))
+
+
+def nii2mgh(file, tools=None):
+    rc = check_call(['bash', _tools(tools)['nii2mgh'], '-z', file])
     print(rc)
 
 
-def warp_native2_mni(file):
+def warp_native2_mni(file, engine='native', tools=None):
+    '''Warp a functional space map to standard space through FEAT reg/, in process (engine='native') or with
+    applywarp (engine='fsl'). Returns the warped file'''
     assert os.path.isfile(file), 'Not found ' + file
     subject_path = os.path.dirname(file)
-    rc = check_call(['applywarp',
+    out_file = file.replace('tsnr', 'tsnr_mni')
+    tools = _tools(tools)
+    if engine == 'native':
+        apply_warp(os.path.join(subject_path, 'reg', 'standard.nii.gz'), file, out_file,
+                   premat=os.path.join(subject_path, 'reg', 'example_func2highres.mat'),
+                   warp=os.path.join(subject_path, 'reg', 'highres2standard_warp.nii.gz'))
+        return out_file
+    rc = check_call([tools['applywarp'],
                 '--ref=' + os.path.join(subject_path, 'reg', 'standard.nii.gz'),
                 '--in=' + file,
                 '--warp=' + os.path.join(subject_path, 'reg', 'highres2standard_warp.nii.gz'),
                 '--premat=' + os.path.join(subject_path, 'reg', 'example_func2highres.mat'),
-                '--out=' + file.replace('tsnr', 'tsnr_mni')])
+                '--out=' + out_file])
     print(rc)
-    return file.replace('.', '_mni.')
+    return out_file
 
 
-def make_grey_matter_mask(subject_path, pve1):
+def make_grey_matter_mask(subject_path, pve1, engine='native', tools=None):
     assert os.path.isfile(pve1), 'Not found ' + pve1
     out_file = os.path.join(subject_path, 'reg', os.path.basename(pve1).replace('.nii', '_func_space.nii'))
-    rc = check_call(['applywarp',
+    mask_file = out_file.replace(os.path.basename(out_file), 'grey_mask_func_space.nii.gz')
+    if engine == 'native':
+        apply_warp(os.path.join(subject_path, 'reg', 'example_func.nii.gz'), pve1, mask_file,
+                   premat=os.path.join(subject_path, 'reg', 'highres2example_func.mat'), threshold=.2, binarize=True)
+        return mask_file
+    tools = _tools(tools)
+    rc = check_call([tools['applywarp'],
                 '--ref=' + os.path.join(subject_path, 'reg', 'example_func.nii.gz'),
                 '--in=' + pve1,
                 '--premat=' + os.path.join(subject_path, 'reg', 'highres2example_func.mat'),
                 '--out=' + out_file])
     print(rc)
-    rc = check_call(['fslmaths',
+    rc = check_call([tools['fslmaths'],
                      out_file,
                     '-thr', '.2',
-                    '-bin', out_file.replace(os.path.basename(out_file), 'grey_mask_func_space.nii.gz')])
+                    '-bin', mask_file])
     print(rc)
-    return out_file.replace(os.path.basename(out_file), 'grey_mask_func_space.nii.gz')
+    return mask_file
@@ -0,0 +1,91 @@
+'''
+Staging of input files into an analysis directory without copying where the file system allows it: reflink
+(copy-on-write clone), then hardlink, then symlink, then copy. A link aliases the dataset file, so any in-place write
+in the analysis directory would change the dataset: hardlinks and symlinks are only made to sources that cannot be
+written (e.g. a dataset made read-only with chmod -R a-w), writable sources are reflinked or copied. Files already
+staged are skipped
+'''
+
+import os
+import fcntl
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+FICLONE = 0x40049409
+METHODS = ('reflink', 'hardlink', 'symlink', 'copy')
+
+
+def is_staged(source, destination):
+    '''destination is source (same inode or a link to it) or has the same size and mtime'''
+    if not os.path.lexists(destination):
+        return False
+    if os.path.realpath(destination) == os.path.realpath(source):
+        return True
+    try:
+        s, d = os.stat(source), os.stat(destination)
+    except OSError:  # dangling symlink
+        return False
+    return (s.st_ino, s.st_dev) == (d.st_ino, d.st_dev) or \
+        (s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime))
+
+
+def _reflink(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
+
+
+def _copy(source, destination):
+    shutil.copy2(source, destination)
+
+
+def _symlink(source, destination):
+    os.symlink(os.path.realpath(source), destination)
+
+
+def _read_only(link):
+    '''link only sources that cannot be written, so that writes in the analysis directory cannot reach them'''
+    def stage_link(source, destination):
+        if os.access(source, os.W_OK):
+            raise PermissionError(source + ' is writable, not linked')
+        link(source, destination)
+    return stage_link
+
+
+_STAGE = {'reflink': _reflink, 'hardlink': _read_only(os.link), 'symlink': _read_only(_symlink), 'copy': _copy}
+
+
+def stage_file(source, destination, methods=METHODS):
+    '''Stage source at destination with the first method in methods that works. Returns the method used or
+    'skipped'. The file is created under a temporary name and renamed, so an interrupted run leaves no partial file'''
+    if is_staged(source, destination):
+        return 'skipped'
+    temp = os.path.join(os.path.dirname(destination), '.tmp.' + str(os.getpid()) + '.' + os.path.basename(destination))
+    for method in methods:
+        try:
+            _STAGE[method](source, temp)
+        except OSError:
+            if os.path.lexists(temp):
+                os.remove(temp)
+            continue
+        os.replace(temp, destination)
+        return method
+    raise OSError('Could not stage ' + source + ' to ' + destination)
+
+
+def stage(pairs, methods=METHODS, jobs=8, verbose=True):
+    '''Stage (source, destination) pairs on a thread pool. Returns {method: [n files, bytes]} and prints it'''
+    pairs = list(pairs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        used = list(executor.map(lambda p: stage_file(p[0], p[1], methods), pairs))
+    summary = dict((method, [0, 0]) for method in ('skipped',) + tuple(methods))
+    for (source, _), method in zip(pairs, used):
+        summary[method][0] += 1
+        summary[method][1] += os.path.getsize(source)
+    if verbose:
+        print('Staged ' + str(len(pairs)) + ' files: ' +
+              ', '.join(method + ' ' + str(n) + ' (' + str(round(size / 2 ** 20, 1)) + ' MB)'
+                        for method, (n, size) in summary.items() if n) +
+              '; ' + str(round(summary.get('copy', [0, 0])[1] / 2 ** 20, 1)) + ' MB copied')
+    return summary
@@ -7,8 +7,9 @@ import os
 import argparse
 
 from ieeg_fmri_validation.fmri.routines import make_grey_matter_mask, warp_native2_mni, nii2mgh
+from ieeg_fmri_validation.fmri.group import GroupStack
 from ieeg_fmri_validation.utils import sort_nicely
-from subprocess import check_call
+from ieeg_fmri_validation import instrument
 
 
 def math_tsnr(data):
@@ -19,13 +20,116 @@ def math_tsnr(data):
     return tsnr
 
 
+def stream_tsnr(img, mask=None, block=32, dtype=np.float64):
+    '''tSNR of a 4D image read through dataobj in blocks of volumes, which are contiguous on disk, so the gzip
+    stream is read once and memory is bounded by block volumes. Mean and variance are merged per block with
+    Chan's form of Welford's update in dtype. mask selects voxels (flattened C order); without it, voxels that
+    are non-zero in every volume are used, as in calculate_tsnr. Returns tsnr of the selected voxels, as
+    math_tsnr, and the boolean voxel selection'''
+    n_vols = img.shape[-1]
+    n_vox = int(np.prod(img.shape[:-1]))
+    select = np.ones(n_vox, dtype=bool) if mask is None else np.asarray(mask, dtype=bool).ravel()
+    nonzero = np.ones(np.sum(select), dtype=bool)
+    mean = np.zeros(np.sum(select), dtype=dtype)
+    m2 = np.zeros_like(mean)
+    n = 0
+    for start in range(0, n_vols, block):
+        x = np.asarray(img.dataobj[..., start:start + block], dtype=dtype)
+        x = x.reshape(n_vox, -1)[select]
+        if mask is None:
+            nonzero &= np.all(x, axis=1)
+        n_b = x.shape[1]
+        mean_b = np.mean(x, 1)
+        m2_b = np.sum((x - mean_b[:, None]) ** 2, 1)
+        delta = mean_b - mean
+        mean += delta * (n_b / (n + n_b))
+        m2 += m2_b + delta ** 2 * (n * n_b / (n + n_b))
+        n += n_b
+    if mask is None:
+        select[select] = nonzero
+        mean, m2 = mean[nonzero], m2[nonzero]
+    s = np.sqrt(m2 / n)
+    s[s == 0] += 1e-5
+    return mean / s, select
+
+
 def tsnr2img(y, z):
     y = y.reshape(z.get_fdata().shape)
     tsnr_img = nibabel.Nifti1Image(y, z.affine, z.header)
     return tsnr_img
 
 
-def calculate_tsnr(output_dir, save_nii=True, use_grey_mask=False):
+def subject_tsnr(output_dir, subject, save_nii=True, use_grey_mask=False, block=32, dtype=np.float64,
+                 warp_engine='native', grey_mask=None, tools=None):
+    '''tSNR of one subject's first-level filtered_func_data. Returns tsnr of the selected voxels and, with save_nii,
+    the tSNR map warped to MNI. With use_grey_mask, grey_mask is the functional space mask of make_grey_matter_mask
+    if it was already made, else it is made here. tools replaces external commands as in routines.TOOLS'''
+    with instrument.span('subject_tsnr', subject=subject):
+        return _subject_tsnr(output_dir, subject, save_nii, use_grey_mask, block, dtype, warp_engine, grey_mask,
+                             tools)
+
+
+def _subject_tsnr(output_dir, subject, save_nii, use_grey_mask, block, dtype, warp_engine, grey_mask, tools):
+    print(subject)
+    grey_mask_tag = '_grey_mask' if use_grey_mask else ''
+    func_file = os.path.join(output_dir, 'sub-' + subject +
+                             '_ses-mri3t_task-film_run-1_bold.feat', 'filtered_func_data.nii.gz')
+    mean_file = os.path.join(output_dir, 'sub-' + subject +
+                             '_ses-mri3t_task-film_run-1_bold.feat', 'mean_func.nii.gz')
+    print(func_file)
+    x = nibabel.load(func_file, keep_file_open=True)
+    z = nibabel.load(mean_file)
+
+    if use_grey_mask:
+        if grey_mask is None:
+            assert len(glob.glob(output_dir + '/sub-' + subject + '*_brain_pve_1.nii.gz')) == 1, \
+                                                                                    'More than one or no pve1 file'
+            pve1 = glob.glob(output_dir + '/sub-' + subject + '*_brain_pve_1.nii.gz')[0]
+            grey_mask = make_grey_matter_mask(os.path.join(output_dir, 'sub-' + subject +
+                                                           '_ses-mri3t_task-film_run-1_bold.feat'), pve1, warp_engine,
+                                              tools)
+        a = nibabel.load(grey_mask)
+        af = a.get_fdata().flatten()
+        tsnr, indices = stream_tsnr(x, af == 1, block, dtype)
+    else:
+        tsnr, indices = stream_tsnr(x, None, block, dtype)
+
+    y = np.zeros((indices.shape[0],))
+    y[indices] = tsnr
+    tsnr_img = tsnr2img(y, z)
+    tsnr_mni = None
+    if save_nii:
+        tsnr_nii_file = os.path.join(output_dir + 'sub-' + subject +
+                                     '_ses-mri3t_task-film_run-1_bold.feat', 'tsnr' + grey_mask_tag + '.nii.gz')
+        nibabel.save(tsnr_img, tsnr_nii_file)  # gzipped by nibabel
+        tsnr_mni = warp_native2_mni(tsnr_nii_file, warp_engine, tools)
+    return tsnr, tsnr_mni
+
+
+@instrument.instrumented()
+def median_tsnr_mni(output_dir, tsnr_mnis, use_grey_mask=False, tools=None):
+    '''Voxelwise median over subjects of the MNI tSNR maps, saved as tsnr_median_mni and converted to mgh'''
+    grey_mask_tag = '_grey_mask' if use_grey_mask else ''
+    stack = None
+    for tsnr_mni in tsnr_mnis:
+        temp_mni = nibabel.load(tsnr_mni)
+        if stack is None:
+            stack = GroupStack(os.path.join(output_dir, 'tsnr_mni_stack' + grey_mask_tag + '.npy'),
+                               len(tsnr_mnis), int(np.prod(temp_mni.shape)))
+        stack.append(temp_mni.get_fdata())
+        mni_size = temp_mni.dataobj.shape
+        print(mni_size)
+
+    tsnrs_mnis_med = stack.median()
+    stack.remove()
+    tsnr_img_mni = tsnr2img(tsnrs_mnis_med, temp_mni)
+    nibabel.save(tsnr_img_mni,
+                 os.path.join(output_dir, 'tsnr_median_mni' + grey_mask_tag + '.nii'))
+    nii2mgh(os.path.join(output_dir, 'tsnr_median_mni' + grey_mask_tag + '.nii'), tools)
+
+
+@instrument.instrumented()
+def calculate_tsnr(output_dir, save_nii=True, use_grey_mask=False, block=32, dtype=np.float64, warp_engine='native'):
 
     subjects = []
     for f in glob.glob(output_dir + 'sub-*.feat/'):
@@ -33,62 +137,17 @@ def calculate_tsnr(output_dir, save_nii=True, use_grey_mask=False):
 
     sort_nicely(subjects)
     print('Found ' + str(len(subjects)) + ' subjects')
-    grey_mask_tag = '_grey_mask' if use_grey_mask else ''
 
     #
     tsnrs, tsnrs_mnis = [], []
     for subject in subjects:
-        print(subject)
-        func_file = os.path.join(output_dir, 'sub-' + subject +
-                                 '_ses-mri3t_task-film_run-1_bold.feat', 'filtered_func_data.nii.gz')
-        mean_file = os.path.join(output_dir, 'sub-' + subject +
-                                 '_ses-mri3t_task-film_run-1_bold.feat', 'mean_func.nii.gz')
-        print(func_file)
-        x = nibabel.load(func_file)
-        z = nibabel.load(mean_file)
-
-        data0 = x.get_fdata()
-        data0 = data0.reshape(-1, data0.shape[-1])
-        if use_grey_mask:
-            assert len(glob.glob(output_dir + '/sub-' + subject + '*_brain_pve_1.nii.gz')) == 1, \
-                                                                                        'More than one or no pve1 file'
-            pve1 = glob.glob(output_dir + '/sub-' + subject + '*_brain_pve_1.nii.gz')[0]
-            grey_mask = make_grey_matter_mask(os.path.join(output_dir, 'sub-' + subject +
-                                                           '_ses-mri3t_task-film_run-1_bold.feat'), pve1)
-            a = nibabel.load(grey_mask)
-            af = a.get_fdata().flatten()
-            data = data0[af == 1]
-            indices = af == 1
-        else:
-            data = data0[np.all(data0, axis=1)]
-            indices = np.all(data0, axis=1)
-
-        tsnr = math_tsnr(data)
-
-        y = np.zeros((data0.shape[0],))
-        y[indices] = tsnr
-        tsnr_img = tsnr2img(y, z)
+        tsnr, tsnr_mni = subject_tsnr(output_dir, subject, save_nii, use_grey_mask, block, dtype, warp_engine)
         if save_nii:
-            tsnr_nii_file = os.path.join(output_dir + 'sub-' + subject +
-                                         '_ses-mri3t_task-film_run-1_bold.feat', 'tsnr' + grey_mask_tag + '.nii')
-            nibabel.save(tsnr_img, tsnr_nii_file)
-            check_call(['gzip', '-f', tsnr_nii_file])
             tsnrs.append(tsnr)
-            tsnr_nii_file += '.gz'
-
-            tsnr_mni = warp_native2_mni(tsnr_nii_file)
-            temp_mni = nibabel.load(tsnr_mni)
-            tsnrs_mnis.append(temp_mni.get_fdata().flatten())
-            mni_size = temp_mni.dataobj.shape
-            print(mni_size)
+            tsnrs_mnis.append(tsnr_mni)
 
     if save_nii:
-        tsnrs_mnis_med = np.median(np.array(tsnrs_mnis), 0)
-        tsnr_img_mni = tsnr2img(tsnrs_mnis_med, temp_mni)
-        nibabel.save(tsnr_img_mni,
-                     os.path.join(output_dir, 'tsnr_median_mni' + grey_mask_tag + '.nii'))
-        nii2mgh(os.path.join(output_dir, 'tsnr_median_mni' + grey_mask_tag + '.nii'))
-
+        median_tsnr_mni(output_dir, tsnrs_mnis, use_grey_mask)
 
 
 ##
@@ -99,9 +158,10 @@ if __name__ == '__main__':
     parser.add_argument('--no-save_nii', dest='save_nii', action='store_false')
     parser.add_argument('--use_grey_mask', dest='use_grey_mask', action='store_true')
     parser.add_argument('--no-use_grey_mask', dest='use_grey_mask', action='store_false')
+    parser.add_argument('--warp_engine', type=str, default='native', choices=['native', 'fsl'])
     parser.set_defaults(save_nii=True)
     parser.set_defaults(use_grey_mask=False)
     args = parser.parse_args()
     print(os.getcwd())
 
-    calculate_tsnr(args.output_directory, args.save_nii, args.use_grey_mask)
+    calculate_tsnr(args.output_directory, args.save_nii, args.use_grey_mask, warp_engine=args.warp_engine)
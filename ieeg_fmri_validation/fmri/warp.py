@@ -0,0 +1,183 @@
+'''
+In-process application of FSL registrations (FLIRT .mat affines and FNIRT displacement fields), equivalent to
+applywarp --ref --in --premat [--warp] [--interp=trilinear|nn] followed by fslmaths -thr -bin. FNIRT cubic spline
+coefficient files, as FEAT writes reg/highres2standard_warp, are evaluated to a displacement field in process
+'''
+
+import os
+import nibabel
+import numpy as np
+
+from functools import lru_cache
+from scipy.ndimage import map_coordinates
+
+FNIRT_DISPLACEMENT_FIELD = 2006
+FNIRT_CUBIC_SPLINE = 2007
+FNIRT_COEFFICIENTS = [2007, 2008, 2009]
+
+
+def geometry(img):
+    '''(shape, voxel sizes, voxel -> world affine) of a nibabel image or a path to one'''
+    img = nibabel.load(img) if isinstance(img, str) else img
+    return tuple(img.shape[:3]), tuple(float(z) for z in img.header.get_zooms()[:3]), np.asarray(img.affine)
+
+
+def fsl_scaled_mm(shape, zooms, affine):
+    '''Voxel -> FSL scaled mm coordinates: voxel indices times voxel sizes, with x flipped when the voxel -> world
+    matrix has a positive determinant (neurological storage order), as FLIRT and FNIRT use them'''
+    scaled = np.diag(np.append(zooms, 1.))
+    if np.linalg.det(affine[:3, :3]) > 0:
+        scaled[0, 0] = -zooms[0]
+        scaled[0, 3] = (shape[0] - 1) * zooms[0]
+    return scaled
+
+
+def read_fsl_mat(path):
+    '''4x4 FLIRT matrix, maps input scaled mm to reference scaled mm'''
+    return np.loadtxt(path).reshape(4, 4)
+
+
+def _cubic_bspline_weights(n, n_coefficients, spacing):
+    '''n voxels x n_coefficients values of cubic B-splines with knots every spacing voxels, the knot grid
+    centred on the voxel grid'''
+    offset = ((n - 1) - (n_coefficients - 1) * spacing) / 2.
+    t = np.abs(np.arange(n)[:, None] - (offset + spacing * np.arange(n_coefficients))[None]) / spacing
+    return np.where(t < 1, 2 / 3. - t ** 2 + t ** 3 / 2, np.where(t < 2, (2 - t) ** 3 / 6, 0))
+
+
+def coefficients_to_field(coefficients, ref):
+    '''Relative displacement field in mm on the grid of ref of an FNIRT cubic spline coefficient image (fnirt
+    --cout), as convertwarp --relout writes it. The knot spacing in reference voxels is the voxel size of the
+    coefficient image and the affine fnirt started from (--aff, input -> reference scaled mm) its sform; the
+    field is the spline field plus the displacement of that affine's inverse'''
+    coefficients = nibabel.load(coefficients) if isinstance(coefficients, str) else coefficients
+    ref = nibabel.load(ref) if isinstance(ref, str) else ref
+    shape, zooms, affine = geometry(ref)
+    spacing = [int(round(float(z))) for z in coefficients.header.get_zooms()[:3]]
+    expected = tuple(int(np.ceil((n + 1) / k)) + 2 for n, k in zip(shape, spacing))
+    assert tuple(coefficients.shape[:3]) == expected and coefficients.shape[3] == 3, \
+        'Coefficients ' + str(coefficients.shape) + ' do not match a reference of ' + str(shape)
+    weights = [_cubic_bspline_weights(n, c, k) for n, c, k in zip(shape, expected, spacing)]
+    data = np.asarray(coefficients.dataobj, dtype=np.float64)
+    field = np.stack([np.einsum('ia,jb,kc,abc->ijk', *weights, data[..., i], optimize=True) for i in range(3)], -1)
+
+    aff = coefficients.get_sform() if int(coefficients.header['sform_code']) else np.eye(4)
+    to_mm = fsl_scaled_mm(shape, zooms, affine)
+    mm = to_mm[:3, :3].dot(np.indices(shape, dtype=np.float64).reshape(3, -1)) + to_mm[:3, 3:]
+    inverse = np.linalg.inv(aff) - np.eye(4)
+    field += (inverse[:3, :3].dot(mm) + inverse[:3, 3:]).T.reshape(shape + (3,))
+    img = nibabel.Nifti1Image(field.astype(np.float32), affine)
+    img.header['intent_code'] = FNIRT_DISPLACEMENT_FIELD
+    return img
+
+
+def read_displacement_field(path, ref=None):
+    '''FNIRT displacement field in mm as written by fnirt --fout or convertwarp. Cubic spline coefficient files
+    (fnirt --cout) are evaluated on the grid of the reference image ref with coefficients_to_field'''
+    img = nibabel.load(path)
+    code = int(img.header['intent_code'])
+    if code == FNIRT_CUBIC_SPLINE:
+        if ref is None:
+            raise ValueError(path + ' holds spline coefficients, the reference image is needed to evaluate them')
+        img = coefficients_to_field(img, ref)
+    elif code in FNIRT_COEFFICIENTS:
+        raise ValueError(path + ' holds quadratic spline or DCT coefficients, use engine=\'fsl\' or convert it with '
+                         'convertwarp --relout')
+    assert img.ndim == 4 and img.shape[3] == 3, 'Not a displacement field ' + path
+    return img
+
+
+class SamplingGrid(object):
+    '''For every voxel of the reference image, where to sample the input image. Composed once from an optional
+    premat (input -> intermediate scaled mm) and an optional displacement field (reference -> intermediate mm),
+    then applied to any number of input volumes with precomputed interpolation weights'''
+    def __init__(self, ref, in_geometry, premat=None, warp=None, relative=True, order=1):
+        self.ref = nibabel.load(ref) if isinstance(ref, str) else ref
+        self.ref_shape, zooms, affine = geometry(self.ref)
+        self.in_shape = tuple(in_geometry[0])
+        self.order = order
+
+        to_mm = fsl_scaled_mm(self.ref_shape, zooms, affine)
+        mm = to_mm[:3, :3].dot(np.indices(self.ref_shape, dtype=np.float64).reshape(3, -1)) + to_mm[:3, 3:]
+        if warp is not None:
+            field = read_displacement_field(warp, ref if isinstance(ref, str) else None) \
+                if isinstance(warp, str) else warp
+            if tuple(field.shape[:3]) == self.ref_shape and np.allclose(field.affine, affine):
+                d = np.asarray(field.dataobj, dtype=np.float64).reshape(-1, 3).T
+            else:
+                to_field = np.linalg.inv(fsl_scaled_mm(*geometry(field)))
+                voxels = to_field[:3, :3].dot(mm) + to_field[:3, 3:]
+                d = np.stack([map_coordinates(np.asarray(field.dataobj[..., i], dtype=np.float64), voxels,
+                                              order=1, mode='nearest') for i in range(3)])
+            mm = mm + d if relative else d
+        to_in = np.linalg.inv(fsl_scaled_mm(*in_geometry))
+        if premat is not None:
+            to_in = to_in.dot(np.linalg.inv(premat))
+        self.coordinates = to_in[:3, :3].dot(mm) + to_in[:3, 3:]
+        self._weights()
+
+    def _weights(self):
+        '''Flat input indices of the 8 (trilinear) or 1 (nearest) neighbours of every sample and their weights,
+        zero outside the input field of view'''
+        c = self.coordinates
+        shape = np.array(self.in_shape)[:, None]
+        inside = np.all((c > -0.5) & (c < shape - 0.5), 0)
+        if self.order == 0:
+            nearest = np.clip(np.floor(c + 0.5).astype(np.int64), 0, shape - 1)
+            self.index = np.ravel_multi_index(nearest, self.in_shape)[None]
+            self.weight = inside[None].astype(np.float32)
+            return
+        c = np.clip(c, 0, shape - 1)
+        low = np.clip(np.floor(c).astype(np.int64), 0, np.maximum(shape - 2, 0))
+        frac = c - low
+        index, weight = [], []
+        for corner in np.ndindex(2, 2, 2):
+            offset = np.array(corner)[:, None]
+            index.append(np.ravel_multi_index(np.minimum(low + offset, shape - 1), self.in_shape))
+            weight.append(np.prod(np.where(offset, frac, 1 - frac), 0) * inside)
+        self.index = np.stack(index)
+        self.weight = np.stack(weight).astype(np.float32)
+
+    def resample(self, data):
+        '''Input volume (x, y, z) or volumes (x, y, z, ...) -> same on the reference grid, in one pass'''
+        data = np.asarray(data)
+        assert tuple(data.shape[:3]) == self.in_shape, 'Input does not match the grid ' + str(data.shape)
+        flat = data.reshape(int(np.prod(self.in_shape)), -1)
+        out = np.zeros((self.index.shape[1], flat.shape[1]), dtype=np.float64)
+        for index, weight in zip(self.index, self.weight):
+            out += flat[index] * weight[:, None]
+        return out.reshape(self.ref_shape + data.shape[3:])
+
+    def to_img(self, data):
+        img = nibabel.Nifti1Image(np.asarray(data, dtype=np.float32), self.ref.affine, self.ref.header)
+        img.set_data_dtype(np.float32)
+        return img
+
+
+@lru_cache(maxsize=2)  # the grids of one subject (grey mask, MNI); an MNI grid is ~100 MB
+def _cached_grid(ref, in_geometry, premat, warp, order, mtimes):
+    return SamplingGrid(ref, (in_geometry[0], in_geometry[1], np.array(in_geometry[2])),
+                        None if premat is None else read_fsl_mat(premat), warp, order=order)
+
+
+def sampling_grid(ref, in_img, premat=None, warp=None, order=1):
+    '''SamplingGrid from files, cached per (ref, input geometry, premat, warp) so all maps of a subject reuse it'''
+    shape, zooms, affine = geometry(in_img)
+    mtimes = tuple(os.stat(p).st_mtime_ns for p in [ref, premat, warp] if p is not None)
+    return _cached_grid(ref, (shape, zooms, tuple(map(tuple, affine))), premat, warp, order, mtimes)
+
+
+def apply_warp(ref, in_img, out_file=None, premat=None, warp=None, order=1, threshold=None, binarize=False):
+    '''applywarp [--interp=nn when order=0], then optionally fslmaths -thr threshold [-bin], in memory. Returns the
+    warped image, saved to out_file if given'''
+    in_img = nibabel.load(in_img) if isinstance(in_img, str) else in_img
+    grid = sampling_grid(ref, in_img, premat, warp, order)
+    data = grid.resample(np.asarray(in_img.dataobj, dtype=np.float64))
+    if threshold is not None:
+        data[data < threshold] = 0
+    if binarize:
+        data = (data != 0).astype(np.float64)
+    img = grid.to_img(data)
+    if out_file is not None:
+        nibabel.save(img, out_file)
+    return img
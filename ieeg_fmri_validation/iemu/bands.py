@@ -0,0 +1,88 @@
+'''
+Band envelopes of all bands in one contiguous array (bands x time x channels) with band and channel labels
+'''
+
+import numpy as np
+
+from collections.abc import Mapping
+
+from ieeg_fmri_validation.utils import resample, smooth_signal, zscore
+
+
+class BandTensor(Mapping):
+    '''Envelopes of all bands as one array (bands x time x channels). Every operation runs on all bands at once
+    and returns a new BandTensor, views of data where possible. Indexed by band name it returns that band's
+    time x channels view, so it can be used as the OrderedDict of per-band arrays it replaces'''
+    def __init__(self, data, bands, ch_names=None):
+        assert data.ndim == 3 and data.shape[0] == len(bands), 'data must be bands x time x channels'
+        self.data = data
+        self.bands = list(bands)
+        self.ch_names = list(ch_names) if ch_names is not None else None
+        self._band_index = dict((band, i) for i, band in enumerate(self.bands))
+
+    @classmethod
+    def from_bands(cls, bands, ch_names=None):
+        '''BandTensor of a mapping of band name to time x channels array, or bands itself if it is one'''
+        if isinstance(bands, cls):
+            return bands
+        return cls(np.stack(list(bands.values())), bands.keys(), ch_names)
+
+    def __getitem__(self, band):
+        return self.data[self._band_index[band]]
+
+    def __setitem__(self, band, value):
+        self.data[self._band_index[band]] = value
+
+    def __iter__(self):
+        return iter(self.bands)
+
+    def __len__(self):
+        return len(self.bands)
+
+    def __repr__(self):
+        return 'BandTensor(' + ', '.join(self.bands) + '; ' + ' x '.join(map(str, self.data.shape)) + ')'
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def _new(self, data, ch_names=None):
+        return BandTensor(data, self.bands, self.ch_names if ch_names is None else ch_names)
+
+    def crop(self, start, stop):
+        return self._new(self.data[:, start:stop])
+
+    def resample(self, sr1, sr2, dtype=np.float32):
+        '''sr1: target, sr2: source, as utils.resample'''
+        return self._new(resample(self.data, sr1, sr2, axis=1, dtype=dtype))
+
+    def smooth(self, n):
+        return self._new(smooth_signal(self.data, n, axis=1))
+
+    def zscore(self):
+        '''z-scored over time per band and channel'''
+        return self._new(zscore(self.data, axis=1))
+
+    def block_means(self, block_length):
+        '''Means over consecutive blocks of block_length samples, a trailing partial block is dropped'''
+        n_blocks = self.data.shape[1] // block_length
+        data = self.data[:, :n_blocks * block_length]
+        return self._new(data.reshape((len(self.bands), n_blocks, block_length, -1)).mean(2))
+
+    def channel_index(self, ch_names):
+        '''Integer positions of ch_names in this tensor's channels'''
+        position = dict((name, i) for i, name in enumerate(self.ch_names))
+        return np.array([position[name] for name in ch_names], dtype=np.intp)
+
+    def select(self, ch_names):
+        return self._new(self.data[..., self.channel_index(ch_names)], ch_names)
+
+
+def common_channels(ch_names, other_ch_names):
+    '''Channels of ch_names also in other_ch_names, in the order of ch_names, with their integer positions in
+    both lists'''
+    position = dict((name, i) for i, name in enumerate(other_ch_names))
+    common = [name for name in ch_names if name in position]
+    index = dict((name, i) for i, name in enumerate(ch_names))
+    return common, np.array([index[name] for name in common], dtype=np.intp), \
+        np.array([position[name] for name in common], dtype=np.intp)
@@ -0,0 +1,111 @@
+'''
+Reader of the BrainVision triplet (.vhdr header, .vmrk markers, .eeg binary data) that memory-maps the data file.
+Views of any channels and samples are zero-copy in the stored type, read() converts to volts one chunk at a
+time, so only the selected channels and samples are ever decoded
+'''
+
+import os
+import re
+import numpy as np
+
+FORMATS = {'INT_16': 'i2', 'INT_32': 'i4', 'IEEE_FLOAT_32': 'f4'}
+UNITS = {'V': 1., 'mV': 1e-3, 'µV': 1e-6, 'uV': 1e-6, 'nV': 1e-9}
+
+
+def _read_ini(path):
+    '''Sections of a BrainVision header or marker file as {section: {key: value}}, decoded with its Codepage'''
+    with open(path, 'rb') as f:
+        raw = f.read()
+    codepage = re.search(br'Codepage=(\S+)', raw, re.IGNORECASE)
+    codepage = codepage.group(1).decode('ascii') if codepage else 'utf-8'
+    try:
+        text = raw.decode('cp1252' if codepage.upper() == 'ANSI' else codepage)
+    except UnicodeDecodeError:
+        text = raw.decode('latin-1')
+    sections, section = {}, None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = sections.setdefault(line[1:-1], {})
+        elif section is not None and '=' in line and not line.startswith(';'):
+            key, value = line.split('=', 1)
+            section[key.strip()] = value.strip()
+    return sections
+
+
+class BrainVision(object):
+    '''Header, markers and memory-mapped data of the BrainVision recording vhdr_path. Raises NotImplementedError
+    for formats other than binary INT_16, INT_32 and IEEE_FLOAT_32'''
+    def __init__(self, vhdr_path):
+        self.vhdr_path = vhdr_path
+        header = _read_ini(vhdr_path)
+        common = header['Common Infos']
+        binary = header.get('Binary Infos', {})
+        if common.get('DataFormat', 'BINARY').upper() != 'BINARY' or binary.get('BinaryFormat') not in FORMATS:
+            raise NotImplementedError('Only binary ' + ', '.join(FORMATS) + ' BrainVision data is supported')
+        directory = os.path.dirname(vhdr_path)
+        self.data_path = os.path.join(directory, common['DataFile'])
+        self.marker_path = os.path.join(directory, common['MarkerFile']) if 'MarkerFile' in common else None
+        self.orientation = common.get('DataOrientation', 'MULTIPLEXED').upper()
+        self.sfreq = 1e6 / float(common['SamplingInterval'])
+        byteorder = '>' if binary.get('UseBigEndianOrder', 'NO').upper() == 'YES' else '<'
+        self.dtype = np.dtype(byteorder + FORMATS[binary['BinaryFormat']])
+
+        n_channels = int(common['NumberOfChannels'])
+        self.ch_names, self.units, resolutions = [], [], []
+        for i in range(n_channels):
+            props = header['Channel Infos']['Ch' + str(i + 1)].split(',')
+            props += [''] * (4 - len(props))
+            self.ch_names.append(props[0].replace(r'\1', ','))
+            resolutions.append(float(props[2]) if props[2] else 1.)
+            self.units.append(props[3] or 'µV')
+        # volts per stored unit, as mne.io.read_raw_brainvision(scale=1.0); unknown units are kept as is
+        self.scales = np.array(resolutions) * np.array([UNITS.get(unit, 1.) for unit in self.units])
+
+        n_values = os.path.getsize(self.data_path) // self.dtype.itemsize
+        self.n_times = n_values // n_channels
+        self.data = np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                              shape=(self.n_times, n_channels) if self.orientation == 'MULTIPLEXED' else
+                              (n_channels, self.n_times))
+        self._index = dict((name, i) for i, name in enumerate(self.ch_names))
+
+    def picks(self, ch_names=None):
+        '''Indices of ch_names in the file, all channels by default'''
+        if ch_names is None:
+            return np.arange(len(self.ch_names))
+        return np.array([self._index[name] for name in ch_names], dtype=np.intp)
+
+    def view(self, ch_names=None, start=0, stop=None):
+        '''Stored values of ch_names between samples start and stop as a channels x time array. No data is read
+        when the channels form a contiguous range, otherwise only the selected channels of start:stop are'''
+        picks = self.picks(ch_names)
+        stop = self.n_times if stop is None else stop
+        if len(picks) and np.all(np.diff(picks) == 1):
+            picks = slice(picks[0], picks[-1] + 1)
+        if self.orientation == 'MULTIPLEXED':
+            return self.data[start:stop, picks].T
+        return self.data[picks, start:stop]
+
+    def read(self, ch_names=None, start=0, stop=None, dtype=np.float64, out=None, chunk=2 ** 16):
+        '''Volts of ch_names between samples start and stop (channels x time), converted chunk by chunk from the
+        memory map into out if given'''
+        picks = self.picks(ch_names)
+        stop = self.n_times if stop is None else stop
+        if out is None:
+            out = np.empty((len(picks), stop - start), dtype=dtype)
+        scales = self.scales[picks][:, None].astype(out.dtype)
+        for s in range(start, stop, chunk):
+            e = min(s + chunk, stop)
+            np.multiply(self.view(ch_names, s, e), scales, out=out[:, s - start:e - start], casting='unsafe')
+        return out
+
+    def markers(self):
+        '''Markers as (type, description, sample, duration) with 0-based sample'''
+        if self.marker_path is None or not os.path.isfile(self.marker_path):
+            return []
+        markers = []
+        infos = _read_ini(self.marker_path).get('Marker Infos', {})
+        for key in sorted(infos, key=lambda k: int(k[2:]) if k[2:].isdigit() else 0):
+            props = infos[key].split(',')
+            markers.append((props[0], props[1].replace(r'\1', ','), int(props[2]) - 1, int(props[3])))
+        return markers
@@ -0,0 +1,154 @@
+'''
+On-disk cache of band envelopes and block means
+
+python -m ieeg_fmri_validation.iemu.cache
+    -c cache_dir
+    --clear [--subject subject]
+    --max_gb 50
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+
+from ieeg_fmri_validation.iemu.bands import BandTensor
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+class EnvelopeCache(object):
+    '''Content-addressed store of SubjectDataset.bands and band_block_means. Every entry is a directory named by
+    the key, holding the band envelopes (bands x time x channels), the block means and meta.json. Arrays are
+    loaded memory-mapped. Entries are evicted least recently used first once max_bytes is exceeded'''
+    version = 2
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+        self.hashes_path = os.path.join(self.cache_dir, 'hashes.json')
+
+    def file_hash(self, path):
+        '''sha1 of the file content, memoized by (size, mtime) so unchanged raw files are hashed only once'''
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        hashes = self._read_hashes()
+        if path in hashes and hashes[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+            return hashes[path][2]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha.update(block)
+        hashes = self._read_hashes()
+        hashes[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        self._write_json(self.hashes_path, hashes)
+        return sha.hexdigest()
+
+    def key(self, raw_path, **params):
+        '''Key from the content of the BrainVision triplet of raw_path and any json-serializable parameters'''
+        base = os.path.splitext(raw_path)[0]
+        files = [base + ext for ext in ['.vhdr', '.vmrk', '.eeg'] if os.path.isfile(base + ext)]
+        params.update({'raw': [self.file_hash(f) for f in files], 'version': self.version})
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        '''Returns (bands, band_block_means, meta) or None if the key is not cached'''
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        ch_names = meta.get('ch_names')
+        bands = BandTensor(np.load(os.path.join(path, 'bands.npy'), mmap_mode='r'), meta['bands'], ch_names)
+        band_block_means = BandTensor(np.load(os.path.join(path, 'block_means.npy'), mmap_mode='r'), meta['bands'],
+                                      ch_names)
+        os.utime(path)  # mark as recently used
+        return bands, band_block_means, meta
+
+    def save(self, key, bands, band_block_means, **meta):
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            return
+        temp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        np.save(os.path.join(temp, 'bands.npy'), BandTensor.from_bands(bands).data)
+        np.save(os.path.join(temp, 'block_means.npy'), BandTensor.from_bands(band_block_means).data)
+        meta.update({'bands': list(bands.keys()), 'created': time.time()})
+        self._write_json(os.path.join(temp, 'meta.json'), meta)
+        try:
+            os.rename(temp, path)
+        except OSError:  # written concurrently by another process
+            shutil.rmtree(temp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        '''Cached keys, least recently used first'''
+        keys = [k for k in os.listdir(self.cache_dir)
+                if not k.startswith('.') and os.path.isdir(os.path.join(self.cache_dir, k))]
+        return sorted(keys, key=lambda k: os.path.getmtime(os.path.join(self.cache_dir, k)))
+
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+        entries = self.entries()
+        sizes = [_dir_size(os.path.join(self.cache_dir, k)) for k in entries]
+        total = sum(sizes)
+        for key, size in zip(entries, sizes):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+            print('Evicted ' + key + ' from envelope cache')
+
+    def invalidate(self, subject=None):
+        '''Remove all entries, or only those of one subject'''
+        removed = 0
+        for key in self.entries():
+            if subject is not None:
+                with open(os.path.join(self.cache_dir, key, 'meta.json')) as f:
+                    if json.load(f).get('subject') != subject:
+                        continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            removed += 1
+        if subject is None and os.path.isfile(self.hashes_path):
+            os.remove(self.hashes_path)
+        print('Removed ' + str(removed) + ' cache entries')
+        return removed
+
+    def _read_hashes(self):
+        if not os.path.isfile(self.hashes_path):
+            return {}
+        try:
+            with open(self.hashes_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _write_json(self, path, obj):
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(temp, path)
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', '-c', type=str)
+    parser.add_argument('--clear', action='store_true')
+    parser.add_argument('--subject', type=str, default=None)
+    parser.add_argument('--max_gb', type=float, default=None)
+    args = parser.parse_args()
+
+    cache = EnvelopeCache(args.cache_dir)
+    if args.clear:
+        cache.invalidate(args.subject)
+    if args.max_gb is not None:
+        cache.evict(int(args.max_gb * 1e9))
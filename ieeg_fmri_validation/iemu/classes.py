@@ -5,10 +5,22 @@ import os
 import json
 import mne_bids
 import warnings
+import tempfile
 
 from collections import OrderedDict
-from ieeg_fmri_validation.utils import resample, smooth_signal, zscore
-from ieeg_fmri_validation.iemu.routines import run_OLS_block_design, calculate_r_squared
+from ieeg_fmri_validation.utils import lazy_property
+from ieeg_fmri_validation.iemu.routines import run_OLS_block_design, calculate_r_squared, compute_band_envelopes, \
+                                                stream_band_envelopes, band_filter_length, notch_filter_length, \
+                                                band_envelope_work_bytes
+from ieeg_fmri_validation.iemu.bands import BandTensor
+from ieeg_fmri_validation.iemu.brainvision import BrainVision
+from ieeg_fmri_validation.iemu.cache import EnvelopeCache
+from ieeg_fmri_validation.iemu.lifecycle import stage, RawMetadata
+from ieeg_fmri_validation.iemu.permutation import permutation_test_ols, permutation_test_r_squared
+from ieeg_fmri_validation.instrument import instrumented
+
+BANDS = OrderedDict([('delta', [1, 4]), ('theta', [5, 8]), ('alpha', [8, 12]), ('beta', [13, 24]),
+                     ('gamma', [60, 120])])
 
 
 class SubjectDataset(object):
@@ -17,87 +29,230 @@ class SubjectDataset(object):
         self.subject = subject
         self.datatype = 'ieeg'
         self.acquisition = None
+        self.cache_dir = None
+        self.cache_max_bytes = None
+        self.streaming = False
+        self.band_method = 'mne'  # band envelopes of extract_bands, see _compute_band_envelopes
+        self.chunk_seconds = 60
+        self.crop_to_task = False  # exact with band_method='fft' only, see _crop_to_task_window
+        self.dtype = np.float64
+        self.reader = 'native'  # 'mne' to decode the signal with mne.io.read_raw_brainvision
+        self.memory_budget = None
+        self.spill_dir = tempfile.gettempdir()
+        self.keep_intermediates = False
+        self.memory_report = []
+        self.n_perm = None  # permutation p-values when set
+        self.permutation = 'block'
+        self.seed = 0
+        self.perm_jobs = 1
+        self.raw_car = None
+        self.bands = None
+        self.index = None
+        self._preprocess_pending = False
+        self._window_events = None  # events read before _crop_to_task_window, in samples of the recording
         self.__dict__.update(kwargs)
+        self.cache = EnvelopeCache(self.cache_dir, self.cache_max_bytes) if self.cache_dir is not None else None
 
         if preload:
-            self._set_paths()
             self._load_data()
-            self._get_bad_electrodes()
 
 
-    def _set_paths(self):
-        bids_path = mne_bids.BIDSPath(subject=self.subject,
-                                      task=self.task,
-                                      suffix='ieeg',
-                                      extension='vhdr',
-                                      datatype=self.datatype,
-                                      acquisition=self.acquisition,
-                                      root=self.root)
+    def _load_data(self):
+        '''Read the BrainVision header and the sidecars now rather than on first use'''
+        self.raw
+        self.bad_electrodes
+
 
+    @lazy_property
+    @instrumented()
+    def _run_entities(self):
         print(self.task)
-        assert len(bids_path.match()) == 1, 'None or more than one run for task is found'
+        if self.index is not None:
+            matches = self.index.find(subject=self.subject, task=self.task, suffix='ieeg', extension='vhdr',
+                                      datatype=self.datatype, acquisition=self.acquisition)
+        else:
+            matches = mne_bids.BIDSPath(subject=self.subject,
+                                        task=self.task,
+                                        suffix='ieeg',
+                                        extension='vhdr',
+                                        datatype=self.datatype,
+                                        acquisition=self.acquisition,
+                                        root=self.root).match()
+            matches = [dict(mne_bids.get_entities_from_fname(match), path=str(match)) for match in matches]
+        assert len(matches) == 1, 'None or more than one run for task is found'
+        print('Picking up BIDS files done')
+        return matches[0]
 
-        self.raw_path = str(bids_path.match()[0])
-        self.run = mne_bids.get_entities_from_fname(bids_path.match()[0])['run']
-        self.session = mne_bids.get_entities_from_fname(bids_path.match()[0])['session']
 
-        bids_path = mne_bids.BIDSPath(subject=self.subject,
-                                      task=self.task,
-                                      session=self.session,
-                                      suffix='channels', run=self.run,
-                                      extension='tsv',
-                                      datatype=self.datatype,
-                                      acquisition=self.acquisition,
-                                      root=self.root)
-        self.channels_path=str(bids_path)
+    @lazy_property
+    def raw_path(self):
+        return self._run_entities['path']
 
-        bids_path = mne_bids.BIDSPath(subject=self.subject,
-                                      session=self.session, suffix='electrodes',
-                                      extension='tsv',
-                                      datatype=self.datatype,
-                                      acquisition=self.acquisition,
-                                      root=self.root)
-        self.electrodes_path = str(bids_path)
 
-        bids_path = mne_bids.BIDSPath(subject=self.subject,
-                                      suffix='T1w',
-                                      extension='.nii.gz',
-                                      root=self.root)
-        self.anat_path = str(bids_path.match()[0])
-        self.anat_session = mne_bids.get_entities_from_fname(bids_path.match()[0])['session']
-        print('Picking up BIDS files done')
+    @lazy_property
+    def run(self):
+        return self._run_entities['run']
 
 
-    def _load_data(self):
-        self.raw = mne.io.read_raw_brainvision(self.raw_path,
-                                               eog=(['EOG']),
-                                               misc=(['OTHER', 'ECG', 'EMG']),
-                                               scale=1.0,
-                                               preload=False,
-                                               verbose=True)
-        self.channels = pd.read_csv(self.channels_path, sep='\t', header=0, index_col=None)
-        self.electrodes = pd.read_csv(self.electrodes_path, sep='\t', header=0, index_col=None)
-        self.raw.set_channel_types({ch_name: str(x).lower()
-                                if str(x).lower() in ['ecog', 'seeg', 'eeg'] else 'misc'
-                                    for ch_name, x in zip(self.raw.ch_names, self.channels['type'].values)})
-        self.other_channels = self.channels['name'][~self.channels['type'].isin(['ECOG', 'SEEG'])].tolist()
-        self.raw.drop_channels(self.other_channels)
-        print('Loading BIDS data done')
+    @lazy_property
+    def session(self):
+        return self._run_entities['session']
+
+
+    @lazy_property
+    def channels_path(self):
+        return str(mne_bids.BIDSPath(subject=self.subject,
+                                     task=self.task,
+                                     session=self.session,
+                                     suffix='channels', run=self.run,
+                                     extension='tsv',
+                                     datatype=self.datatype,
+                                     acquisition=self.acquisition,
+                                     root=self.root))
+
+
+    @lazy_property
+    def electrodes_path(self):
+        return str(mne_bids.BIDSPath(subject=self.subject,
+                                     session=self.session, suffix='electrodes',
+                                     extension='tsv',
+                                     datatype=self.datatype,
+                                     acquisition=self.acquisition,
+                                     root=self.root))
+
+
+    @lazy_property
+    def _anat_entities(self):
+        if self.index is not None:
+            return self.index.find(subject=self.subject, suffix='T1w', extension='.nii.gz')[0]
+        match = mne_bids.BIDSPath(subject=self.subject,
+                                  suffix='T1w',
+                                  extension='.nii.gz',
+                                  root=self.root).match()[0]
+        return dict(mne_bids.get_entities_from_fname(match), path=str(match))
+
+
+    @lazy_property
+    def anat_path(self):
+        return self._anat_entities['path']
 
 
-    def _get_bad_electrodes(self):
-        self.bad_electrodes = self.channels['name'][
+    @lazy_property
+    def anat_session(self):
+        return self._anat_entities['session']
+
+
+    @lazy_property
+    def channels(self):
+        return pd.read_csv(self.channels_path, sep='\t', header=0, index_col=None)
+
+
+    @lazy_property
+    def electrodes(self):
+        return pd.read_csv(self.electrodes_path, sep='\t', header=0, index_col=None)
+
+
+    @lazy_property
+    def other_channels(self):
+        return self.channels['name'][~self.channels['type'].isin(['ECOG', 'SEEG'])].tolist()
+
+
+    @lazy_property
+    def bad_electrodes(self):
+        return self.channels['name'][
             (self.channels['type'].isin(['ECOG', 'SEEG'])) & (self.channels['status'] == 'bad')].tolist()
-        self.all_electrodes = self.channels['name'][(self.channels['type'].isin(['ECOG', 'SEEG']))].tolist()
-        print('Getting bad electrodes done')
 
 
+    @lazy_property
+    def all_electrodes(self):
+        return self.channels['name'][(self.channels['type'].isin(['ECOG', 'SEEG']))].tolist()
+
+
+    @lazy_property
+    @instrumented()
+    def raw(self):
+        '''BrainVision header (the signal is loaded by preprocess) with ECoG and sEEG channels only'''
+        raw = mne.io.read_raw_brainvision(self.raw_path,
+                                          eog=(['EOG']),
+                                          misc=(['OTHER', 'ECG', 'EMG']),
+                                          scale=1.0,
+                                          preload=False,
+                                          verbose=True)
+        raw.set_channel_types({ch_name: str(x).lower()
+                               if str(x).lower() in ['ecog', 'seeg', 'eeg'] else 'misc'
+                               for ch_name, x in zip(raw.ch_names, self.channels['type'].values)})
+        raw.drop_channels(self.other_channels)
+        print('Loading BIDS data done')
+        return raw
+
+
+    @instrumented()
     def preprocess(self):
         self._discard_bad_electrodes()
-        self._notch_filter()
-        self._common_average_reference()
+        if self.crop_to_task:
+            self._crop_to_task_window()
+        if self.cache is not None or self.streaming:
+            self._preprocess_pending = True  # deferred to extract_bands: envelopes are cached or streamed
+        else:
+            self._preprocess()
 
 
+    def _preprocess(self):
+        self._load_signal()
+        self._notch_filter()
+        self._common_average_reference()
+        self._preprocess_pending = False
+
+
+    def _release(self, attribute):
+        '''Drop a consumed intermediate, raw keeps its metadata'''
+        if getattr(self, attribute, None) is not None:
+            setattr(self, attribute, RawMetadata(self.raw) if attribute == 'raw' else None)
+
+
+    @lazy_property
+    def brainvision(self):
+        '''Memory-mapped reader of the recording, None with reader='mne' or for formats it does not support'''
+        if self.reader != 'native':
+            return None
+        try:
+            return BrainVision(self.raw_path)
+        except NotImplementedError:
+            return None
+
+
+    def _read_signal(self, start, stop, out=None):
+        '''Volts of the channels of raw between its samples start and stop, decoding only those channels and
+        samples with the native reader'''
+        if self.brainvision is None:
+            return self.raw.get_data(start=start, stop=stop)
+        offset = self.raw.first_samp  # BrainVision recordings start at sample 0, crop moves first_samp
+        return self.brainvision.read(self.raw.ch_names, offset + start, offset + stop, out=out)
+
+
+    @stage(produces=('raw',), estimate=lambda self: len(self.raw.ch_names) * self.raw.n_times * 8, spill=True)
+    def _load_signal(self):
+        if self.brainvision is None:
+            if self._spill:
+                fd, path = tempfile.mkstemp(dir=self.spill_dir, suffix='.dat')
+                os.close(fd)
+                self.raw._preload_data(path)  # memory-mapped preload, as mne.io.read_raw_*(preload=path)
+                os.remove(path)
+            else:
+                self.raw.load_data()
+            return
+        out = None
+        if self._spill:
+            out = np.memmap(tempfile.TemporaryFile(dir=self.spill_dir), dtype=np.float64,
+                            shape=(len(self.raw.ch_names), self.raw.n_times))
+        # preload as BaseRaw._preload_data does, decoding only the channels and samples raw kept
+        self.raw._data = self._read_signal(0, self.raw.n_times, out)
+        self.raw.preload = True
+        self.raw._comp = None
+        self.raw.close()
+
+
+    @instrumented()
     def _discard_bad_electrodes(self):
         if self.raw is not None:
             [self.bad_electrodes.remove(i) for i in self.bad_electrodes if i not in self.raw.ch_names]
@@ -105,10 +260,31 @@ class SubjectDataset(object):
             print('Bad channels indicated: ' + str(self.bad_electrodes))
             print('Dropped ' + str(self.raw.info['bads']) + 'channels')
             self.raw.drop_channels(self.raw.info['bads'])
-            self.raw.load_data()
             print('Remaining channels ' + str(self.raw.ch_names))
 
 
+    @instrumented()
+    def _crop_to_task_window(self):
+        '''Crop raw to the task window padded by the notch and longest band-pass filter (plus the same again for
+        the Hilbert tail), so that preprocessing and band extraction only run on data that is kept. The events are
+        kept as read before cropping: annotation onsets of the cropped raw lose the exact sample in the time round
+        trip and would be read one sample early. The 'fft' band envelopes of the cropped run equal those of the
+        whole run; the 'mne' ones do not, apply_hilbert wraps the cropped edges around into the task window (up
+        to ~2e-1 of the envelope RMS for delta, ~3e-5 for gamma)'''
+        if self.raw is not None:
+            self._read_events()
+            sfreq = self.raw.info['sfreq']
+            pad = notch_filter_length(sfreq) // 2 + band_filter_length(sfreq, BANDS)
+            start = max(self.events[0, 0] - self.raw.first_samp - pad, 0)
+            stop = min(self.events[-1, 0] - self.raw.first_samp + pad, self.raw.n_times - 1)
+            first_samp = self.raw.first_samp
+            self.raw.crop(self.raw.times[start], self.raw.times[stop])
+            assert self.raw.first_samp == first_samp + start and self.raw.n_times == stop - start + 1, \
+                'Crop missed the task window samples'
+            self._window_events = self.events.copy(), dict(self.event_id)
+
+
+    @stage(produces=('raw',))
     def _notch_filter(self):
         if self.raw is not None:
             if np.any(np.isnan(self.raw._data)):
@@ -118,12 +294,18 @@ class SubjectDataset(object):
             print('Notch filter done')
 
 
+    @stage(consumes=('raw',), produces=('raw_car',),
+           estimate=lambda self: self.raw._data.nbytes if self.keep_intermediates else 0)
     def _common_average_reference(self):
         if self.raw is not None:
-            self.raw_car, _ = mne.set_eeg_reference(self.raw.copy(), 'average')
+            if self.keep_intermediates:
+                self.raw_car, _ = mne.set_eeg_reference(self.raw.copy(), 'average')
+            else:
+                self.raw_car, _ = mne.set_eeg_reference(self.raw, 'average', copy=False)  # raw is released
             print('CAR done')
 
 
+    @instrumented()
     def extract_events(self, plot=False):
         self._read_events()
         if plot:
@@ -131,7 +313,8 @@ class SubjectDataset(object):
 
 
     def _read_events(self):
-        if self.raw is not None:
+        raw = self.raw_car if self.raw_car is not None else self.raw
+        if raw is not None:
             if self.task == 'film':
                 custom_mapping = {'Stimulus/music': 2,
                                   'Stimulus/speech': 1,
@@ -141,7 +324,10 @@ class SubjectDataset(object):
                                   'Stimulus/end task': 2}
             else:
                 raise NotImplementedError
-            self.events, self.event_id = mne.events_from_annotations(self.raw, event_id=custom_mapping,
+            if self._window_events is not None:  # events carry first_samp, so they still index the cropped raw
+                self.events, self.event_id = self._window_events[0].copy(), dict(self._window_events[1])
+                return
+            self.events, self.event_id = mne.events_from_annotations(raw, event_id=custom_mapping,
                                                                      use_rounding=False)
             print('Reading events done')
 
@@ -156,50 +342,107 @@ class SubjectDataset(object):
                               bgcolor='w')
 
 
-    def extract_bands(self, smooth=False):
-        if self.raw_car is not None:
-            self._compute_band_envelopes()
+    @instrumented()
+    def extract_bands(self, smooth=False, method=None):
+        '''Band envelopes with method ('mne' or 'fft', default self.band_method), or with the streaming FFT filter
+        bank when self.streaming'''
+        method = self.band_method if method is None else method
+        if method not in ('mne', 'fft'):
+            raise ValueError("method must be 'mne' or 'fft', not " + repr(method))
+        if self.cache is not None and self._read_cached_bands(smooth, method):
+            return
+        if self.streaming:
+            self._stream_band_envelopes()
+        else:
+            if self._preprocess_pending:
+                self._preprocess()
+            self._compute_band_envelopes(method)
             self._crop_band_envelopes()
             self._resample_band_envelopes()
-            if smooth: self._smooth_band_envelopes()
-            self._compute_block_means_per_band()
-
-
-    def _compute_band_envelopes(self):
+        if smooth: self._smooth_band_envelopes()
+        self._compute_block_means_per_band()
+        if self.cache is not None:
+            self.cache.save(self._cache_key, self.bands, self.band_block_means,
+                            subject=self.subject, task=self.task, ch_names=self.raw.ch_names)
+
+
+    def _read_cached_bands(self, smooth, method):
+        self._cache_key = self.cache.key(self.raw_path, bad_electrodes=sorted(self.bad_electrodes),
+                                         ch_names=self.raw.ch_names, bands=BANDS, method=method, smooth=smooth,
+                                         sfreq=self.raw.info['sfreq'], target_sfreq=25, notch=[50, 251, 50],
+                                         events=self.events[[0, -1], 0].tolist(), streaming=self.streaming,
+                                         crop_to_task=self.crop_to_task, dtype=np.dtype(self.dtype).name,
+                                         expected_duration=self.expected_duration)
+        cached = self.cache.load(self._cache_key)
+        if cached is None:
+            return False
+        self.bands, self.band_block_means, _ = cached
+        return True
+
+
+    def _estimate_band_envelopes(self):
+        n_ch, n_times = len(self.raw_car.ch_names), self.raw_car.n_times
+        return len(BANDS) * n_ch * n_times * np.dtype(self.dtype).itemsize + \
+            band_envelope_work_bytes(n_ch, n_times, self.raw_car.info['sfreq'], BANDS)
+
+
+    @stage(consumes=('raw_car',), produces=('bands',), estimate=_estimate_band_envelopes, spill=True)
+    def _compute_band_envelopes(self, method='mne'):
+        '''method: 'mne' for MNE filter + apply_hilbert per band, 'fft' for the single-FFT filter bank, faster but
+        not a drop-in replacement: theta to gamma r2 agree to ~1e-4, delta r2 differs by up to ~2e-2 (filter edges)'''
         if self.raw_car is not None:
-            bands = {'delta': [1, 4], 'theta': [5, 8], 'alpha': [8, 12], 'beta': [13, 24], 'gamma': [60, 120]}
-            self.bands = OrderedDict.fromkeys(bands.keys())
-            for key in self.bands.keys():
-                self.bands[key] = self.raw_car.copy().filter(bands[key][0], bands[key][1]).apply_hilbert(
-                    envelope=True).get_data().T
+            if method == 'fft':
+                out = None
+                if self._spill:
+                    out = np.memmap(tempfile.TemporaryFile(dir=self.spill_dir), dtype=self.dtype,
+                                    shape=(len(BANDS), self.raw_car.n_times, len(self.raw_car.ch_names)))
+                envelopes = compute_band_envelopes(self.raw_car.get_data().astype(self.dtype, copy=False),
+                                                   self.raw_car.info['sfreq'], BANDS, out=out)
+            elif method == 'mne':
+                envelopes = np.stack([self.raw_car.copy().filter(l_freq, h_freq).apply_hilbert(
+                    envelope=True).get_data().T for l_freq, h_freq in BANDS.values()])
+            else:
+                raise ValueError("method must be 'mne' or 'fft', not " + repr(method))
+            self.bands = BandTensor(envelopes, BANDS.keys(), self.raw_car.ch_names)
             print('Extracting band envelopes done')
 
 
+    @stage(produces=('bands',))
+    def _stream_band_envelopes(self):
+        '''Notch, CAR, band envelopes and resampling of the task window in chunks of chunk_seconds, reading the
+        raw file chunk by chunk so that only downsampled envelopes are kept in memory'''
+        envelopes = stream_band_envelopes(self._read_signal,
+                                          self.raw.n_times, self.raw.info['sfreq'], BANDS,
+                                          self.events[0, 0] - self.raw.first_samp,
+                                          self.events[-1, 0] - self.raw.first_samp, 25,
+                                          chunk_seconds=self.chunk_seconds, dtype=self.dtype)
+        self.bands = BandTensor(envelopes, BANDS.keys(), self.raw.ch_names)
+
+
+    @stage(produces=('bands',))
     def _crop_band_envelopes(self):
         if self.bands is not None:
-            for key in self.bands.keys():
-                self.bands[key] = self.bands[key][self.events[0, 0]:self.events[-1, 0]]
+            self.bands = self.bands.crop(self.events[0, 0] - self.raw.first_samp,
+                                         self.events[-1, 0] - self.raw.first_samp)
 
 
+    @stage(produces=('bands',))
     def _resample_band_envelopes(self):
         if self.bands is not None:
-            for key in self.bands.keys():
-                self.bands[key] = resample(self.bands[key], 25, int(self.raw.info['sfreq']))
+            self.bands = self.bands.resample(25, int(self.raw.info['sfreq']))
 
 
+    @stage(produces=('bands',))
     def _smooth_band_envelopes(self):
         if self.bands is not None:
-            for key in self.bands.keys():
-                self.bands[key] = np.apply_along_axis(smooth_signal, 0, self.bands[key], 5)
+            self.bands = self.bands.smooth(5)
 
 
+    @stage(produces=('band_block_means',))
     def _compute_block_means_per_band(self):
         if self.bands is not None:
-            self.band_block_means = OrderedDict.fromkeys(self.bands.keys())
-            for key in self.bands.keys():
-                band = zscore(self.bands[key][:self.expected_duration * 25])
-                band = band.reshape((-1, 750, band.shape[-1]))  # 13 blocks in chill or 6 in rest
-                self.band_block_means[key] = np.mean(band, 1)
+            # 13 blocks in chill or 6 in rest
+            self.band_block_means = self.bands.crop(0, self.expected_duration * 25).zscore().block_means(750)
 
 
 class FilmDataset(SubjectDataset):
@@ -209,6 +452,7 @@ class FilmDataset(SubjectDataset):
         super().__init__(input_root, subject, preload, **kwargs)
 
 
+    @instrumented()
     def run_task_gamma_ols(self, maxlag=25, alpha=5e-2):
         if self.bands is not None:
             design = np.hstack([np.zeros(30 * 25), np.ones(30 * 25)] * 7)[:-30 * 25]
@@ -219,17 +463,24 @@ class FilmDataset(SubjectDataset):
                                        'tvalue': ts,
                                        'lags': lags,
                                        'pvalue': ps})
+            if self.n_perm:
+                _, _, p, p_fwe = permutation_test_ols(design, self.bands['gamma'][:9750], maxlag, self.n_perm,
+                                                      self.permutation, seed=self.seed, jobs=self.perm_jobs)
+                ols_output['pvalue_perm'] = p
+                ols_output['pvalue_fwe'] = p_fwe
             print('OLS speech-music done')
             return ols_output
 
 
+    @instrumented()
     def run_task_r_squared(self):
         if self.bands is not None:
             n_bands = len(self.bands.keys())
             design = np.array([0, 1] * 7)[:-1]
-            r2s, ps = zip(*[calculate_r_squared(value, design[:, None]) for value in self.band_block_means.values()])
-            r2s = np.hstack(r2s)
-            ps = np.hstack(ps)
+            block_means = BandTensor.from_bands(self.band_block_means).data
+            r2s, ps = calculate_r_squared(block_means, design[:, None])
+            r2s = r2s.ravel()
+            ps = ps.ravel()
             r2_output = pd.DataFrame({'analysis': 'speech-music',
               'subject': self.subject,
               'name': self.raw.ch_names * n_bands,
@@ -237,6 +488,11 @@ class FilmDataset(SubjectDataset):
               'pvalue': ps,
               'band': [item for sublist in [[key] * len(self.raw.ch_names) for key in self.bands.keys()]
                                                                                                 for item in sublist]})
+            if self.n_perm:
+                _, p, p_fwe = permutation_test_r_squared(block_means, design, self.n_perm, self.seed,
+                                                         jobs=self.perm_jobs)
+                r2_output['pvalue_perm'] = p.ravel()
+                r2_output['pvalue_fwe'] = p_fwe.ravel()  # family-wise over channels within band
             print('R2 speech-music done')
             return r2_output
 
@@ -247,10 +503,8 @@ class RestDataset(SubjectDataset):
         self.expected_duration = 180
         super().__init__(input_root, subject, preload, **kwargs)
 
-        if preload:
-            self.set_rest_type()
-
-    def set_rest_type(self):
+    @lazy_property
+    def type_rest(self):
         bids_path = mne_bids.BIDSPath(subject=self.subject,
                                       extension='json',
                                       session=self.session,
@@ -261,6 +515,12 @@ class RestDataset(SubjectDataset):
                                       root=self.root)
         with open(str(bids_path).split('.')[0] + '.json') as json_file:
             metadata = json.load(json_file)
-        self.type_rest = metadata['TaskDescription']
+        return metadata['TaskDescription']
+
+
+    def set_rest_type(self):
+        '''Read type_rest from the sidecar now, rereading it if it was read before'''
+        self.__dict__.pop('type_rest', None)
+        self.type_rest
 
 
@@ -0,0 +1,58 @@
+'''
+Stage lifecycle of SubjectDataset: what each stage consumes and produces, release of consumed intermediates,
+memory budget checks and peak RSS per stage
+'''
+
+import warnings
+
+from functools import wraps
+
+from ieeg_fmri_validation.instrument import current_rss, peak_rss, reset_peak_rss, span, nbytes
+
+
+class RawMetadata(object):
+    '''Everything SubjectDataset uses from a released mne Raw except the signal'''
+    def __init__(self, raw):
+        self.info = raw.info
+        self.ch_names = raw.ch_names
+        self.first_samp = raw.first_samp
+        self.n_times = raw.n_times
+        self.annotations = raw.annotations
+
+
+def stage(consumes=(), produces=(), estimate=None, spill=False):
+    '''Decorate a SubjectDataset stage. estimate(self) returns the bytes the stage will allocate: if that exceeds
+    the headroom left under self.memory_budget by the current RSS, the stage runs with self._spill set when it
+    supports spilling to disk, otherwise it runs anyway with a warning. Unless self.keep_intermediates, the
+    attributes in consumes are released when the stage is done. Peak RSS of every stage is appended to
+    self.memory_report, and the stage is recorded by the instrumentation when enabled'''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            name = method.__name__.strip('_')
+            self._spill = False
+            if self.memory_budget is not None and estimate is not None:
+                needed = estimate(self)
+                headroom = max(self.memory_budget - current_rss(), 0)
+                if needed > headroom:
+                    if spill:
+                        self._spill = True
+                    else:
+                        warnings.warn('Stage ' + name + ' needs ~' + str(needed // 2 ** 20) + ' MB, ' +
+                                      str(headroom // 2 ** 20) + ' MB left of the memory budget of ' +
+                                      str(self.memory_budget // 2 ** 20) + ' MB')
+            with span(method.__qualname__, force=True, subject=self.subject, task=getattr(self, 'task', None),
+                      acquisition=self.acquisition, spilled=self._spill) as s:
+                result = method(self, *args, **kwargs)
+                s.nbytes = sum(nbytes(getattr(self, attribute, None)) for attribute in produces)
+            if not self.keep_intermediates:
+                for attribute in consumes:
+                    self._release(attribute)
+            self.memory_report.append({'stage': name, 'consumes': list(consumes), 'produces': list(produces),
+                                       'rss_before': s.rss_before, 'peak_rss': s.peak_rss, 'rss_after': current_rss(),
+                                       'spilled': self._spill})
+            return result
+        wrapper.consumes = consumes
+        wrapper.produces = produces
+        return wrapper
+    return decorator
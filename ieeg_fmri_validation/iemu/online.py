@@ -0,0 +1,253 @@
+'''
+Online speech/music mapping of the film task: raw samples are pushed as they are acquired, band envelopes are
+computed chunk by chunk from a ring buffer with the streaming filter bank (stream_band_envelopes), and the gamma OLS
+t-values and r2 of every band are updated from running sums. After each 30 s block the current channel map is
+available; once the film has ended the statistics equal those of the streamed offline analysis.
+
+Notch, band-pass and Hilbert filters are zero-phase, so an envelope sample is final once the padding of the
+streaming filters (a few seconds) has arrived after it: the map of a block is ready chunk_seconds plus that
+padding after the block ends. Both OLS t and Pearson r are invariant to the per-channel z-scoring of the offline
+analysis, so no statistic depends on data that has not arrived yet. With chunk_seconds as in the offline streaming
+analysis the results agree to rounding; shorter chunks move the chunk edges, which changes delta envelopes by up to
+1e-2 of their RMS (see stream_band_envelopes) and the other bands by less than 1e-4.
+
+python -m ieeg_fmri_validation.iemu.online
+    -i bids_dir
+    -s subject
+    [--acq clinical]
+    [--block_seconds .5]
+'''
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from collections import namedtuple
+from scipy import stats
+
+from ieeg_fmri_validation.iemu.routines import stream_plan, stream_chunk_envelopes, calculate_r_squared
+from ieeg_fmri_validation.iemu.classes import BANDS, FilmDataset
+
+# latency: seconds of signal received after the end of the block when its map was computed, seconds: compute time
+BlockUpdate = namedtuple('BlockUpdate', ['block', 'latency', 'seconds', 'ols', 'r2'])
+
+
+class RingBuffer(object):
+    '''Last capacity samples of a channels x time stream, addressed by absolute sample index'''
+    def __init__(self, n_channels, capacity, dtype=np.float64):
+        self.data = np.zeros((n_channels, capacity), dtype=dtype)
+        self.capacity = capacity
+        self.end = 0  # absolute index of the next sample
+
+    def append(self, x):
+        n = x.shape[1]
+        assert n <= self.capacity, 'Block longer than the buffer'
+        i = self.end % self.capacity
+        first = min(n, self.capacity - i)
+        self.data[:, i:i + first] = x[:, :first]
+        self.data[:, :n - first] = x[:, first:]
+        self.end += n
+
+    def get(self, a, b):
+        assert self.end - self.capacity <= a <= b <= self.end, 'Samples are no longer or not yet in the buffer'
+        return self.data[:, np.arange(a, b) % self.capacity]
+
+
+class OnlineFilm(object):
+    '''Speech/music statistics of a film run updated from blocks of raw samples (channels x time, in V) pushed in
+    recording order. start and stop are the samples of the first and the end marker; stop defaults to the film
+    length after start. push() returns a BlockUpdate for every 30 s block completed by the samples pushed'''
+    def __init__(self, ch_names, sfreq, start, stop=None, subject=None, bands=BANDS, maxlag=25, alpha=5e-2,
+                 expected_duration=390, chunk_seconds=2, notch_freqs=np.arange(50, 251, 50), dtype=np.float64):
+        self.ch_names = list(ch_names)
+        self.sfreq = sfreq
+        self.subject = subject
+        self.bands = bands
+        self.maxlag = maxlag
+        self.alpha = alpha
+        self.notch_freqs = notch_freqs
+        self.dtype = dtype
+        self.start = start
+        self.stop = start + int(round(expected_duration * sfreq)) if stop is None else stop
+        self.up, self.down, self.n_pad, self.n_chunk = stream_plan(sfreq, bands, 25, chunk_seconds)
+        self.n_out = -(-(self.stop - self.start) * self.up // self.down)
+        self.buffer = RingBuffer(len(self.ch_names), self.n_chunk + 2 * self.n_pad)
+        self.next_chunk = start  # first sample of the next chunk to compute
+        self.n_envelopes = 0  # envelope samples at 25 Hz computed so far
+
+        # block design of run_task_gamma_ols and run_task_r_squared
+        self.block_length = 30 * 25
+        self.n_blocks = expected_duration // 30
+        self.design = np.hstack([np.zeros(self.block_length), np.ones(self.block_length)] *
+                                (self.n_blocks // 2 + 1))[:self.n_blocks * self.block_length]
+        self.lagged = np.stack([np.roll(self.design, i) for i in range(maxlag)])
+        self.block_design = np.array([0, 1] * (self.n_blocks // 2 + 1))[:self.n_blocks]
+
+        # running sums: gamma envelopes shifted by their first value against every lag of the design, block sums
+        n_ch = len(self.ch_names)
+        self.shift = None
+        self.sy = np.zeros(n_ch)
+        self.syy = np.zeros(n_ch)
+        self.sxy = np.zeros((maxlag, n_ch))
+        self.block_sums = np.zeros((len(bands), self.n_blocks, n_ch))
+        self.blocks_done = 0
+        self.updates = []
+
+    def push(self, x):
+        '''Append samples x (channels x time) and compute every chunk whose padding has arrived'''
+        started = time.perf_counter()
+        updates = []
+        i = 0
+        while i < x.shape[1]:
+            # never append past the end of the next chunk's padding, so its samples are still in the buffer
+            n = min(self._needed(), self.buffer.capacity)
+            self.buffer.append(x[:, i:i + n])
+            i += n
+            while self._needed() <= 0:
+                updates.extend(self._compute_chunk(self.buffer.end))
+        return self._record(updates, started)
+
+    def _needed(self):
+        '''Samples still missing for the next chunk, the buffer capacity once all chunks are computed'''
+        if self.next_chunk >= self.stop:
+            return self.buffer.capacity
+        return min(self.next_chunk + self.n_chunk, self.stop) + self.n_pad - self.buffer.end
+
+    def finish(self):
+        '''Compute the remaining chunks at the end of the recording, reflecting it as the offline analysis does'''
+        started = time.perf_counter()
+        updates = []
+        while self.next_chunk < self.stop:
+            updates.extend(self._compute_chunk(self.buffer.end))
+        return self._record(updates, started)
+
+    def _record(self, updates, started):
+        seconds = time.perf_counter() - started
+        updates = [update._replace(seconds=seconds) for update in updates]
+        self.updates.extend(updates)
+        return updates
+
+    def _compute_chunk(self, n_times):
+        s = self.next_chunk
+        e = min(s + self.n_chunk, self.stop)
+        a, b = s - self.n_pad, e + self.n_pad
+        x = stream_chunk_envelopes(self.buffer.get(max(a, 0), min(b, n_times)), a, b, n_times, self.start,
+                                   self.stop, self.sfreq, self.bands, self.up, self.down, self.notch_freqs,
+                                   self.dtype)
+        i0 = (s - self.start) * self.up // self.down
+        i1 = min(-(-(e - self.start) * self.up // self.down), self.n_out)
+        offset = self.n_pad * self.up // self.down
+        self._update(x[:, offset:offset + i1 - i0], i0)
+        self.next_chunk = e
+        self.n_envelopes = i1
+
+        updates = []
+        while self.blocks_done < self.n_blocks and (self.blocks_done + 1) * self.block_length <= i1:
+            block_end = self.start + (self.blocks_done + 1) * self.block_length * self.down // self.up
+            self.blocks_done += 1
+            updates.append(BlockUpdate(self.blocks_done, (self.buffer.end - block_end) / self.sfreq, None,
+                                       self.gamma_ols(), self.r_squared()))
+        return updates
+
+    def _update(self, envelopes, i0):
+        '''Add envelope samples i0:i0 + len (bands x time x channels) to the running sums'''
+        i1 = min(i0 + envelopes.shape[1], len(self.design))
+        if i1 <= i0:
+            return
+        envelopes = envelopes[:, :i1 - i0].astype(np.float64)
+        gamma = envelopes[list(self.bands.keys()).index('gamma')]
+        if self.shift is None:
+            self.shift = gamma[0].copy()  # running sums of y - shift avoid cancellation in syy - sy ** 2 / n
+        y = gamma - self.shift
+        self.sy += y.sum(0)
+        self.syy += np.einsum('ij,ij->j', y, y)
+        self.sxy += self.lagged[:, i0:i1] @ y
+        blocks = np.arange(i0, i1) // self.block_length
+        np.add.at(self.block_sums, (slice(None), blocks), envelopes)
+
+    def _ols(self):
+        n = min(self.n_envelopes, len(self.design))
+        sx = self.lagged[:, :n].sum(1)[:, None]  # binary design: sum of squares equals sum
+        sxx = sx - sx ** 2 / n
+        sxy = self.sxy - sx * self.sy[None] / n
+        syy = self.syy - self.sy ** 2 / n
+        df = n - 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.clip(sxy / np.sqrt(sxx * syy[None]), -1, 1)
+            t = r * np.sqrt(df / (1 - r ** 2))
+        t = np.where(np.isnan(t), -np.inf, t)
+        lags = np.argmax(t, 0)
+        ts = t[lags, np.arange(t.shape[1])]
+        ps = 2 * stats.t.sf(np.abs(ts), df) if df > 0 else np.full(len(ts), np.nan)
+        return np.where(np.isinf(ts), np.nan, ts), lags, ps
+
+    def gamma_ols(self):
+        '''Best-lag t of gamma on the block design so far, as FilmDataset.run_task_gamma_ols'''
+        ts, lags, ps = self._ols()
+        return pd.DataFrame({'subject': self.subject,
+                             'name': self.ch_names,
+                             'tvalue': ts,
+                             'lags': lags,
+                             'pvalue': ps})
+
+    def block_means(self):
+        '''Means of the completed blocks, bands x blocks x channels'''
+        return self.block_sums[:, :self.blocks_done] / self.block_length
+
+    def r_squared(self):
+        '''Signed r2 of the completed block means of every band and the block design, as
+        FilmDataset.run_task_r_squared. NaN until three blocks are complete'''
+        n_ch = len(self.ch_names)
+        if self.blocks_done < 3:
+            r2s = ps = np.full(len(self.bands) * n_ch, np.nan)
+        else:
+            r2s, ps = calculate_r_squared(self.block_means(), self.block_design[:self.blocks_done, None])
+        return pd.DataFrame({'analysis': 'speech-music',
+                             'subject': self.subject,
+                             'name': self.ch_names * len(self.bands),
+                             'r2': np.ravel(r2s),
+                             'pvalue': np.ravel(ps),
+                             'band': [key for key in self.bands.keys() for _ in range(n_ch)]})
+
+    def significant(self):
+        '''Channels with significant positive gamma t so far, Bonferroni corrected as run_OLS_block_design'''
+        ts, _, ps = self._ols()
+        return [name for name, t, p in zip(self.ch_names, ts, ps)
+                if t > 0 and p < self.alpha / len(self.ch_names) / self.maxlag]
+
+
+def replay(film, block_seconds=.5, **kwargs):
+    '''Feed the film recording of FilmDataset film to OnlineFilm in blocks of block_seconds, as it would arrive
+    during acquisition, with the channels the offline analysis keeps. Returns the OnlineFilm, finished'''
+    film._discard_bad_electrodes()
+    film._read_events()
+    sfreq = film.raw.info['sfreq']
+    online = OnlineFilm(film.raw.ch_names, sfreq, film.events[0, 0] - film.raw.first_samp,
+                        film.events[-1, 0] - film.raw.first_samp, subject=film.subject,
+                        expected_duration=film.expected_duration, **kwargs)
+    block = max(int(block_seconds * sfreq), 1)
+    for start in range(0, film.raw.n_times, block):
+        online.push(film._read_signal(start, min(start + block, film.raw.n_times)))
+    online.finish()
+    return online
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bids_dir', '-i', type=str)
+    parser.add_argument('--subject', '-s', type=str)
+    parser.add_argument('--acq', type=str, default='clinical')
+    parser.add_argument('--block_seconds', type=float, default=.5)
+    parser.add_argument('--chunk_seconds', type=float, default=2)
+    args = parser.parse_args()
+
+    film = FilmDataset(args.bids_dir, args.subject, acquisition=args.acq)
+    online = replay(film, args.block_seconds, chunk_seconds=args.chunk_seconds)
+    for update in online.updates:
+        top = update.ols.sort_values('tvalue', ascending=False).head(3)
+        print('Block ' + str(update.block) + ': latency ' + str(round(update.latency, 2)) + ' s, computed in ' +
+              str(round(update.seconds, 3)) + ' s, top t ' +
+              ', '.join(name + ' ' + str(round(t, 1)) for name, t in zip(top['name'], top['tvalue'])))
+    print('Significant: ' + str(online.significant()))
@@ -0,0 +1,152 @@
+'''
+Permutation and circular-shift nulls for the block-design statistics, with max-statistic family-wise error
+correction. Every surrogate design is evaluated against all channels and lags at once: the lagged OLS t of a
+centered design depends on the data only through the cross-products sxy, which are
+    circular shifts: one FFT cross-correlation per channel gives sxy for every shift, lag i of shift s is shift s + i
+    block permutations: sxy = labels @ S with S (lags, blocks, channels) the per-block sums of the lagged data
+'''
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from scipy import fft as sp_fft
+
+from ieeg_fmri_validation.utils import zscore
+
+
+def _t_from_sxy(sxy, sxx, syy, df):
+    '''Slope t of OLS with intercept from centered cross-products, as lagged_ols'''
+    r = np.clip(sxy / np.sqrt(sxx * syy), -1, 1)
+    with np.errstate(divide='ignore'):
+        return r * np.sqrt(df / (1 - r ** 2))
+
+
+def _seeds(seed, n):
+    return np.random.SeedSequence(seed).spawn(n)
+
+
+def _chunks(n, chunk):
+    return [min(chunk, n - start) for start in range(0, n, chunk)]
+
+
+def _map(func, args, jobs):
+    if jobs == 1:
+        return [func(*a) for a in args]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, *zip(*args)))
+
+
+def _p_values(observed, null, null_max):
+    '''Per test (null: permutations x tests) and family-wise (null_max: max over tests) permutation p-values,
+    counting the observed statistic as one permutation'''
+    n = null.shape[0]
+    p = (1 + np.sum(null >= observed[None], 0)) / (n + 1)
+    p_fwe = (1 + np.sum(null_max[:, None] >= observed[None], 0)) / (n + 1)
+    return p, p_fwe
+
+
+def block_sums(Y, maxlag, block_length):
+    '''S[i, b, c] = sum of Y[:, c] rolled back by lag i over the samples of block b: sxy of roll(x, i) and Y for a
+    design x that is constant per block is x_blocks @ S[i]'''
+    n = Y.shape[0]
+    n_blocks = n // block_length
+    cumsum = np.concatenate([np.zeros((1, Y.shape[1])), np.cumsum(np.concatenate([Y, Y[:maxlag]]), 0)])
+    edges = np.arange(n_blocks + 1) * block_length
+    S = np.empty((maxlag, n_blocks, Y.shape[1]))
+    for i in range(maxlag):
+        S[i] = cumsum[edges[1:] + i] - cumsum[edges[:-1] + i]  # sum_u in block Y[u + i], as x[t - i] Y[t]
+    return S
+
+
+def _block_null_chunk(S, labels, sxx, syy, df, seed, size):
+    rng = np.random.default_rng(seed)
+    perms = np.array([rng.permutation(labels) for _ in range(size)], dtype=np.float64)
+    t = _t_from_sxy(np.einsum('pb,ibc->pic', perms, S), sxx, syy, df)
+    return t.max(1)  # permutations x channels, best lag
+
+
+def block_permutation_null(x, Y, maxlag, block_length=750, n_perm=10000, seed=0, chunk=1000, jobs=1):
+    '''Null of the best-lag t per channel when the block labels of x are permuted. x must be constant within
+    blocks of block_length samples. Returns the observed t per channel, the null (permutations x channels) and the
+    observed best lags. With 13 blocks there are only 1716 distinct labelings, so p-values below ~6e-4 cannot be
+    resolved however many permutations are drawn'''
+    Y = zscore(np.asarray(Y, dtype=np.float64))
+    n = len(x)
+    labels = np.asarray(x[:n - n % block_length], dtype=np.float64).reshape(-1, block_length)
+    assert np.all(labels == labels[:, :1]), 'Design is not constant within blocks'
+    labels = labels[:, 0]
+    S = block_sums(Y[:len(labels) * block_length], maxlag, block_length)
+    sxx = np.sum((np.repeat(labels, block_length) - labels.mean()) ** 2)
+    syy = np.sum(Y[:len(labels) * block_length] ** 2, 0)
+    df = len(labels) * block_length - 2
+
+    observed_t = _t_from_sxy(np.einsum('b,ibc->ic', labels, S), sxx, syy, df)
+    seeds = _seeds(seed, len(_chunks(n_perm, chunk)))
+    null = _map(_block_null_chunk, [(S, labels, sxx, syy, df, s, size)
+                                    for s, size in zip(seeds, _chunks(n_perm, chunk))], jobs)
+    return observed_t.max(0), np.concatenate(null), observed_t.argmax(0)
+
+
+def circular_shift_null(x, Y, maxlag, n_perm=10000, min_shift=None, seed=0, chunk=1000):
+    '''Null of the best-lag t per channel under circular shifts of x by at least min_shift samples (default
+    maxlag) from either end, drawn without replacement when n_perm is smaller than the number of shifts, else all
+    shifts. The cross-correlation with every shift comes from one FFT per channel. Returns the observed t per
+    channel, the null (shifts x channels) and the observed best lags'''
+    Y = zscore(np.asarray(Y, dtype=np.float64))
+    n = len(x)
+    xc = np.asarray(x, dtype=np.float64) - np.mean(x)
+    sxx = np.sum(xc ** 2)
+    syy = np.sum(Y ** 2, 0)
+    # c[k] = sum_t x[t - k] Y[t], the sxy of np.roll(x, k); no padding, shifts are circular on n samples
+    c = sp_fft.irfft(np.conj(sp_fft.rfft(xc))[:, None] * sp_fft.rfft(Y, axis=0), n, axis=0)
+    observed = c[:maxlag]
+
+    min_shift = maxlag if min_shift is None else min_shift
+    candidates = np.arange(min_shift, n - min_shift - maxlag + 1)
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    shifts = candidates if n_perm >= len(candidates) else rng.choice(candidates, n_perm, replace=False)
+    null = np.empty((len(shifts), Y.shape[1]))
+    for start in range(0, len(shifts), chunk):
+        s = shifts[start:start + chunk]
+        null[start:start + chunk] = c[s[:, None] + np.arange(maxlag)].max(1)
+    df = n - 2
+    return _t_from_sxy(observed, sxx, syy, df).max(0), _t_from_sxy(null, sxx, syy, df), observed.argmax(0)
+
+
+def permutation_test_ols(x, Y, maxlag, n_perm=10000, method='block', block_length=750, seed=0, chunk=1000, jobs=1):
+    '''Best-lag t per channel of run_OLS_block_design with permutation p-values, uncorrected and family-wise
+    corrected over channels and lags with the max statistic. method 'block' permutes block labels, 'circular'
+    shifts the design. Returns ts, lags, p, p_fwe'''
+    if method == 'block':
+        ts, null, lags = block_permutation_null(x, Y, maxlag, block_length, n_perm, seed, chunk, jobs)
+    elif method == 'circular':
+        ts, null, lags = circular_shift_null(x, Y, maxlag, n_perm, seed=seed, chunk=chunk)
+    else:
+        raise ValueError("method must be 'block' or 'circular', not " + repr(method))
+    p, p_fwe = _p_values(ts, null, null.max(1))
+    return ts, lags, p, p_fwe
+
+
+def _r_null_chunk(design, A, seed, size):
+    rng = np.random.default_rng(seed)
+    perms = np.array([rng.permutation(design) for _ in range(size)])
+    return np.abs(np.einsum('ps,...sc->p...c', perms, A))
+
+
+def permutation_test_r_squared(a, design, n_perm=10000, seed=0, chunk=1000, jobs=1):
+    '''Signed r2 of calculate_r_squared between columns of a (..., samples, channels) and design (samples,) with
+    two-sided permutation p-values from permuting design, uncorrected and family-wise corrected over channels
+    (the last axis) by the max |r|. Returns r2, p, p_fwe'''
+    a = np.asarray(a, dtype=np.float64)
+    design = np.asarray(design, dtype=np.float64).ravel()
+    A = a - a.mean(-2, keepdims=True)
+    A = A / np.sqrt(np.sum(A ** 2, -2, keepdims=True))
+    design = design - design.mean()
+    design = design / np.sqrt(np.sum(design ** 2))
+    r = np.einsum('s,...sc->...c', design, A)
+
+    seeds = _seeds(seed, len(_chunks(n_perm, chunk)))
+    null = np.concatenate(_map(_r_null_chunk, [(design, A, s, size)
+                                               for s, size in zip(seeds, _chunks(n_perm, chunk))], jobs))
+    p, p_fwe = _p_values(np.abs(r), null, null.max(-1)[..., None])
+    return np.sign(r) * r ** 2, p, p_fwe
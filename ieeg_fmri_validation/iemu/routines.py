@@ -1,13 +1,184 @@
+import mne
 import numpy as np
 import statsmodels.api as sm
 import pandas as pd
 
-from ieeg_fmri_validation.utils import zscore
-from scipy.stats import pearsonr
+from ieeg_fmri_validation.utils import zscore, _resample_filter
+from ieeg_fmri_validation.iemu.bands import BandTensor, common_channels
+from ieeg_fmri_validation.instrument import instrumented
+from fractions import Fraction
+from functools import lru_cache
+from scipy import fft as sp_fft
+from scipy.signal import resample_poly
+from scipy import stats, special
 
 
-def run_OLS_block_design(x, Y, maxlag=0, alpha=1e-2):
-    Y = zscore(Y)
+@lru_cache(maxsize=None)
+def _band_filters(sfreq, edges):
+    '''MNE's default FIR band-pass filters for the (l_freq, h_freq) in edges, designed once per sampling rate'''
+    filters = tuple(mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False) for l_freq, h_freq in edges)
+    for h in filters:
+        h.flags.writeable = False
+    return filters
+
+
+def band_filter_length(sfreq, bands):
+    '''Length of the longest of MNE's default FIR band-pass filters for bands'''
+    return max([len(h) for h in _band_filters(sfreq, tuple(map(tuple, bands.values())))])
+
+
+def notch_filter_length(sfreq, trans_bandwidth=1):
+    '''Length of MNE's default FIR notch filter: hamming window, 3.3 / transition band, split over both sides'''
+    return int(round(3.3 * sfreq / (trans_bandwidth / 2.))) // 2 * 2 + 1
+
+
+def band_filter_masks(sfreq, bands, n_fft):
+    '''Zero-phase amplitude responses of MNE's default FIR band-pass filters on the rfft grid of length n_fft,
+    multiplied by the analytic signal weights (1 at DC and Nyquist, 2 for positive frequencies)'''
+    masks = []
+    for h in _band_filters(sfreq, tuple(map(tuple, bands.values()))):
+        h_zero = np.zeros(n_fft)
+        h_zero[:len(h)] = h
+        h_zero = np.roll(h_zero, -(len(h) - 1) // 2)  # center the symmetric filter on sample 0
+        masks.append(sp_fft.rfft(h_zero).real)
+    masks = np.array(masks)
+    masks[:, 1:(n_fft + 1) // 2] *= 2
+    return masks
+
+
+ENVELOPE_CHUNK = 16  # channels transformed at once by compute_band_envelopes
+
+
+def _envelope_fft_size(n_times, sfreq, bands):
+    '''Reflection padding and FFT length of compute_band_envelopes for n_times samples'''
+    n_pad = min(band_filter_length(sfreq, bands) - 1, n_times - 1)
+    return n_pad, sp_fft.next_fast_len(n_times + 2 * n_pad, real=True)
+
+
+def band_envelope_work_bytes(n_channels, n_times, sfreq, bands, chunk=ENVELOPE_CHUNK):
+    '''Bytes of the work buffers compute_band_envelopes holds besides its output: for one chunk of channels the
+    padded signal, its rfft, one masked spectrum, its analytic signal and that signal's envelope'''
+    n_pad, n_fft = _envelope_fft_size(n_times, sfreq, bands)
+    n_spectrum = n_fft // 2 + 1
+    return min(chunk, n_channels) * (8 * (n_times + 2 * n_pad) + 2 * 16 * n_spectrum + 16 * n_fft + 8 * n_times)
+
+
+def compute_band_envelopes(data, sfreq, bands, chunk=ENVELOPE_CHUNK, workers=-1, out=None):
+    '''Hilbert envelopes of data (channels x time) in all bands from a single forward FFT per channel.
+
+    Each channel is odd-reflection padded by the longest filter length, as MNE does before FIR filtering,
+    transformed once with an rfft of next fast length and multiplied by every band mask from
+    band_filter_masks; the analytic signal of each band is one inverse FFT.
+
+    Comparison with filter().apply_hilbert(envelope=True): band-passed signals agree to 1e-15. Envelopes differ
+    because apply_hilbert takes a circular FFT of the unpadded filtered signal and the wrap-around discontinuity
+    leaks into the whole recording with ~1/t decay. On 300 s of white noise at 2048 Hz the maximal difference
+    relative to envelope RMS is, 10 s / 60 s away from either edge: delta 1e-1 / 2e-2, theta 7e-3 / 1e-3,
+    alpha 3e-3 / 5e-4, beta 1e-3 / 2e-4, gamma 2e-4 / 3e-5.
+    Returns an array of bands x time x channels, written to out if given'''
+    n_ch, n_times = data.shape
+    n_pad, n_fft = _envelope_fft_size(n_times, sfreq, bands)
+    masks = band_filter_masks(sfreq, bands, n_fft)
+
+    envelopes = np.empty((len(bands), n_times, n_ch), dtype=data.dtype) if out is None else out
+    for start in range(0, n_ch, chunk):
+        x = np.pad(data[start:start + chunk], ((0, 0), (n_pad, n_pad)), 'reflect', reflect_type='odd')
+        x = sp_fft.rfft(x, n_fft, axis=-1, workers=workers)
+        for i, mask in enumerate(masks):
+            analytic = sp_fft.ifft(x * mask, n_fft, axis=-1, workers=workers)
+            envelopes[i, :, start:start + chunk] = np.abs(analytic[:, n_pad:n_pad + n_times]).T
+    return envelopes
+
+
+def stream_band_envelopes(read, n_times, sfreq, bands, start, stop, target_sfreq=25,
+                          notch_freqs=np.arange(50, 251, 50), chunk_seconds=60, dtype=np.float32):
+    '''Notch filter, common average reference, band envelopes and resampling to target_sfreq of samples
+    start:stop, computed in chunks of chunk_seconds so that only one chunk of raw data is in memory at a time.
+
+    read(a, b) must return the channels x samples of the recording (n_times long) between a and b. Chunks are
+    read with padding covering the notch, band-pass (including the Hilbert tail) and resampling filters on both
+    sides and only their core is kept (overlap-save). Cores start at multiples of the decimation factor from
+    start, so the output equals resample(compute_band_envelopes(...)[:, start:stop]) of the whole recording,
+    including the zero extension resample_poly applies outside start:stop. Data beyond the recording edges is
+    odd-reflected. The Hilbert transform is not local, so chunk joins differ from the whole-recording envelopes
+    by the analytic tail beyond the padding: on white noise at 2048 Hz the maximum difference relative to
+    envelope RMS is 1e-2 for delta (its pass band reaches down to DC) and below 1e-4 for the other bands.
+    Returns an array of bands x resampled time x channels'''
+    up, down, n_pad, n_chunk = stream_plan(sfreq, bands, target_sfreq, chunk_seconds)
+    n_out = -(-(stop - start) * up // down)
+
+    envelopes = None
+    for s in range(start, stop, n_chunk):
+        e = min(s + n_chunk, stop)
+        a, b = s - n_pad, e + n_pad
+        x = stream_chunk_envelopes(read(max(a, 0), min(b, n_times)), a, b, n_times, start, stop, sfreq, bands,
+                                   up, down, notch_freqs, dtype)
+
+        i0 = (s - start) * up // down
+        i1 = min(-(-(e - start) * up // down), n_out)
+        if envelopes is None:
+            envelopes = np.zeros((x.shape[0], n_out, x.shape[-1]), dtype=dtype)
+        envelopes[:, i0:i1] = x[:, n_pad * up // down:n_pad * up // down + i1 - i0]
+    return envelopes
+
+
+def stream_plan(sfreq, bands, target_sfreq=25, chunk_seconds=60):
+    '''Resampling factors up and down, padding and chunk length in samples of stream_band_envelopes. Padding and
+    chunk length are multiples of down'''
+    frac = Fraction(target_sfreq, int(sfreq))
+    up, down = frac.numerator, frac.denominator
+    n_resample = 10 * max(up, down) // up + 1
+    n_pad = (notch_filter_length(sfreq) + band_filter_length(sfreq, bands)) // 2 + n_resample
+    n_pad = int(np.ceil(n_pad / down)) * down
+    n_chunk = max(int(chunk_seconds * sfreq) // down, 1) * down
+    return up, down, n_pad, n_chunk
+
+
+def stream_chunk_envelopes(x, a, b, n_times, start, stop, sfreq, bands, up, down,
+                           notch_freqs=np.arange(50, 251, 50), dtype=np.float32):
+    '''Resampled envelopes of one padded chunk of stream_band_envelopes: x holds samples max(a, 0):min(b, n_times)
+    of the recording, a:b is the chunk with its padding. Returns bands x resampled a:b x channels'''
+    x = np.pad(x, ((0, 0), (max(-a, 0), max(b - n_times, 0))), 'reflect', reflect_type='odd')
+    x = mne.filter.notch_filter(x, sfreq, notch_freqs, verbose=False)
+    x -= np.mean(x, 0, keepdims=True)
+    x = compute_band_envelopes(x.astype(dtype, copy=False), sfreq, bands)
+    x[:, :max(start - a, 0)] = 0  # resample_poly zero-extends the cropped envelopes
+    x[:, x.shape[1] - max(b - stop, 0):] = 0
+    return resample_poly(x, up, down, axis=1, window=_resample_filter(up, down, np.dtype(np.float64)))
+
+
+def lagged_ols(x, Y, maxlag):
+    '''Closed-form OLS of every column of Y on [1, np.roll(x, i)] for all lags i < maxlag at once.
+    Returns F, p(F), t, p(t) and betas laid out as in the statsmodels loop: (channels, lags) for F and
+    (channels, lags, 2) for t, p(t) and betas, intercept first'''
+    n = x.shape[0]
+    X = np.stack([np.roll(x, i) for i in range(maxlag)]).astype(np.float64)  # lags x time
+    Y = np.asarray(Y, dtype=np.float64)
+    x_mean = X.mean(1)[:, None]
+    y_mean = Y.mean(0)[None]
+    Xc = X - x_mean
+    Yc = Y - y_mean
+    sxx = np.einsum('ij,ij->i', Xc, Xc)[:, None]
+    syy = np.einsum('ij,ij->j', Yc, Yc)[None]
+    sxy = Xc @ Yc  # lags x channels, all regressions in one call
+
+    df = n - 2
+    b1 = sxy / sxx
+    b0 = y_mean - b1 * x_mean
+    sigma2 = np.maximum(syy - b1 * sxy, 0) / df
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = b1 / np.sqrt(sigma2 / sxx)
+        t0 = b0 / np.sqrt(sigma2 * (1 / n + x_mean ** 2 / sxx))
+    f = t1 ** 2
+    fp = stats.f.sf(f, 1, df)
+    ts = np.stack([t0, t1], -1)
+    tps = 2 * stats.t.sf(np.abs(ts), df)
+    w = np.stack([b0, b1], -1)
+    return f.T, fp.T, ts.transpose(1, 0, 2), tps.transpose(1, 0, 2), w.transpose(1, 0, 2)
+
+
+def lagged_ols_statsmodels(x, Y, maxlag):
+    '''Reference implementation of lagged_ols: one statsmodels fit per channel per lag'''
     sm_f, sm_fp, sm_ts, sm_tps, sm_w = [], [], [], [], []
     for e in range(Y.shape[-1]):
         sm_f.append([])
@@ -24,15 +195,33 @@ def run_OLS_block_design(x, Y, maxlag=0, alpha=1e-2):
             sm_ts[-1].append(est2.tvalues)
             sm_tps[-1].append(est2.pvalues)
             sm_w[-1].append(est2.params)
-    sm_f, sm_fp, sm_ts, sm_tps, sm_w = np.array(sm_f), np.array(sm_fp), np.array(sm_ts), np.array(sm_tps), np.array(
-        sm_w)
+    return np.array(sm_f), np.array(sm_fp), np.array(sm_ts), np.array(sm_tps), np.array(sm_w)
+
+
+def check_lagged_ols(x, Y, maxlag, rtol=1e-6, atol=1e-8):
+    '''Compare lagged_ols against the statsmodels path, raises AssertionError on mismatch'''
+    Y = zscore(Y)
+    names = ['F', 'F p-values', 't-values', 't p-values', 'betas']
+    for name, a, b in zip(names, lagged_ols(x, Y, maxlag), lagged_ols_statsmodels(x, Y, maxlag)):
+        assert np.allclose(a, b, rtol=rtol, atol=atol), name + ' differ: max abs diff ' + \
+                                                        str(np.nanmax(np.abs(a - b)))
+
+
+def run_OLS_block_design(x, Y, maxlag=0, alpha=1e-2, engine='batched'):
+    Y = zscore(Y)
+    if engine == 'batched':
+        sm_f, sm_fp, sm_ts, sm_tps, sm_w = lagged_ols(x, Y, maxlag)
+    elif engine == 'statsmodels':
+        sm_f, sm_fp, sm_ts, sm_tps, sm_w = lagged_ols_statsmodels(x, Y, maxlag)
+    else:
+        raise ValueError("engine must be 'batched' or 'statsmodels', not " + repr(engine))
 
     sm_ts = sm_ts[:, :, -1]  # 0 is intercept
     sm_tps = sm_tps[:, :, -1]
 
     ts = np.max(sm_ts, 1)
     lags = np.argmax(sm_ts, 1)
-    ps = np.array([sm_tps[counter, i] for counter, i in enumerate(lags)])
+    ps = sm_tps[np.arange(len(lags)), lags]
 
     inds1 = np.where(ps < alpha / Y.shape[-1] / maxlag)[0]
     inds2 = np.where(ts > 0)[0]
@@ -43,59 +232,56 @@ def run_OLS_block_design(x, Y, maxlag=0, alpha=1e-2):
 
 
 def calculate_r_squared(a, b):
-    if b.shape[1] == 1:
-        b = np.repeat(b, a.shape[1], axis=1)
-    elif a.shape[1] == 1:
-        a = np.repeat(a, b.shape[1], axis=1)
-    r = np.zeros((a.shape[-1]))
-    p = np.zeros_like(r)
-    for i, (ia, ib) in enumerate(zip(a.T, b.T)):
-        r[i], p[i] = pearsonr(ia, ib)
+    '''Signed r2 and two-sided p-values of Pearson correlations between columns of a and b along the
+    second to last axis (samples). Single columns and leading axes (e.g. bands) broadcast. Both are centred in
+    the dtype of a (float64 unless a is floating), so a float32 a is not upcast by a float64 design b; the sums
+    are returned in float64'''
+    a, b = np.asarray(a), np.asarray(b)
+    dtype = a.dtype if np.issubdtype(a.dtype, np.floating) else np.float64
+    a = a - np.mean(a, -2, keepdims=True, dtype=dtype).astype(dtype)
+    b = b.astype(dtype, copy=False) - np.mean(b, -2, keepdims=True, dtype=np.float64).astype(dtype)
+    n = np.broadcast_shapes(a.shape, b.shape)[-2]
+
+    sab = np.einsum('...ti,...ti->...i', a, b).astype(np.float64)
+    saa = np.einsum('...ti,...ti->...i', a, a).astype(np.float64)
+    sbb = np.einsum('...ti,...ti->...i', b, b).astype(np.float64)
+    r = np.clip(sab / np.sqrt(saa * sbb), -1, 1)
+
+    df = n - 2
+    p = special.betainc(df / 2, .5, np.clip(1 - r ** 2, 0, 1))
     return np.sign(r)*(r** 2), p
 
 
+@instrumented()
 def run_rest_speech_r_squared(film, rest):
-    def run_per_band(key):
-        film_band = film.bands[key][:film.expected_duration * 25]
-        film_band = film_band.reshape((-1, 750, 1, film_band.shape[-1])) # 25 & 30
-        film_band = pd.DataFrame(film_band[1::2].squeeze().reshape((-1, film_band.shape[-1])).T)
-
-        rest_band = pd.DataFrame(rest.bands[key][:rest.expected_duration * 25].T)
-
-        film_band.index = film.raw.ch_names
-        rest_band.index = rest.raw.ch_names
-        common = film_band.index.intersection(rest_band.index)
-        c_ = film_band.loc[common].values
-        r_ = rest_band.loc[common].values
-
-        # normalize together
-        temp = np.hstack([c_, r_])
-        mean_common = np.mean(temp, 1, keepdims=True)
-        std_common = np.std(temp, 1, keepdims=True)
-        c_z = (c_ - mean_common) / std_common
-        r_z = (r_ - mean_common) / std_common
-        c_zm = np.mean(c_z.reshape((c_z.shape[0], -1, 750)), -1)  # means per block
-        r_zm = np.mean(r_z.reshape((r_z.shape[0], -1, 750)), -1)  # means per block
-        r, p = calculate_r_squared(np.vstack([r_zm.T, c_zm.T]), design[:, None])
-        return r, p, c_zm, r_zm
-
-    n_bands = len(film.band_block_means.keys())
-    film_band = pd.DataFrame(film.band_block_means['gamma'].T)
-    film_band.index = film.raw.ch_names
-    rest_band = pd.DataFrame(rest.band_block_means['gamma'].T)
-    rest_band.index = rest.raw.ch_names
-    common = film_band.index.intersection(rest_band.index)
+    '''Signed r2 of speech (every second film block) against rest block means of the channels in both, all bands
+    at once. Film and rest envelopes of each channel are z-scored together'''
+    film_bands = BandTensor.from_bands(film.bands, film.raw.ch_names)
+    rest_bands = BandTensor.from_bands(rest.bands, rest.raw.ch_names)
+    common, film_index, rest_index = common_channels(film.raw.ch_names, rest.raw.ch_names)
+    n_bands = len(film_bands)
+
+    c_ = film_bands.data[:, :film.expected_duration * 25]
+    c_ = c_.reshape((n_bands, -1, 750, c_.shape[-1]))[:, 1::2].reshape((n_bands, -1, c_.shape[-1]))[..., film_index]
+    r_ = rest_bands.data[:, :rest.expected_duration * 25][..., rest_index]
+
+    # normalize together
+    temp = np.concatenate([c_, r_], 1)
+    mean_common = np.mean(temp, 1, keepdims=True, dtype=np.float64)
+    std_common = np.std(temp, 1, keepdims=True, dtype=np.float64)
+    c_zm = BandTensor((c_ - mean_common) / std_common, film_bands.bands).block_means(750).data  # means per block
+    r_zm = BandTensor((r_ - mean_common) / std_common, film_bands.bands).block_means(750).data
 
     design = np.array([0] * 1 * 6 + [1] * 1 * 6)
-    r2s, ps, cs, rs = zip(*[run_per_band(key) for key in film.band_block_means.keys()])
-    r2s = np.hstack(r2s)
-    ps = np.hstack(ps)
+    r2s, ps = calculate_r_squared(np.concatenate([r_zm, c_zm], 1), design[:, None])
+    r2s = r2s.ravel()
+    ps = ps.ravel()
     r2_output = pd.DataFrame({'analysis': 'speech-' + rest.type_rest,
                               'subject': film.subject,
-                              'name': list(common.values) * n_bands,
+                              'name': common * n_bands,
                               'r2': r2s,
                               'pvalue': ps,
-                              'band': [item for sublist in [[key] * len(common) for key in film.band_block_means.keys()]
+                              'band': [item for sublist in [[key] * len(common) for key in film_bands.bands]
                                        for item in sublist]})
     print('R2 speech-rest done')
     return r2_output
@@ -0,0 +1,264 @@
+'''
+Stage instrumentation: wall time, CPU time, peak RSS and array sizes per stage and subject, written as JSON lines
+and convertible to Chrome trace format (chrome://tracing, Perfetto). Enabled with enable(path) or the environment
+variable IEEG_FMRI_TRACE=path, which processes started afterwards inherit, so pool workers append to the same file.
+When disabled, span() and instrumented() cost one attribute lookup
+
+python -m ieeg_fmri_validation.instrument
+    -i trace.jsonl
+    [--chrome trace.json]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import numpy as np
+import pandas as pd
+
+from functools import wraps
+from collections import OrderedDict
+from collections.abc import Mapping
+
+ENVIRONMENT_VARIABLE = 'IEEG_FMRI_TRACE'
+
+
+def current_rss():
+    '''Resident set size of this process in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    '''Peak resident set size in bytes, since the last reset_peak_rss where the kernel supports it'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def nbytes(obj):
+    '''Bytes held by arrays in obj: arrays, preloaded mne Raw, DataFrames (without the objects their columns
+    point to), objects holding an array as data (BandTensor), and dicts, lists or tuples of them'''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=False).sum())
+    if isinstance(getattr(obj, 'data', None), np.ndarray):
+        return obj.data.nbytes
+    if isinstance(obj, Mapping):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    if getattr(obj, 'preload', False) and hasattr(obj, 'get_data'):
+        # one sample for the dtype, the signal itself is not copied
+        return len(obj.ch_names) * obj.n_times * obj.get_data(start=0, stop=1).itemsize
+    return 0
+
+
+class _State(threading.local):
+    def __init__(self):
+        self.stack = []
+
+
+_state = _State()
+_path = os.environ.get(ENVIRONMENT_VARIABLE) or None
+_lock = threading.Lock()
+_active = {}  # thread id: number of open spans, for spans of all threads of this process
+
+
+def enable(path):
+    '''Append records to path (JSON lines), in this process and in processes started from it'''
+    global _path
+    _path = path
+    os.environ[ENVIRONMENT_VARIABLE] = path
+
+
+def disable():
+    global _path
+    _path = None
+    os.environ.pop(ENVIRONMENT_VARIABLE, None)
+
+
+def enabled():
+    return _path is not None
+
+
+class Span(object):
+    '''Measurement of one stage. Peak RSS is measured from the start of the span: the kernel high-water mark is
+    reset on entry, and the parent span keeps the peak it had reached before so nesting does not lose it. The
+    high-water mark is process-wide, so it is only reset when no span of another thread is open; spans opened while
+    another thread has one open (e.g. the threaded read_meta) leave it alone and report peak_rss None'''
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.nbytes = None
+        self._peak = 0
+
+    def __enter__(self):
+        if _state.stack:
+            parent = _state.stack[-1]
+            parent._peak = max(parent._peak, peak_rss())
+            for key, value in parent.attributes.items():
+                if key in ('subject', 'task', 'acquisition'):
+                    self.attributes.setdefault(key, value)
+        _state.stack.append(self)
+        self.rss_before = current_rss()
+        thread = threading.get_ident()
+        with _lock:
+            self._measure_peak = not any(n for t, n in _active.items() if t != thread)
+            _active[thread] = _active.get(thread, 0) + 1
+            if self._measure_peak:
+                reset_peak_rss()
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.peak_rss = max(self._peak, peak_rss()) if self._measure_peak else None
+        self.rss_after = current_rss()
+        thread = threading.get_ident()
+        with _lock:
+            _active[thread] -= 1
+            if not _active[thread]:
+                del _active[thread]
+        _state.stack.pop()
+        if _state.stack and self.peak_rss is not None:
+            _state.stack[-1]._peak = max(_state.stack[-1]._peak, self.peak_rss)
+        if _path is not None:
+            _write(dict(self.attributes, name=self.name, pid=os.getpid(), tid=threading.get_ident(),
+                        depth=len(_state.stack), start=self.start, wall=self.wall, cpu=self.cpu,
+                        rss_before=self.rss_before, peak_rss=self.peak_rss, rss_after=self.rss_after,
+                        nbytes=self.nbytes, failed=kind is not None))
+        return False
+
+
+class _NullSpan(object):
+    nbytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name, force=False, **attributes):
+    '''Context manager measuring the enclosed block, a no-op when disabled unless force'''
+    if _path is None and not force:
+        return _null_span
+    return Span(name, **attributes)
+
+
+def _write(record):
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        with open(_path, 'a') as f:  # one append per record, processes can share the file
+            f.write(line)
+
+
+def _attributes(args):
+    if args and hasattr(args[0], 'subject'):
+        return dict((key, getattr(args[0], key)) for key in ('subject', 'task', 'acquisition')
+                    if getattr(args[0], key, None) is not None)
+    return {}
+
+
+def instrumented(name=None):
+    '''Decorate a function or method to run in a span named name (default qualified name). Subject, task and
+    acquisition are taken from self when present, nbytes from the returned arrays'''
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return func(*args, **kwargs)
+            with Span(label, **_attributes(args)) as s:
+                result = func(*args, **kwargs)
+                s.nbytes = nbytes(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def read(path, since=None):
+    '''Records of path, only those started after since (time.time()) when given'''
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [r for r in records if since is None or r['start'] >= since]
+
+
+def to_chrome_trace(records, path):
+    '''Complete events ('X') with times in microseconds, one track per process and thread'''
+    events = [{'name': r['name'], 'ph': 'X', 'ts': r['start'] * 1e6, 'dur': r['wall'] * 1e6, 'pid': r['pid'],
+               'tid': r['tid'], 'args': dict((k, v) for k, v in r.items()
+                                             if k not in ('name', 'start', 'wall', 'pid', 'tid'))}
+              for r in records]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(records, by='name'):
+    '''Table per stage (by='name') or per subject: count, total and max wall time, CPU time, max peak RSS of the
+    spans that measured it. Per subject only outermost spans are counted, so nested stages are not added twice'''
+    if by != 'name':
+        records = [r for r in records if r['depth'] == 0]
+    table = OrderedDict()
+    for r in sorted(records, key=lambda r: r['start']):
+        key = r.get(by)
+        row = table.setdefault(key, {'count': 0, 'wall': 0., 'max_wall': 0., 'cpu': 0., 'peak_rss': 0})
+        row['count'] += 1
+        row['wall'] += r['wall']
+        row['max_wall'] = max(row['max_wall'], r['wall'])
+        row['cpu'] += r['cpu']
+        row['peak_rss'] = max(row['peak_rss'], r['peak_rss'] or 0)
+    return table
+
+
+def print_summary(records, by='name', file=sys.stdout):
+    table = summary(records, by)
+    width = max([len(str(key)) for key in table] + [len(by)])
+    file.write(str(by).ljust(width) + '  count    wall s  max wall s     cpu s  peak MB\n')
+    for key, row in table.items():
+        file.write(str(key).ljust(width) + '  ' + str(row['count']).rjust(5) + '  ' +
+                   '%8.2f  %10.2f  %8.2f  %7d\n' % (row['wall'], row['max_wall'], row['cpu'],
+                                                   row['peak_rss'] // 2 ** 20))
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', type=str)
+    parser.add_argument('--chrome', type=str, default=None)
+    parser.add_argument('--by', type=str, default='name', choices=['name', 'subject'])
+    args = parser.parse_args()
+
+    records = read(args.input)
+    print_summary(records, args.by)
+    if args.chrome is not None:
+        to_chrome_trace(records, args.chrome)
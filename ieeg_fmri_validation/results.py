@@ -0,0 +1,167 @@
+'''
+Columnar store of the iEEG results (ols_music, r2_music, r2_rest) as Parquet datasets partitioned by
+analysis/band/subject, one file per subject and acquisition, written as soon as a subject is done. String columns
+are dictionary encoded, reads push filters on partition and data columns down to pyarrow so only the matching files
+and row groups are read. Requires pyarrow
+
+    store = ResultsStore('results')
+    store.load('r2_music', band='gamma', subject=['01', '02'], columns=['name', 'r2'])
+
+python -m ieeg_fmri_validation.results
+    -i results
+    [--table r2_music]
+'''
+
+import os
+import json
+import time
+import argparse
+import pandas as pd
+
+from urllib.parse import quote
+
+TABLES = ('ols_music', 'r2_music', 'r2_rest')
+PARTITIONS = ('analysis', 'band', 'subject')
+DICTIONARY_COLUMNS = ('analysis', 'subject', 'name', 'band')
+DEFAULTS = {'analysis': 'speech-music', 'band': 'gamma'}  # ols_music has neither column, it is speech-music gamma
+ORDER = ('_batch', '_run', '_row')  # stored position of every row: store, run in its batch, row in the frame
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('ResultsStore requires pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+class ResultsStore(object):
+    '''Results under root. Rows written through one ResultsStore form a batch, identified by its batch attribute
+    (time of creation in ns), so that a batch can be read back without results of earlier batches in root'''
+    def __init__(self, root):
+        self.root = root
+        self.pa = _pyarrow()
+        self.batch = time.time_ns()
+
+    def path(self, table, analysis, band, subject, acquisition=None):
+        return os.path.join(self.root, table, 'analysis=' + quote(str(analysis), safe=''),
+                            'band=' + quote(str(band), safe=''), 'subject=' + quote(str(subject), safe=''),
+                            'part' + ('-acq-' + acquisition if acquisition else '') + '.parquet')
+
+    def write(self, table, frame, acquisition=None, run=0):
+        '''Write frame, one file per analysis/band/subject partition. Rewriting a subject and acquisition replaces
+        its files, each file is written under a temporary name and renamed. The batch, run (the position of the
+        subject and acquisition in the batch) and the row positions are stored so that load returns rows in written
+        order'''
+        if frame is None or not len(frame):
+            return []
+        pa = self.pa
+        columns = list(frame.columns)
+        frame = frame.assign(**dict((key, value) for key, value in DEFAULTS.items() if key not in frame))
+        frame = frame.assign(_batch=self.batch, _run=run, _row=range(len(frame)))
+        paths = []
+        for (analysis, band, subject), part in frame.groupby(list(PARTITIONS), sort=False):
+            data = part.drop(columns=list(PARTITIONS)).reset_index(drop=True)
+            for column in DICTIONARY_COLUMNS:
+                if column in data and pd.api.types.is_string_dtype(data[column]):
+                    data[column] = data[column].astype('category')
+            arrow = pa.Table.from_pandas(data, preserve_index=False)
+            arrow = arrow.replace_schema_metadata(dict(arrow.schema.metadata or {},
+                                                       columns=json.dumps(columns)))
+            path = self.path(table, analysis, band, subject, acquisition)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = os.path.join(os.path.dirname(path), '.tmp.' + str(os.getpid()) + '.' + os.path.basename(path))
+            pa.parquet.write_table(arrow, temp, use_dictionary=True, compression='zstd')
+            os.replace(temp, path)
+            paths.append(path)
+        return paths
+
+    def write_outputs(self, outputs, acquisition=None, run=0):
+        '''Write the (ols_music, r2_music, r2_rest) of one subject as returned by process_one'''
+        for table, frame in zip(TABLES, outputs):
+            self.write(table, frame, acquisition, run)
+
+    def dataset(self, table):
+        '''pyarrow dataset of table, partition columns as dictionary-encoded strings'''
+        pa = self.pa
+        partitioning = pa.dataset.partitioning(pa.schema([(key, pa.dictionary(pa.int32(), pa.string()))
+                                                          for key in PARTITIONS]), flavor='hive', dictionaries='infer')
+        return pa.dataset.dataset(os.path.join(self.root, table), format='parquet', partitioning=partitioning,
+                                  exclude_invalid_files=False, ignore_prefixes=['.'])
+
+    def _filter(self, filters):
+        expression = None
+        for key, value in filters.items():
+            field = self.pa.dataset.field(key)
+            condition = field.isin(list(value)) if isinstance(value, (list, tuple, set)) else field == value
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def _read_columns(self, dataset, columns):
+        if columns is None:
+            return None
+        return [c for c in dataset.schema.names if c in columns or c in ORDER]
+
+    def _frame(self, table, columns, categorical):
+        order = json.loads(table.schema.metadata[b'columns']) if table.schema.metadata and \
+            b'columns' in table.schema.metadata else table.column_names
+        frame = table.to_pandas()
+        frame = frame[[c for c in order if c in frame and (columns is None or c in columns)]]
+        if not categorical:
+            for column in frame.columns:
+                if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                    frame[column] = frame[column].astype(frame[column].cat.categories.dtype)
+        return frame
+
+    def load(self, table, columns=None, categorical=True, batch=None, **filters):
+        '''DataFrame of table with the columns of the frames written (default all), rows matching filters
+        (column=value or column=[values]) in the order they were written: by batch, run, then row within the frame.
+        With batch (a ResultsStore's batch attribute), only rows of that batch. String columns are categorical
+        unless categorical=False. The result is read into memory at once, scan iterates over tables larger than
+        memory'''
+        if not os.path.isdir(os.path.join(self.root, table)):
+            return None
+        if batch is not None:
+            filters['_batch'] = batch
+        dataset = self.dataset(table)
+        result = dataset.to_table(columns=self._read_columns(dataset, columns), filter=self._filter(filters))
+        if all(c in result.column_names for c in ORDER):
+            result = result.sort_by([(c, 'ascending') for c in ORDER])
+        result = result.replace_schema_metadata(dataset.schema.metadata)
+        return self._frame(result, columns, categorical)
+
+    def scan(self, table, columns=None, batch_size=2 ** 16, categorical=True, **filters):
+        '''Iterate lazily over table as DataFrames of at most batch_size rows, for tables larger than memory. Rows
+        come in file order (by partition), not sorted into written order as in load'''
+        dataset = self.dataset(table)
+        for batch in dataset.to_batches(columns=self._read_columns(dataset, columns), filter=self._filter(filters),
+                                        batch_size=batch_size):
+            if batch.num_rows:
+                yield self._frame(self.pa.Table.from_batches([batch]).replace_schema_metadata(
+                    dataset.schema.metadata), columns, categorical)
+
+    def frames(self, categorical=True, batch=None, **filters):
+        '''(ols_music, r2_music, r2_rest) as returned by process_iemu, with the rows in the same order; of one batch
+        only with batch, as in load'''
+        return tuple(self.load(table, categorical=categorical, batch=batch, **filters) for table in TABLES)
+
+    def subjects(self, table='r2_music'):
+        path = os.path.join(self.root, table)
+        return sorted(set(part.split('=', 1)[1] for _, dirs, _ in os.walk(path) for part in dirs
+                          if part.startswith('subject='))) if os.path.isdir(path) else []
+
+
+##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', type=str)
+    parser.add_argument('--table', type=str, default=None, choices=TABLES)
+    args = parser.parse_args()
+
+    store = ResultsStore(args.input)
+    for table in TABLES if args.table is None else [args.table]:
+        frame = store.load(table)
+        print(table + ': ' + ('missing' if frame is None else str(len(frame)) + ' rows, ' +
+                              str(len(store.subjects(table))) + ' subjects'))
@@ -1,8 +1,26 @@
 import re
 from fractions import Fraction
-from scipy.signal import resample_poly
+from functools import lru_cache
+from scipy.signal import resample_poly, firwin
+from scipy.ndimage import uniform_filter1d
 import numpy as np
 
+class lazy_property(object):
+    """ Attribute computed by the decorated method on first access and then stored on the instance, so later
+    accesses are plain attribute lookups. Assigning or deleting the attribute overrides or resets it
+    (functools.cached_property, which needs python 3.8).
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.name = func.__name__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
 def sort_nicely(l):
     """ Sort the given list in the way that humans expect.
     """
@@ -10,15 +28,31 @@ def sort_nicely(l):
     alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
     l.sort( key=alphanum_key )
 
-def resample(x, sr1, sr2, axis=0):
-    '''sr1: target, sr2: source'''
-    a, b = Fraction(sr1, sr2)._numerator, Fraction(sr1, sr2)._denominator
-    return resample_poly(x, a, b, axis).astype(np.float32)
+@lru_cache(maxsize=None)
+def _resample_filter(up, down, dtype):
+    '''resample_poly's default anti-aliasing filter, designed once per rate pair'''
+    max_rate = max(up, down)
+    h = firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(dtype)
+    h.flags.writeable = False
+    return h
+
+def resample(x, sr1, sr2, axis=0, dtype=np.float32):
+    '''sr1: target, sr2: source. Computes in the float type of x, returns dtype'''
+    frac = Fraction(sr1, sr2)
+    x = np.asarray(x)
+    work = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    h = _resample_filter(frac.numerator, frac.denominator, np.dtype(work))
+    return resample_poly(x, frac.numerator, frac.denominator, axis, window=h).astype(dtype, copy=False)
 
-def smooth_signal(y, n):
-    box = np.ones(n)/n
-    ys = np.convolve(y, box, mode='same')
-    return ys
+def smooth_signal(y, n, axis=0):
+    '''Moving average of width n along axis, same alignment and zero edges as np.convolve(y, box, 'same')'''
+    return uniform_filter1d(y, n, axis=axis, mode='constant')
 
-def zscore(x):
-    return (x - np.mean(x, 0, keepdims=True)) / np.std(x, 0, keepdims=True)
\ No newline at end of file
+def zscore(x, axis=0, dtype=None, out=None):
+    '''z-score along axis in dtype (default: float type of x). Pass out=x to normalize in place'''
+    if dtype is None:
+        dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    mean = np.mean(x, axis, dtype=dtype, keepdims=True)
+    std = np.std(x, axis, dtype=dtype, keepdims=True)
+    out = np.subtract(x, mean, out=out, dtype=dtype)
+    return np.divide(out, std, out=out)